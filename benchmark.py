@@ -0,0 +1,625 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import tracemalloc
+
+import numpy as np
+import torch
+import model.model as module_arch
+import model.quantization as quantization
+from parse_config import ConfigParser
+from deepmvlm.model_store import ModelStore, create_model_from_state_dict
+from deepmvlm.result_cache import ResultCache
+from prediction import Predict2D
+from prediction import TorchBackend
+from prediction import OnnxRuntimeBackend
+from prediction import find_maxima_in_batch_of_heatmaps_numpy
+from utils3d import Utils3D
+from utils3d import Render3D
+from utils3d import ViewSet
+from utils3d import Mesh3D
+from utils3d import ParallelRender3D
+from utils3d import SurfaceIndex
+from utils3d import vtk_lazy as vtk
+from utils3d.viewset import clear_view_set_cache
+from utils import file_sha256
+
+
+# Synthetic heatmap maxima and view transformations with the sizes given in the config
+def random_heatmap_maxima_and_transformations(config, seed=0):
+    n_landmarks = config['arch']['args']['n_landmarks']
+    n_views = config['data_loader']['args']['n_views']
+    hm_size = config['data_loader']['args']['heatmap_size']
+
+    rng = np.random.RandomState(seed)
+    heatmap_maxima = np.zeros((n_landmarks, n_views, 3))
+    heatmap_maxima[:, :, 0:2] = rng.uniform(0, hm_size, (n_landmarks, n_views, 2))
+    heatmap_maxima[:, :, 2] = rng.uniform(0, 1, (n_landmarks, n_views))
+
+    np.random.seed(seed)
+    transform_stack = Render3D(config).generate_3d_transformations()
+    return heatmap_maxima, transform_stack
+
+
+# Synthetic view lines through known landmarks with noise and a fraction of outliers
+def random_view_lines(config, seed=0, noise=1.5, outlier_fraction=0.3):
+    heatmap_maxima, transform_stack = random_heatmap_maxima_and_transformations(config, seed)
+    n_landmarks, n_views = heatmap_maxima.shape[0:2]
+
+    rng = np.random.RandomState(seed)
+    landmarks = rng.uniform(-60, 60, (n_landmarks, 3))
+    rotations = Utils3D.get_view_rotation_matrices(transform_stack)
+    directions = rotations[:, 2, :]  # view direction in original space
+    points = landmarks[:, np.newaxis, :] + rng.normal(0, noise, (n_landmarks, n_views, 3))
+    outliers = rng.uniform(size=(n_landmarks, n_views)) < outlier_fraction
+    points[outliers] += rng.normal(0, 40, (np.sum(outliers), 3))
+
+    lm_start = points + 500 * directions
+    lm_end = points - 500 * directions
+    return landmarks, lm_start, lm_end, heatmap_maxima
+
+
+# Synthetic bumpy face-sized surface with point normals written as a .vtk file in work_dir. With scalars, the
+# surface also has float point scalars (as curvature or quality values), which VTK colors with a lookup table
+def synthetic_mesh_file(work_dir, resolution=120, scalars=False):
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(1)
+    sphere.SetThetaResolution(resolution)
+    sphere.SetPhiResolution(resolution)
+    sphere.Update()
+    pd = sphere.GetOutput()
+    p = vtk.vtk_to_numpy(pd.GetPoints().GetData()).astype(np.float64)
+    r = 1 + 0.15 * np.sin(4 * p[:, 0]) * np.cos(3 * p[:, 1]) + 0.1 * np.exp(-((p[:, 2] - 1) ** 2 + p[:, 0] ** 2) * 8)
+    p = p * r[:, np.newaxis] * np.array([70, 90, 60])
+    pd.GetPoints().SetData(vtk.numpy_to_vtk(p.astype(np.float32), deep=True))
+
+    normals = vtk.vtkPolyDataNormals()
+    if scalars:
+        values = vtk.numpy_to_vtk((r - np.min(r)) / (np.max(r) - np.min(r)), deep=True)
+        values.SetName('values')
+        pd.GetPointData().SetScalars(values)
+    normals.SetInputData(pd)
+    normals.Update()
+    file_name = str(work_dir / ('benchmark_mesh_' + str(resolution) + ('_scalars' if scalars else '') + '.vtk'))
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetInputData(normals.GetOutput())
+    writer.SetFileName(file_name)
+    writer.Write()
+    return file_name
+
+
+# Synthetic batch of heatmaps with one gaussian blob per landmark and a bit of noise
+def random_heatmaps(config, seed=0, sigma=4):
+    batch_size = config['data_loader']['args']['batch_size']
+    n_landmarks = config['arch']['args']['n_landmarks']
+    hm_size = config['data_loader']['args']['heatmap_size']
+
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:hm_size, 0:hm_size]
+    centers = rng.uniform(0, hm_size, (batch_size, n_landmarks, 2))
+    heatmaps = np.exp(-((rows - centers[:, :, 0, np.newaxis, np.newaxis]) ** 2 +
+                        (cols - centers[:, :, 1, np.newaxis, np.newaxis]) ** 2) / (2 * sigma ** 2))
+    heatmaps += rng.normal(0, 0.01, heatmaps.shape)
+    return heatmaps.astype(np.float32)
+
+
+# MVLMModel with random weights and random batch normalisation statistics in evaluation mode
+def random_model(config, seed=0):
+    torch.manual_seed(seed)
+    model = config.initialize('arch', module_arch)
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            torch.nn.init.uniform_(m.weight, 0.5, 1.5)
+            torch.nn.init.uniform_(m.bias, -0.1, 0.1)
+            torch.nn.init.uniform_(m.running_mean, -0.1, 0.1)
+            torch.nn.init.uniform_(m.running_var, 0.5, 1.5)
+    return model.eval()
+
+
+def random_images(config, n_images, seed=0):
+    image_size = config['data_loader']['args']['image_size']
+    in_channels = module_arch.MVLMModel(image_channels=config['arch']['args']['image_channels']).in_channels
+    rng = np.random.RandomState(seed)
+    return torch.from_numpy(rng.uniform(0, 1, (n_images, in_channels, image_size, image_size)).astype(np.float32))
+
+
+def time_function(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return np.median(times)
+
+
+def benchmark_view_lines(config, repeats, work_dir):
+    heatmap_maxima, transform_stack = random_heatmap_maxima_and_transformations(config)
+    u3d = Utils3D(config)
+    u3d.heatmap_maxima = heatmap_maxima
+    u3d.transformations_3d = transform_stack
+
+    time_vtk = time_function(u3d.compute_lines_from_heatmap_maxima_vtk, repeats)
+    lm_start_vtk, lm_end_vtk = u3d.lm_start, u3d.lm_end
+    time_np = time_function(u3d.compute_lines_from_heatmap_maxima, repeats)
+
+    max_diff = max(np.max(np.abs(u3d.lm_start - lm_start_vtk)), np.max(np.abs(u3d.lm_end - lm_end_vtk)))
+    print('View lines for', heatmap_maxima.shape[0], 'landmarks in', heatmap_maxima.shape[1], 'views')
+    print('vtk   : {:.4f} s'.format(time_vtk))
+    print('numpy : {:.4f} s (speedup {:.1f}x)'.format(time_np, time_vtk / time_np))
+    print('max difference between line end points: {:.2e}'.format(max_diff))
+
+
+def benchmark_ransac(config, repeats, work_dir):
+    landmarks, lm_start, lm_end, heatmap_maxima = random_view_lines(config)
+    u3d = Utils3D(config)
+    u3d.heatmap_maxima = heatmap_maxima
+    u3d.lm_start = lm_start
+    u3d.lm_end = lm_end
+
+    time_loop = time_function(u3d.compute_all_landmarks_from_view_lines_loop, repeats)
+    landmarks_loop = u3d.landmarks
+    time_batched = time_function(u3d.compute_all_landmarks_from_view_lines, repeats)
+
+    print('RANSAC for', lm_start.shape[0], 'landmarks with', lm_start.shape[1], 'view lines')
+    print('loop    : {:.4f} s'.format(time_loop))
+    print('batched : {:.4f} s (speedup {:.1f}x)'.format(time_batched, time_loop / time_batched))
+    print('mean error to true landmarks: loop {:.3f} batched {:.3f}'.format(
+        np.mean(np.linalg.norm(landmarks_loop - landmarks, axis=1)),
+        np.mean(np.linalg.norm(u3d.landmarks - landmarks, axis=1))))
+
+
+def benchmark_heatmap_maxima(config, repeats, work_dir):
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    heatmaps = torch.from_numpy(random_heatmaps(config)).to(device)
+    batch_size, n_landmarks = heatmaps.shape[0:2]
+    predict_2d = Predict2D(config, None, device)
+
+    maxima_host = np.zeros((n_landmarks, batch_size, 3))
+    maxima_numpy = np.zeros((n_landmarks, batch_size, 3))
+    maxima_device = np.zeros((n_landmarks, batch_size, 3))
+
+    def on_host():
+        predict_2d.find_maxima_in_batch_of_heatmaps(heatmaps.cpu().numpy(), 0, maxima_host)
+
+    def batched_numpy():
+        coordinates = find_maxima_in_batch_of_heatmaps_numpy(heatmaps.cpu().numpy())
+        predict_2d.store_maxima_of_batch(coordinates, 0, maxima_numpy)
+
+    def on_device():
+        coordinates = TorchBackend.find_maxima_in_batch_of_heatmaps_on_device(heatmaps)
+        predict_2d.store_maxima_of_batch(coordinates.cpu().numpy(), 0, maxima_device)
+
+    time_host = time_function(on_host, repeats)
+    time_numpy = time_function(batched_numpy, repeats)
+    time_device = time_function(on_device, repeats)
+    print('Heatmap maxima for a batch of', batch_size, 'x', n_landmarks, 'heatmaps on', device)
+    print('copy + numpy   : {:.4f} s'.format(time_host))
+    print('batched numpy  : {:.4f} s (speedup {:.1f}x)'.format(time_numpy, time_host / time_numpy))
+    print('on device      : {:.4f} s (speedup {:.1f}x)'.format(time_device, time_host / time_device))
+    print('max difference in maxima: numpy {:.2e} device {:.2e}'.format(
+        np.max(np.abs(maxima_host - maxima_numpy)), np.max(np.abs(maxima_host - maxima_device))))
+
+
+def benchmark_inference_model(config, repeats, work_dir):
+    model = random_model(config)
+    inference_model = module_arch.MVLMInferenceModel(model)
+    half_resolution_model = module_arch.MVLMInferenceModel(model, half_resolution=True)
+    data = random_images(config, 2)
+
+    with torch.no_grad():
+        time_full = time_function(lambda: model(data), repeats)
+        time_inference = time_function(lambda: inference_model(data), repeats)
+        time_half = time_function(lambda: half_resolution_model(data), repeats)
+
+    # The heatmaps are checked with python test.py --inference_model_check
+    print('Prediction of', data.shape[0], 'images on cpu')
+    print('MVLMModel          : {:.4f} s'.format(time_full))
+    print('MVLMInferenceModel : {:.4f} s (speedup {:.2f}x)'.format(time_inference, time_full / time_inference))
+    print('half resolution    : {:.4f} s (speedup {:.2f}x)'.format(time_half, time_full / time_half))
+
+
+def benchmark_quantization(config, repeats, work_dir):
+    batch_size = config['data_loader']['args']['batch_size']
+    inference_model = module_arch.MVLMInferenceModel(random_model(config))
+    calibration_data = random_images(config, 2 * batch_size, seed=1)
+    quantized_model = quantization.quantize_model_int8(inference_model, torch.split(calibration_data, batch_size))
+    data = random_images(config, 2)
+
+    with torch.no_grad():
+        time_fp32 = time_function(lambda: inference_model(data), repeats)
+        time_int8 = time_function(lambda: quantized_model(data), repeats)
+        heatmaps_fp32 = inference_model(data)
+        heatmaps_int8 = quantized_model(data)
+
+    # The heatmaps of a random model have no distinct maxima, so the heatmaps are compared directly
+    relative_error = (torch.norm(heatmaps_int8 - heatmaps_fp32) / torch.norm(heatmaps_fp32)).item()
+    print('Prediction of', data.shape[0], 'images on cpu with backend', torch.backends.quantized.engine)
+    print('fp32 : {:.4f} s'.format(time_fp32))
+    print('int8 : {:.4f} s (speedup {:.2f}x)'.format(time_int8, time_fp32 / time_int8))
+    print('relative difference in heatmaps: {:.2e}'.format(relative_error))
+    print('Landmark accuracy on real scans: python test.py -c <config> -r <checkpoint> --quantization_test')
+
+
+def benchmark_onnxruntime(config, repeats, work_dir):
+    inference_model = module_arch.MVLMInferenceModel(random_model(config)).eval()
+    data = random_images(config, 2)
+    model_file = str(work_dir / 'benchmark_model.onnx')
+    torch.onnx.export(inference_model, (data[0:1],), model_file, input_names=['images'], output_names=['heatmaps'],
+                      dynamic_axes={'images': {0: 'batch'}, 'heatmaps': {0: 'batch'}}, opset_version=17, dynamo=False)
+
+    images = data.permute(0, 2, 3, 1).numpy()
+    torch_backend = TorchBackend(inference_model, torch.device('cpu'))
+    ort_backend = OnnxRuntimeBackend(model_file)
+    time_torch = time_function(lambda: torch_backend.predict_heatmaps(images), repeats)
+    time_ort = time_function(lambda: ort_backend.predict_heatmaps(images), repeats)
+    heatmaps_torch = torch_backend.predict_heatmaps(images).numpy()
+    heatmaps_ort = ort_backend.predict_heatmaps(images)
+
+    print('Prediction of', data.shape[0], 'images on cpu')
+    print('PyTorch      : {:.4f} s'.format(time_torch))
+    print('ONNX Runtime : {:.4f} s (speedup {:.2f}x)'.format(time_ort, time_torch / time_ort))
+    print('max difference in heatmaps: {:.2e}'.format(np.max(np.abs(heatmaps_torch - heatmaps_ort))))
+
+
+# Model startup as done before the model store: random initialisation followed by unpickling the checkpoint
+def load_model_unpickled(config, file_name):
+    model = config.initialize('arch', module_arch)
+    model.load_state_dict(torch.load(file_name, map_location='cpu'))
+    return model
+
+
+def benchmark_startup(config, repeats, work_dir):
+    # A checkpoint of a random model named with its hash prefix as the checkpoints in models_urls
+    temp_name = str(work_dir / 'benchmark_checkpoint.pth')
+    torch.save(random_model(config).state_dict(), temp_name)
+    file_name = str(work_dir / 'MVLMModel_benchmark-{}.pth'.format(ModelStore.compute_sha256(temp_name)[:8]))
+    os.replace(temp_name, file_name)
+    if os.path.isfile(file_name + '.sha256'):
+        os.remove(file_name + '.sha256')
+    store = ModelStore(str(work_dir), {'benchmark': 'https://localhost/' + os.path.basename(file_name)},
+                       offline=True)
+
+    def load_model_from_store():
+        return create_model_from_state_dict(config, module_arch, store.load_state_dict('benchmark'))
+
+    start = time.time()
+    store.get_checkpoint('benchmark')
+    time_verify = time.time() - start
+    time_unpickled = time_function(lambda: load_model_unpickled(config, file_name), repeats)
+    time_store = time_function(load_model_from_store, repeats)
+
+    model_unpickled = load_model_unpickled(config, file_name).eval()
+    model_store = load_model_from_store().eval()
+    data = random_images(config, 1)
+    with torch.no_grad():
+        max_diff = torch.max(torch.abs(model_unpickled(data)[1] - model_store(data)[1])).item()
+    print('Model startup with a checkpoint of {:.1f} MB'.format(os.path.getsize(file_name) / 1e6))
+    print('first checksum verification : {:.4f} s'.format(time_verify))
+    print('random init + torch.load    : {:.4f} s'.format(time_unpickled))
+    print('model store (meta + mmap)   : {:.4f} s (speedup {:.1f}x)'.format(time_store, time_unpickled / time_store))
+    print('max difference in heatmaps: {:.2e}'.format(max_diff))
+
+
+# Import times in seconds (cumulative, self) per module reported by python -X importtime for a fresh interpreter
+def get_import_times(statement):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(cumulative_us) / 1e6, int(self_us) / 1e6)
+    return times
+
+
+def benchmark_imports(config, repeats, work_dir):
+    heavy_packages = ['torch', 'vtk', 'vtkmodules', 'matplotlib', 'imageio', 'scipy', 'tensorboard', 'onnxruntime']
+    for statement in ['import deepmvlm', 'import predict', 'import parse_config', 'import deepmvlm.pipeline']:
+        runs = [get_import_times(statement) for _ in range(repeats)]
+        top_module = statement.split()[-1]
+        total = np.median([times[top_module][0] for times in runs])
+        loaded = [p for p in heavy_packages if p in runs[0]]
+        print('{:28s}: {:.3f} s, heavy packages loaded: {}'.format(statement, total, ', '.join(loaded) or 'none'))
+
+        # The top level packages that take the most time
+        packages = {}
+        for name, (_, self_time) in runs[0].items():
+            package = name.strip().split('.')[0]
+            packages[package] = packages.get(package, 0) + self_time
+        slowest = sorted(packages.items(), key=lambda item: -item[1])[:5]
+        print('    slowest: ' + ', '.join('{} {:.3f} s'.format(name, t) for name, t in slowest))
+
+
+# The adaptive view loop of DeepMVLM.predict_one_file_adaptive on synthetic view lines, where the rendering and
+# prediction of an increment of views is replaced by taking the next views of the synthetic lines
+def benchmark_adaptive_views(config, repeats, work_dir):
+    process_3d = config['process_3d']
+    max_views = process_3d.get('max_views', config['data_loader']['args']['n_views'])
+    min_views = min(process_3d.get('min_views', 24), max_views)
+    view_increment = process_3d.get('view_increment', 8)
+    landmark_tolerance = process_3d.get('landmark_tolerance', 1.0)
+    inlier_tolerance = process_3d.get('inlier_tolerance', 0.05)
+
+    for noise, outlier_fraction in [(1.0, 0.1), (1.5, 0.3), (3.0, 0.5)]:
+        landmarks, lm_start, lm_end, heatmap_maxima = random_view_lines(config, 0, noise, outlier_fraction)
+        u3d = Utils3D(config)
+        previous = None
+        n_views = 0
+        while n_views < max_views:
+            n_views = min(max(n_views + view_increment, min_views), max_views)
+            u3d.heatmap_maxima = heatmap_maxima[:, :n_views]
+            u3d.lm_start = lm_start[:, :n_views]
+            u3d.lm_end = lm_end[:, :n_views]
+            u3d.compute_all_landmarks_from_view_lines()
+            u3d.refine_landmarks_on_consensus()
+            current = (u3d.landmarks.copy(), u3d.landmark_inliers.copy(), n_views)
+            if previous is not None and Utils3D.landmark_estimates_converged(
+                    previous, current, landmark_tolerance, inlier_tolerance):
+                break
+            previous = current
+        error_adaptive = np.mean(np.linalg.norm(u3d.landmarks - landmarks, axis=1))
+
+        u3d.heatmap_maxima, u3d.lm_start, u3d.lm_end = heatmap_maxima, lm_start, lm_end
+        u3d.compute_all_landmarks_from_view_lines()
+        error_all = np.mean(np.linalg.norm(u3d.landmarks - landmarks, axis=1))
+        u3d.refine_landmarks_on_consensus()
+        error_refined = np.mean(np.linalg.norm(u3d.landmarks - landmarks, axis=1))
+        print('noise {} outliers {:.0%}: {} of {} views, mean error adaptive {:.3f} all views {:.3f} '
+              '(refined {:.3f})'.format(noise, outlier_fraction, n_views, lm_start.shape[1], error_adaptive,
+                                        error_all, error_refined))
+
+
+# The view set coverage and view lines are checked with python test.py --check view_sets
+def benchmark_view_sets(config, repeats, work_dir):
+    heatmap_maxima, _ = random_heatmap_maxima_and_transformations(config)
+    transform_stack = ViewSet.generate_halton_transformations(config, heatmap_maxima.shape[1])
+    u3d = Utils3D(config)
+    u3d.heatmap_maxima = heatmap_maxima
+    u3d.transformations_3d = transform_stack
+
+    def compute_lines_uncached():
+        clear_view_set_cache()
+        u3d.compute_lines_from_heatmap_maxima()
+
+    time_uncached = time_function(compute_lines_uncached, repeats)
+    time_cached = time_function(u3d.compute_lines_from_heatmap_maxima, repeats)
+    print('View lines for', heatmap_maxima.shape[0], 'landmarks in', heatmap_maxima.shape[1], 'views')
+    print('tables computed per scan : {:.5f} s'.format(time_uncached))
+    print('cached tables            : {:.5f} s (speedup {:.1f}x)'.format(time_cached, time_uncached / time_cached))
+
+
+# Speed of the numpy rasterizer against the VTK/OpenGL renderings of the geometry and depth channels. The renderings
+# are compared by python test.py --check software_rendering
+def benchmark_software_rendering(config, repeats, work_dir):
+    n_views = 16
+    render_3d = Render3D(config)
+    transform_stack = ViewSet.generate_halton_transformations(config, n_views)
+    channels = ['geometry', 'depth']
+
+    for scalars in [False, True]:
+        mesh = Mesh3D(config, synthetic_mesh_file(work_dir, scalars=scalars))
+        time_vtk = time_function(
+            lambda: render_3d.render_3d_multi_rgb_geometry_depth(transform_stack, mesh, channels), repeats)
+        time_numpy = time_function(
+            lambda: render_3d.render_3d_geometry_depth_software(transform_stack, mesh, channels), repeats)
+
+        print('Geometry and depth renderings of', n_views, 'views of a surface with',
+              mesh.polydata.GetNumberOfCells(), 'triangles' + (' and float scalars' if scalars else ''))
+        print('vtk   : {:.4f} s per view'.format(time_vtk / n_views))
+        print('numpy : {:.4f} s per view'.format(time_numpy / n_views))
+
+
+def benchmark_parallel_rendering(config, repeats, work_dir):
+    render_3d = Render3D(config)
+    file_name = synthetic_mesh_file(work_dir)
+    mesh = Mesh3D(config, file_name)
+    transform_stack = render_3d.generate_3d_transformations()
+    n_views = transform_stack.shape[0]
+
+    time_single = time_function(lambda: render_3d.render_3d_file(mesh, transform_stack), repeats)
+    images_single, _ = render_3d.render_3d_file(mesh, transform_stack)
+    print('Rendering', n_views, 'views of a surface with', mesh.polydata.GetNumberOfCells(), 'triangles on',
+          os.cpu_count(), 'CPUs')
+    print('1 process   : {:.4f} s'.format(time_single))
+    for n_workers in [2, 4, os.cpu_count()]:
+        parallel_render_3d = ParallelRender3D(config, n_workers)
+        # The first call lets the workers read the mesh
+        parallel_render_3d.render_3d_file(file_name, transform_stack)
+        time_parallel = time_function(lambda: parallel_render_3d.render_3d_file(file_name, transform_stack), repeats)
+        images_parallel, _ = parallel_render_3d.render_3d_file(file_name, transform_stack)
+        print('{} processes : {:.4f} s, identical images {}'.format(
+            n_workers, time_parallel, np.array_equal(images_single, images_parallel)))
+        del images_parallel
+        parallel_render_3d.close()
+
+
+# Reads the last rendering through vtkWindowToImageFilter as the renderer did before reading directly from the
+# render window
+def read_rendering_with_image_filter(ren_win, image_stack, view, first_channel, n_channels):
+    w2if = vtk.vtkWindowToImageFilter()
+    w2if.SetInput(ren_win)
+    w2if.ShouldRerenderOff()
+    w2if.SetInputBufferTypeToRGB()
+    w2if.Update()
+    im = w2if.GetOutput()
+    rows, cols, _ = im.GetDimensions()
+    a = vtk.vtk_to_numpy(im.GetPointData().GetScalars()).reshape(rows, cols, -1)
+    image_stack[view, :, :, first_channel:first_channel + n_channels] = np.flipud(a)[:, :, 0:n_channels]
+
+
+def benchmark_readback(config, repeats, work_dir):
+    render_3d = Render3D(config)
+    mesh = Mesh3D(config, synthetic_mesh_file(work_dir))
+    transform_stack = render_3d.generate_3d_transformations()
+    n_views = transform_stack.shape[0]
+
+    render_3d.render_3d_file(mesh, transform_stack)
+    time_render = time_function(lambda: render_3d.render_3d_file(mesh, transform_stack), repeats)
+    tracemalloc.start()
+    image_stack, _ = render_3d.render_3d_file(mesh, transform_stack)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('Rendering {} views: {:.4f} s, image stack {:.1f} MB, peak memory {:.1f} MB'.format(
+        n_views, time_render, image_stack.nbytes / 2 ** 20, peak / 2 ** 20))
+
+    # The window still holds the last view
+    ren_win = render_3d.get_render_window()
+    n_reads = 100
+    time_filter = time_function(lambda: [read_rendering_with_image_filter(ren_win, image_stack, 0, 0, 3)
+                                         for _ in range(n_reads)], repeats)
+    time_direct = time_function(lambda: [render_3d.read_pixels(ren_win, image_stack, 0, 0, 3)
+                                         for _ in range(n_reads)], repeats)
+    print('RGB readback through vtkWindowToImageFilter: {:.3f} ms'.format(time_filter / n_reads * 1000))
+    print('RGB readback directly into the image stack  : {:.3f} ms'.format(time_direct / n_reads * 1000))
+
+
+def benchmark_surface_projection(config, repeats, work_dir):
+    n_landmarks = config['arch']['args']['n_landmarks']
+    for resolution in [120, 1000]:
+        file_name = synthetic_mesh_file(work_dir, resolution)
+        mesh = Mesh3D(config, file_name)
+        # Landmarks a few mm from the surface in the pre-aligned space
+        points = vtk.vtk_to_numpy(mesh.get_aligned_surface().GetPoints().GetData())
+        rng = np.random.RandomState(0)
+        landmarks = points[rng.randint(0, len(points), n_landmarks)] + rng.normal(0, 3, (n_landmarks, 3))
+        mesh.get_surface_index()
+
+        def project(u3d_project, new_mesh):
+            u3d = Utils3D(config)
+            u3d.landmarks = landmarks.copy()
+            m = Mesh3D(config, file_name) if new_mesh else mesh
+            u3d_project(u3d)(m)
+            return u3d.landmarks
+
+        time_vtk = time_function(lambda: project(lambda u3d: u3d.project_landmarks_to_surface_vtk, True), repeats)
+        time_new = time_function(lambda: project(lambda u3d: u3d.project_landmarks_to_surface, True), repeats)
+        time_cached = time_function(lambda: project(lambda u3d: u3d.project_landmarks_to_surface, False), repeats)
+        index_name = str(work_dir / 'benchmark_surface_index.npz')
+        with open(index_name, 'wb') as f:
+            mesh.get_surface_index().save(f)
+        time_load = time_function(lambda: SurfaceIndex.load(index_name), repeats)
+        time_read = time_function(lambda: Mesh3D(config, file_name), repeats)
+
+        diff = np.linalg.norm(project(lambda u3d: u3d.project_landmarks_to_surface_vtk, False) -
+                              project(lambda u3d: u3d.project_landmarks_to_surface, False), axis=1)
+        print('Projection of', n_landmarks, 'landmarks to a surface with', mesh.polydata.GetNumberOfCells(),
+              'triangles (reading the mesh takes {:.4f} s)'.format(time_read))
+        print('vtkCellLocator (with reading the mesh)   : {:.4f} s'.format(time_vtk))
+        print('SurfaceIndex (with reading the mesh)     : {:.4f} s'.format(time_new))
+        print('SurfaceIndex already built               : {:.4f} s'.format(time_cached))
+        print('Reading a saved SurfaceIndex             : {:.4f} s'.format(time_load))
+        print('Max difference {:.2e} mm'.format(np.max(diff)))
+
+
+def benchmark_result_cache(config, repeats, work_dir):
+    n_landmarks = config['arch']['args']['n_landmarks']
+    file_name = synthetic_mesh_file(work_dir, 1000)
+    cache_dir = str(work_dir / 'benchmark_result_cache')
+    rng = np.random.RandomState(0)
+    result = {'landmarks': rng.normal(0, 50, (n_landmarks, 3)), 'landmark_errors': rng.uniform(0, 5, n_landmarks),
+              'landmark_inliers': rng.randint(0, 96, n_landmarks), 'transformations_3d': rng.normal(0, 1, (96, 6))}
+    cache = ResultCache(cache_dir, {'config': 0}, {'model': 0})
+    cache.put(cache.get_key(file_name), result)
+
+    time_hash = time_function(lambda: file_sha256(file_name), repeats)
+    # A new cache object reads the content hash of the mesh from the cache directory
+    def get_with_new_cache():
+        new_cache = ResultCache(cache_dir, {'config': 0}, {'model': 0})
+        return new_cache.get(new_cache.get_key(file_name))
+
+    time_new = time_function(get_with_new_cache, repeats)
+    time_hit = time_function(lambda: cache.get(cache.get_key(file_name)), repeats)
+    print('Mesh file of {:.1f} MB'.format(os.path.getsize(file_name) / 1e6))
+    print('SHA256 of the mesh file     : {:.4f} s'.format(time_hash))
+    print('Cache hit in a new process  : {:.4f} s'.format(time_new))
+    print('Cache hit                   : {:.4f} s'.format(time_hit))
+
+
+# Reading the heatmap maxima and view transformations of a scan from one text file per view and from a view artifact
+def benchmark_view_artifacts(config, repeats, work_dir):
+    heatmap_maxima, transform_stack = random_heatmap_maxima_and_transformations(config)
+    n_landmarks, n_views = heatmap_maxima.shape[0:2]
+    text_dir = work_dir / 'benchmark_view_text'
+    text_dir.mkdir(parents=True, exist_ok=True)
+    for idx in range(n_views):
+        with open(text_dir / ('hm_maxima' + str(idx) + '.txt'), 'w') as f:
+            for px, py, value in heatmap_maxima[:, idx]:
+                f.write(str(px) + ' ' + str(py) + ' ' + str(value) + '\n')
+        np.savetxt(text_dir / ('transform' + str(idx) + '.txt'), transform_stack[idx])
+
+    u3d = Utils3D(config)
+    u3d.heatmap_maxima = heatmap_maxima
+    u3d.transformations_3d = transform_stack
+    u3d.compute_lines_from_heatmap_maxima()
+    artifact_name = str(work_dir / 'benchmark_views.bin')
+    u3d.write_view_artifact(artifact_name, include_lines=True)
+
+    def read(dir_name):
+        u3d_read = Utils3D(config)
+        u3d_read.read_heatmap_maxima(dir_name)
+        u3d_read.read_3d_transformations(dir_name)
+        return u3d_read
+
+    time_text = time_function(lambda: read(str(text_dir)), repeats)
+    time_artifact = time_function(lambda: read(artifact_name), repeats)
+    time_lines = time_function(lambda: Utils3D(config).read_view_artifact(artifact_name), repeats)
+    u3d_text = read(str(text_dir))
+    u3d_artifact = read(artifact_name)
+    print('Heatmap maxima and transformations of', n_views, 'views with', n_landmarks, 'landmarks')
+    print('Text files per view                   : {:.4f} s'.format(time_text))
+    print('View artifact                         : {:.4f} s'.format(time_artifact))
+    print('View artifact with view lines         : {:.4f} s'.format(time_lines))
+    print('Max difference text {:.2e} artifact {:.2e}'.format(
+        np.max(np.abs(u3d_text.heatmap_maxima - heatmap_maxima)),
+        np.max(np.abs(u3d_artifact.heatmap_maxima - heatmap_maxima))))
+
+
+benchmarks = {
+    'heatmap_maxima': benchmark_heatmap_maxima,
+    'view_lines': benchmark_view_lines,
+    'ransac': benchmark_ransac,
+    'inference_model': benchmark_inference_model,
+    'quantization': benchmark_quantization,
+    'onnxruntime': benchmark_onnxruntime,
+    'startup': benchmark_startup,
+    'imports': benchmark_imports,
+    'adaptive_views': benchmark_adaptive_views,
+    'view_sets': benchmark_view_sets,
+    'software_rendering': benchmark_software_rendering,
+    'parallel_rendering': benchmark_parallel_rendering,
+    'readback': benchmark_readback,
+    'surface_projection': benchmark_surface_projection,
+    'result_cache': benchmark_result_cache,
+    'view_artifacts': benchmark_view_artifacts
+}
+
+
+# The benchmarks write their files (meshes, models, caches) to a temporary directory that is removed afterwards
+def main(config, names, repeats):
+    if names is None:
+        names = list(benchmarks.keys())
+    # Renderings are not written to the temp dir of the config while timing
+    config['process_3d']['write_renderings'] = False
+    with tempfile.TemporaryDirectory(prefix='deepmvlm_benchmark_') as work_dir:
+        for name in names:
+            print('=== Benchmark', name, '===')
+            benchmarks[name](config, repeats, Path(work_dir))
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Deep-MVLM benchmarks')
+    args.add_argument('-c', '--config', default=None, type=str,
+                      help='config file path (default: None)')
+    args.add_argument('-b', '--benchmark', default=None, type=str, nargs='+', choices=list(benchmarks.keys()),
+                      help='benchmarks to run (default: all)')
+    args.add_argument('--repeats', default=5, type=int,
+                      help='number of times each timed function is run (default: 5)')
+
+    cli_args = args.parse_args()
+    global_config = ConfigParser(args)
+    main(global_config, cli_args.benchmark, cli_args.repeats)
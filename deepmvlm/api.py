@@ -1,10 +1,24 @@
-import torch
-import model.model as module_arch
 from utils3d import Utils3D
 from utils3d import Render3D
+from utils3d import ParallelRender3D
+from utils3d import Mesh3D
 from prediction import Predict2D
-from torch.utils.model_zoo import load_url
-# import os
+from prediction import TorchBackend
+from prediction import OnnxRuntimeBackend
+from deepmvlm.model_store import ModelStore
+from deepmvlm.result_cache import ResultCache
+import numpy as np
+import os
+import time
+
+# process_3d keys that change how the scans are processed, but not the predicted landmarks
+# (the renderer is not one of them, as the numpy renderer gives slightly different images than VTK)
+PROCESSING_ONLY_KEYS = ['write_renderings', 'off_screen_rendering', 'pipeline_workers', 'pipeline_queue_size',
+                        'render_workers', 'surface_index_dir', 'landmark_store', 'write_landmark_files', 'manifest',
+                        'result_cache', 'result_cache_size_mb', 'write_view_artifacts', 'view_artifact_lines']
+
+# torch and the network are imported when a PyTorch model is loaded, so predicting with the onnxruntime
+# backend does not need torch
 
 models_urls = {
     'MVLMModel_DTU3D-RGB':
@@ -59,9 +73,19 @@ class DeepMVLM:
         self.config = config
         # self.device, self.model = self._get_device_and_load_model()
         self.logger = config.get_logger('predict')
-        self.device, self.model = self._get_device_and_load_model_from_url()
+        self.backend = None
+        self.parallel_render_3d = None
+        self.result_cache = None
+        self.result_cache_refused = False
+        if self.config.get('inference', {}).get('backend', 'torch') == 'onnxruntime':
+            self.device, self.model = None, None
+            self.backend = self._get_onnxruntime_backend()
+        else:
+            self.device, self.model = self._get_device_and_load_model_from_url()
 
     def _prepare_device(self, n_gpu_use):
+        import torch
+
         n_gpu = torch.cuda.device_count()
         if n_gpu_use > 0 and n_gpu == 0:
             self.logger.warning("Warning: There\'s no GPU available on this machine,"
@@ -79,50 +103,171 @@ class DeepMVLM:
         list_ids = list(range(n_gpu_use))
         return device, list_ids
 
-    def _get_device_and_load_model_from_url(self):
-        logger = self.config.get_logger('test')
-
-        print('Initialising model')
-        model = self.config.initialize('arch', module_arch)
-
-        print('Loading checkpoint')
-        model_dir = self.config['trainer']['save_dir'] + "/trained/"
+    def _get_check_point_name(self):
         model_name = self.config['name']
         image_channels = self.config['data_loader']['args']['image_channels']
         name_channels = model_name + '-' + image_channels
-        check_point_name = models_urls[name_channels]
+        return models_urls[name_channels]
+
+    # File name without extension used for files derived from the downloaded checkpoint, like the
+    # int8 quantized model and the exported ONNX graph
+    def get_derived_model_name(self):
+        model_dir = self.get_model_store().model_dir
+        base_name = os.path.basename(os.path.splitext(self._get_check_point_name())[0])
+        if self.config.get('inference', {}).get('half_resolution_heatmaps', False):
+            base_name += '_half'
+        return os.path.join(model_dir, base_name)
+
+    def _get_onnxruntime_backend(self):
+        inference = self.config['inference']
+        model_file = inference.get('onnx_model', None)
+        if model_file is None:
+            model_file = self.get_derived_model_name() + '.onnx'
+        print('Loading ONNX model', model_file)
+        return OnnxRuntimeBackend(model_file, inference.get('intra_op_num_threads', 0),
+                                  inference.get('inter_op_num_threads', 0))
+
+    # The settings that change the predicted landmarks as a dict that can be written as JSON: the pre-alignment, the
+    # process_3d section without PROCESSING_ONLY_KEYS (which only change how the scans are processed) and the image
+    # and heatmap sizes. The view set is always included, since its default has changed
+    def get_config_identity(self):
+        process_3d = {key: value for key, value in self.config['process_3d'].items()
+                      if key not in PROCESSING_ONLY_KEYS}
+        process_3d['view_set'] = self.config['process_3d'].get('view_set', 'halton')
+        process_3d['ransac_seed'] = self.config['process_3d'].get('ransac_seed', 0)
+        pre_align = {key: value for key, value in self.config['pre-align'].items() if key != 'write_pre_aligned'}
+        args = self.config['data_loader']['args']
+        return {'process_3d': process_3d,
+                'pre-align': pre_align,
+                'data_loader': {key: args[key] for key in ['image_size', 'image_channels', 'n_views', 'heatmap_size']
+                                if key in args},
+                'n_landmarks': self.config['arch']['args']['n_landmarks']}
+
+    # The model as a dict that can be written as JSON: the checkpoint (whose file name ends with its hash) and the
+    # inference settings that change the model output. With the onnxruntime backend also the ONNX file with its size
+    # and modification time
+    def get_model_identity(self):
+        inference = self.config.get('inference', {})
+        identity = {'checkpoint': os.path.basename(self._get_check_point_name()),
+                    'backend': inference.get('backend', 'torch'),
+                    'quantize': inference.get('quantize', None),
+                    'half_resolution_heatmaps': inference.get('half_resolution_heatmaps', False)}
+        if identity['backend'] == 'onnxruntime':
+            model_file = inference.get('onnx_model', None)
+            if model_file is None:
+                model_file = self.get_derived_model_name() + '.onnx'
+            stat = os.stat(model_file)
+            identity['onnx_model'] = [os.path.abspath(model_file), stat.st_size, stat.st_mtime_ns]
+        return identity
+
+    def get_model_store(self):
+        inference = self.config.get('inference', {})
+        model_dir = inference.get('model_dir', self.config['trainer']['save_dir'] + "/trained/")
+        return ModelStore(model_dir, models_urls, inference.get('offline', False))
 
-        print('Getting device')
-        device, device_ids = self._prepare_device(self.config['n_gpu'])
+    def _get_device_and_load_model_from_url(self):
+        import torch
+        import model.model as module_arch
+        from deepmvlm.model_store import create_model_from_state_dict
 
-        logger.info('Loading checkpoint: {}'.format(check_point_name))
+        logger = self.config.get_logger('test')
 
-        checkpoint = load_url(check_point_name, model_dir, map_location=device)
+        print('Getting device')
+        device, device_ids = self._prepare_device(self.config['n_gpu'])
 
-        # Write clean model - should only be done once for translation of models
-        # base_name = os.path.basename(os.path.splitext(check_point_name)[0])
-        # clean_file = 'saved/trained/' + base_name + '_only_state_dict.pth'
-        # torch.save(checkpoint['state_dict'], clean_file)
+        print('Loading checkpoint')
+        name_channels = self.config['name'] + '-' + self.config['data_loader']['args']['image_channels']
+        logger.info('Loading checkpoint: {}'.format(self._get_check_point_name()))
+        trusted = self.config.get('inference', {}).get('trusted_checkpoint', False)
+        state_dict = self.get_model_store().load_state_dict(name_channels, trusted)
 
-        state_dict = []
-        # Hack until all dicts are transformed
-        if check_point_name.find('only_state_dict') == -1:
-            state_dict = checkpoint['state_dict']
-        else:
-            state_dict = checkpoint
+        # The parameters are taken from the (memory-mapped) checkpoint instead of being randomly initialised
+        print('Initialising model')
+        model = create_model_from_state_dict(self.config, module_arch, state_dict)
 
         if len(device_ids) > 1:
             model = torch.nn.DataParallel(model, device_ids=device_ids)
 
-        model.load_state_dict(state_dict)
+        half_resolution = self.config.get('inference', {}).get('half_resolution_heatmaps', False)
+        if self.config.get('inference', {}).get('fuse_model', True) or half_resolution:
+            print('Building inference model')
+            model = self._get_inference_model(model, device_ids, half_resolution)
 
+        if self.config.get('inference', {}).get('quantize', None) == 'int8':
+            if device.type != 'cpu':
+                logger.warning('Warning: int8 quantized models only run on CPU - prediction will be performed on CPU')
+                device = torch.device('cpu')
+            quantized_name = self.get_derived_model_name() + '_int8.pth'
+            model = self._get_quantized_model(model, quantized_name, half_resolution)
 
         model = model.to(device)
         model.eval()
         return device, model
 
+    @staticmethod
+    def _get_inference_model(model, device_ids, half_resolution=False):
+        import torch
+        import model.model as module_arch
+
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        # The model was just loaded, so it is changed in place instead of keeping a copy of the mapped weights
+        model = module_arch.MVLMInferenceModel(model, half_resolution, in_place=True)
+        if len(device_ids) > 1:
+            model = torch.nn.DataParallel(model, device_ids=device_ids)
+        return model
+
+    # Post-training int8 quantization of the inference model. The quantized model is cached next to the
+    # downloaded checkpoint, so the calibration is only done the first time
+    def _get_quantized_model(self, model, quantized_name, half_resolution=False):
+        import torch
+        import model.model as module_arch
+        import model.quantization as quantization
+
+        logger = self.config.get_logger('test')
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        if not isinstance(model, module_arch.MVLMInferenceModel):
+            model = module_arch.MVLMInferenceModel(model, half_resolution, in_place=True)
+        model = model.cpu().eval()
+
+        image_size = self.config['data_loader']['args']['image_size']
+        example_input = torch.zeros(1, model.in_channels, image_size, image_size)
+        if os.path.isfile(quantized_name):
+            print('Loading int8 quantized model', quantized_name)
+            return quantization.load_quantized_model_int8(model, quantized_name, example_input)
+
+        calibration_files = self.config['inference'].get('calibration_files', [])
+        if not calibration_files:
+            logger.warning('Warning: No calibration_files given in the inference section of the config - '
+                           'using the float model')
+            return model
+
+        print('Calibrating int8 quantization on', len(calibration_files), 'files')
+        quantized = quantization.quantize_model_int8(model, self._calibration_batches(calibration_files))
+        torch.save(quantized.state_dict(), quantized_name)
+        print('Int8 quantized model written to', quantized_name)
+        return quantized
+
+    # Batches of rendered views of the calibration files in the format used by Predict2D
+    def _calibration_batches(self, calibration_files):
+        n_views = self.config['inference'].get('calibration_views', 16)
+        batch_size = self.config['data_loader']['args']['batch_size']
+        render_3d = Render3D(self.config)
+        for file_name in calibration_files:
+            image_stack, _ = render_3d.render_3d_file(Mesh3D(self.config, file_name))
+            if image_stack is None:
+                continue
+            image_stack = image_stack[:n_views]
+            for cur_id in range(0, image_stack.shape[0], batch_size):
+                images = image_stack[cur_id:cur_id + batch_size]
+                yield TorchBackend.images_to_tensor(images)
+
     # Deprecated - should not be used
     def _get_device_and_load_model(self):
+        import torch
+        import model.model as module_arch
+
         logger = self.config.get_logger('test')
 
         print('Initialising model')
@@ -170,12 +315,107 @@ class DeepMVLM:
         model.eval()
         return device, model
 
-    def predict_one_file(self, file_name):
-        render_3d = Render3D(self.config)
-        image_stack, transform_stack = render_3d.render_3d_file(file_name)
+    # Writes the network as an ONNX graph with a dynamic batch dimension for the onnxruntime backend
+    def export_onnx(self, file_name=None, opset_version=17):
+        import torch
+        import model.model as module_arch
+
+        if file_name is None:
+            file_name = self.get_derived_model_name() + '.onnx'
+        model = self.model
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        if isinstance(model, module_arch.MVLMModel):
+            half_resolution = self.config.get('inference', {}).get('half_resolution_heatmaps', False)
+            model = module_arch.MVLMInferenceModel(model, half_resolution)
+        elif not isinstance(model, module_arch.MVLMInferenceModel):
+            raise ValueError('Only the float model can be exported to ONNX - disable quantize in the config')
+        model = model.cpu().eval()
+        image_size = self.config['data_loader']['args']['image_size']
+        example_input = torch.zeros(1, model.in_channels, image_size, image_size)
+        torch.onnx.export(model, (example_input,), file_name, input_names=['images'], output_names=['heatmaps'],
+                          dynamic_axes={'images': {0: 'batch'}, 'heatmaps': {0: 'batch'}},
+                          opset_version=opset_version, dynamo=False)
+        model.to(self.device)
+        return file_name
+
+    # With process_3d.render_workers > 0 the views are rendered by a pool of worker processes, that is started
+    # the first time it is needed and reused for the following scans
+    def get_renderer(self):
+        if self.config['process_3d'].get('render_workers', 0) < 1:
+            return Render3D(self.config)
+        if self.parallel_render_3d is None:
+            self.parallel_render_3d = ParallelRender3D(self.config)
+        return self.parallel_render_3d
+
+    # With process_3d.result_cache the results are saved in and read from a ResultCache in that directory
+    # The result cache, or None when it is not configured or when the landmarks are not reproducible: a random view
+    # set or an unseeded RANSAC gives other landmarks for the same scan and settings, so a hit would return the
+    # landmarks of the first prediction forever
+    def get_result_cache(self):
+        process_3d = self.config['process_3d']
+        cache_dir = process_3d.get('result_cache')
+        if cache_dir is not None and (process_3d.get('view_set', 'halton') == 'random'
+                                      or process_3d.get('ransac_seed', 0) is None):
+            if not self.result_cache_refused:
+                self.logger.warning('Warning: result_cache is not used with a random view set or a null ransac_seed')
+                self.result_cache_refused = True
+            return None
+        if self.result_cache is None and cache_dir is not None:
+            self.result_cache = ResultCache(cache_dir, self.get_config_identity(), self.get_model_identity(),
+                                            self.config['process_3d'].get('result_cache_size_mb', 1024))
+        return self.result_cache
 
-        predict_2d = Predict2D(self.config, self.model, self.device)
-        heatmap_maxima = predict_2d.predict_heatmaps_from_images(image_stack)
+    def predict_heatmap_maxima(self, image_stack):
+        predict_2d = Predict2D(self.config, self.model, self.device, self.backend)
+        return predict_2d.predict_heatmaps_from_images(image_stack)
+
+    def predict_one_file(self, file_name):
+        u3d, _ = self.predict_one_file_with_details(file_name)
+        return None if u3d is None else u3d.landmarks
+
+    # Returns the Utils3D with the landmarks (in the space of the scan), their RANSAC errors and inlier counts and
+    # the transformations of the used views, and a dict with the time in seconds spent on loading, rendering,
+    # prediction, reconstruction and in total. The Utils3D is None when the scan could not be rendered.
+    # A result found in the result cache only has the total time
+    def predict_one_file_with_details(self, file_name):
+        cache = self.get_result_cache()
+        if cache is None:
+            return self._predict_one_file_with_details(file_name)
+
+        start = time.time()
+        key = cache.get_key(file_name)
+        result = cache.get(key)
+        if result is not None:
+            u3d = Utils3D(self.config)
+            for name, value in result.items():
+                setattr(u3d, name, value)
+            return u3d, {'total': time.time() - start}
+
+        u3d, timing = self._predict_one_file_with_details(file_name)
+        if u3d is not None:
+            cache.put(key, {name: getattr(u3d, name) for name in ResultCache.fields})
+        return u3d, timing
+
+    def _predict_one_file_with_details(self, file_name):
+        start = time.time()
+        # The mesh is read once and shared by rendering and surface projection
+        mesh = Mesh3D(self.config, file_name)
+        timing = {'load': time.time() - start}
+        if self.config['process_3d'].get('adaptive_views', False):
+            u3d = self.predict_one_file_adaptive(mesh, timing)
+            timing['total'] = time.time() - start
+            self.write_view_artifact(file_name, u3d)
+            return u3d, timing
+
+        render_3d = self.get_renderer()
+        image_stack, transform_stack = render_3d.render_3d_file(mesh)
+        timing['render'] = time.time() - start - timing['load']
+        if image_stack is None:
+            return None, timing
+
+        heatmap_maxima = self.predict_heatmap_maxima(image_stack)
+        timing['predict'] = time.time() - start - timing['load'] - timing['render']
 
         u3d = Utils3D(self.config)
         u3d.heatmap_maxima = heatmap_maxima
@@ -183,9 +423,91 @@ class DeepMVLM:
         u3d.compute_lines_from_heatmap_maxima()
         #  u3d.visualise_one_landmark_lines(65)
         u3d.compute_all_landmarks_from_view_lines()
-        u3d.project_landmarks_to_surface(file_name)
-
-        return u3d.landmarks
+        u3d.project_landmarks_to_surface(mesh)
+        timing['total'] = time.time() - start
+        timing['reconstruct'] = timing['total'] - timing['load'] - timing['render'] - timing['predict']
+        self.write_view_artifact(file_name, u3d)
+
+        return u3d, timing
+
+    # Renders and predicts the views in increments of view_increment views, starting with min_views views.
+    # After each increment the landmarks are estimated from all views so far, and no more views are rendered
+    # when the estimates are stable (see Utils3D.landmark_estimates_converged) or max_views is reached
+    # Returns the Utils3D with the landmarks. The time spent on each step is added to timing when it is given
+    def predict_one_file_adaptive(self, mesh, timing=None):
+        if timing is None:
+            timing = {}
+        for name in ['render', 'predict', 'reconstruct']:
+            timing[name] = 0
+        process_3d = self.config['process_3d']
+        max_views = process_3d.get('max_views', self.config['data_loader']['args']['n_views'])
+        min_views = min(process_3d.get('min_views', 24), max_views)
+        view_increment = process_3d.get('view_increment', 8)
+        landmark_tolerance = process_3d.get('landmark_tolerance', 1.0)
+        inlier_tolerance = process_3d.get('inlier_tolerance', 0.05)
+
+        render_3d = self.get_renderer()
+        transform_stack = render_3d.generate_3d_transformations(max_views)
+        heatmap_maxima = []
+        u3d = Utils3D(self.config)
+        previous = None
+        n_views = 0
+        while n_views < max_views:
+            n_next = min(max(n_views + view_increment, min_views), max_views)
+            start = time.time()
+            image_stack, _ = render_3d.render_3d_file(mesh, transform_stack[n_views:n_next])
+            timing['render'] += time.time() - start
+            if image_stack is None:
+                return None
+            start = time.time()
+            heatmap_maxima.append(self.predict_heatmap_maxima(image_stack))
+            timing['predict'] += time.time() - start
+            n_views = n_next
+
+            start = time.time()
+            u3d.heatmap_maxima = np.concatenate(heatmap_maxima, axis=1)
+            u3d.transformations_3d = transform_stack[:n_views]
+            u3d.compute_lines_from_heatmap_maxima()
+            u3d.compute_all_landmarks_from_view_lines()
+            u3d.refine_landmarks_on_consensus()
+            current = (u3d.landmarks.copy(), u3d.landmark_inliers.copy(), n_views)
+            timing['reconstruct'] += time.time() - start
+            if previous is not None and Utils3D.landmark_estimates_converged(
+                    previous, current, landmark_tolerance, inlier_tolerance):
+                break
+            previous = current
+
+        print('Landmarks estimated from', n_views, 'of', max_views, 'views')
+        start = time.time()
+        u3d.project_landmarks_to_surface(mesh)
+        timing['reconstruct'] += time.time() - start
+        return u3d
+
+    # With process_3d.write_view_artifacts the heatmap maxima and view transformations of the scan are written to a
+    # ViewArtifact next to it (see Utils3D.get_view_artifact_name), with the view lines when
+    # process_3d.view_artifact_lines is true
+    def write_view_artifact(self, file_name, u3d):
+        process_3d = self.config['process_3d']
+        if u3d is None or not process_3d.get('write_view_artifacts', False):
+            return
+        u3d.write_view_artifact(Utils3D.get_view_artifact_name(file_name), process_3d.get('view_artifact_lines', False),
+                                {'file_name': os.path.abspath(file_name)})
+
+    # Computes the landmarks of a scan again from its view artifact without rendering and inference, for instance
+    # with other RANSAC settings. The view lines are computed from the heatmap maxima when they were not written.
+    # Returns the Utils3D with the landmarks
+    def reconstruct_from_view_artifact(self, file_name, artifact_name=None):
+        if artifact_name is None:
+            artifact_name = Utils3D.get_view_artifact_name(file_name)
+        u3d = Utils3D(self.config)
+        u3d.read_view_artifact(artifact_name)
+        if u3d.lm_start is None or u3d.lm_end is None:
+            u3d.compute_lines_from_heatmap_maxima()
+        u3d.compute_all_landmarks_from_view_lines()
+        if self.config['process_3d'].get('adaptive_views', False):
+            u3d.refine_landmarks_on_consensus()
+        u3d.project_landmarks_to_surface(Mesh3D(self.config, file_name, for_rendering=False))
+        return u3d
 
     @staticmethod
     def write_landmarks_as_vtk_points(landmarks, file_name):
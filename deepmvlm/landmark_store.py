@@ -0,0 +1,132 @@
+import os
+import struct
+
+import numpy as np
+
+# The timing fields of a record in seconds
+TIMING_FIELDS = ['time_load', 'time_render', 'time_predict', 'time_reconstruct', 'time_total']
+
+
+def landmark_store_dtype(n_landmarks, path_length=512):
+    fields = [('path', 'S{}'.format(path_length)),
+              ('landmarks', '<f8', (n_landmarks, 3)),
+              ('errors', '<f8', (n_landmarks,)),
+              ('inliers', '<i4', (n_landmarks,)),
+              ('n_views', '<i4')]
+    fields += [(name, '<f4') for name in TIMING_FIELDS]
+    return np.dtype(fields)
+
+
+class LandmarkStore:
+    """
+    The landmarks of many scans in one binary file with one fixed size record per scan.
+
+    A record holds the scan path (UTF-8, at most path_length bytes), the landmarks in the space of the scan, the
+    RANSAC error and number of inliers of each landmark, the number of views and the time spent on the scan.
+    The file is a .npy file with a structured array, so it can be read without parsing text by
+        store = LandmarkStore.read(file_name)   # or np.load(file_name, mmap_mode='r')
+        landmarks = store['landmarks']          # (n_scans, n_landmarks, 3)
+        paths = [p.decode() for p in store['path']]
+    Records are appended one at a time. The number of records in the header is updated after each record is
+    written, so the file is always a valid array of the scans written so far. An existing store with the same
+    record layout is appended to. put replaces the record of a scan that is already in the store instead, so a scan
+    that is processed again (after a change, or after a run stopped before its status was saved) has one record.
+    """
+    magic = b'\x93NUMPY\x02\x00'
+    # The header is padded to a fixed size, so the number of records can be updated in place
+    header_size = 1024
+
+    def __init__(self, file_name, n_landmarks, path_length=512):
+        self.file_name = file_name
+        self.dtype = landmark_store_dtype(n_landmarks, path_length)
+        self.n_landmarks = n_landmarks
+        self.path_length = path_length
+
+        if os.path.isfile(file_name) and os.path.getsize(file_name) > 0:
+            existing = np.load(file_name, mmap_mode='r')
+            if existing.dtype != self.dtype:
+                raise ValueError('The landmark store {} has another record layout ({} landmarks, paths of {} bytes '
+                                 'expected)'.format(file_name, n_landmarks, path_length))
+            self.n_records = existing.shape[0]
+            # The index of the last record of each path
+            self.indices = {path.decode('utf-8'): index for index, path in enumerate(existing['path'])}
+            del existing
+            self.f = open(file_name, 'r+b')
+            # Bytes after the last complete record (from an interrupted write) are overwritten
+            self.f.truncate(self.header_size + self.n_records * self.dtype.itemsize)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+            self.n_records = 0
+            self.indices = {}
+            self.f = open(file_name, 'w+b')
+            self.write_header()
+
+    def write_header(self):
+        header = "{{'descr': {}, 'fortran_order': False, 'shape': ({},), }}".format(
+            repr(np.lib.format.dtype_to_descr(self.dtype)), self.n_records)
+        padding = self.header_size - len(self.magic) - 4 - len(header) - 1
+        if padding < 0:
+            raise ValueError('The record layout does not fit in the header of the landmark store')
+        self.f.seek(0)
+        self.f.write(self.magic + struct.pack('<I', self.header_size - len(self.magic) - 4))
+        self.f.write(header.encode('latin1') + b' ' * padding + b'\n')
+
+    # landmarks: (n_landmarks, 3). errors and inliers: (n_landmarks) or None. timing: dict with some of the
+    # TIMING_FIELDS (without the time_ prefix) as keys
+    def make_record(self, path, landmarks, errors=None, inliers=None, n_views=0, timing=None):
+        encoded_path = os.fspath(path).encode('utf-8')
+        if len(encoded_path) > self.path_length:
+            raise ValueError('The path {} is longer than the {} bytes of the landmark store'.format(
+                path, self.path_length))
+
+        record = np.zeros(1, dtype=self.dtype)
+        record['path'] = encoded_path
+        record['landmarks'] = landmarks
+        if errors is not None:
+            record['errors'] = errors
+        if inliers is not None:
+            record['inliers'] = inliers
+        record['n_views'] = n_views
+        for name, value in (timing or {}).items():
+            record['time_' + name] = value
+        return record
+
+    def write_record(self, index, record):
+        self.f.seek(self.header_size + index * self.dtype.itemsize)
+        self.f.write(record.tobytes())
+        self.f.flush()
+
+    # Appends a record (arguments as make_record) and returns its index
+    def append(self, path, landmarks, errors=None, inliers=None, n_views=0, timing=None):
+        record = self.make_record(path, landmarks, errors, inliers, n_views, timing)
+        index = self.n_records
+        self.write_record(index, record)
+        self.n_records += 1
+        self.write_header()
+        self.f.flush()
+        self.indices[os.fspath(path)] = index
+        return index
+
+    # As append, but the record of a path that is already in the store is replaced. Returns the index of the record
+    def put(self, path, landmarks, errors=None, inliers=None, n_views=0, timing=None):
+        index = self.indices.get(os.fspath(path))
+        if index is None:
+            return self.append(path, landmarks, errors, inliers, n_views, timing)
+        self.write_record(index, self.make_record(path, landmarks, errors, inliers, n_views, timing))
+        return index
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # The records as a read-only memory-mapped structured array
+    @staticmethod
+    def read(file_name):
+        return np.load(file_name, mmap_mode='r')
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+from deepmvlm.landmark_store import LandmarkStore
+from utils import file_sha256
+from utils3d import Utils3D
+
+
+class RunManifest:
+    """
+    Status of each scan of a (repeated) run over many scans, so a run can be resumed and a rerun only processes
+    new or changed scans and scans that failed.
+
+    The manifest is a text file with one JSON record per line, appended (and flushed) after each scan. The last
+    record of a scan wins, so a crash loses at most the scan being processed. A record holds the status
+    ('done' or 'failed'), the size, modification time and SHA256 of the input files (the mesh, its texture and
+    material file), the identity of the config and the model and the output files.
+    A scan is up to date when it was done with the same config and model identity, its outputs exist and its input
+    files have the same size and modification time. When only the modification time has changed (a copy or a
+    touch), the content hash decides and the record is updated. When the landmarks were written to a LandmarkStore,
+    the record holds the index of the scan in the store, and the scan is only up to date when that record of the
+    store is still the record of the scan.
+    The input files are hashed before a scan is processed (get_input_stamps) and the stamps are given to mark_done.
+    """
+    # When the file has this many more lines than scans, it is rewritten with one line per scan
+    compact_factor = 4
+
+    def __init__(self, file_name, config_identity, model_identity):
+        self.file_name = file_name
+        self.config_identity = config_identity
+        self.model_identity = model_identity
+        self.records = {}
+        # The landmark stores read while filtering
+        self.stores = {}
+        n_lines = 0
+        if os.path.isfile(file_name):
+            with open(file_name) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut off when a run was stopped
+                        continue
+                    self.records[record['path']] = record
+                    n_lines += 1
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+
+        if n_lines > self.compact_factor * max(1, len(self.records)):
+            self.compact()
+        self.f = open(file_name, 'a')
+
+    # Rewrites the file with the last record of each scan. The new file replaces the old in one step
+    def compact(self):
+        temp_name = '{}.{}.tmp'.format(self.file_name, os.getpid())
+        with open(temp_name, 'w') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(temp_name, self.file_name)
+
+    @staticmethod
+    def get_file_stamps(file_name):
+        stamps = []
+        for name in Utils3D.get_input_file_names(file_name):
+            stat = os.stat(name)
+            stamps.append({'name': os.path.abspath(name), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+        return stamps
+
+    # The stamps of the input files with their SHA256
+    @staticmethod
+    def get_input_stamps(file_name):
+        stamps = RunManifest.get_file_stamps(file_name)
+        for stamp in stamps:
+            stamp['sha256'] = file_sha256(stamp['name'])
+        return stamps
+
+    # Whether the record at the index in the landmark store is the record of path. The store may have been deleted
+    # or replaced since
+    def in_store(self, path, store):
+        records = self.stores.get(store['name'])
+        if records is None:
+            try:
+                records = LandmarkStore.read(store['name'])
+            except (OSError, ValueError):
+                records = []
+            self.stores[store['name']] = records
+        index = store['index']
+        return index < len(records) and os.path.abspath(records[index]['path'].decode('utf-8')) == path
+
+    def needs_processing(self, file_name):
+        record = self.records.get(os.path.abspath(file_name))
+        if record is None or record['status'] != 'done':
+            return True
+        if record['config'] != self.config_identity or record['model'] != self.model_identity:
+            return True
+        if not all(os.path.exists(name) for name in record['outputs']):
+            return True
+        if 'store' in record and not self.in_store(record['path'], record['store']):
+            return True
+
+        stamps = self.get_file_stamps(file_name)
+        if [stamp['name'] for stamp in stamps] != [stamp['name'] for stamp in record['inputs']]:
+            return True
+        touched = False
+        for stamp, old_stamp in zip(stamps, record['inputs']):
+            if stamp['size'] != old_stamp['size']:
+                return True
+            if stamp['mtime_ns'] != old_stamp['mtime_ns']:
+                if file_sha256(stamp['name']) != old_stamp['sha256']:
+                    return True
+                touched = True
+        if touched:
+            self.write_record(dict(record, inputs=[dict(stamp, sha256=old_stamp['sha256'])
+                                                   for stamp, old_stamp in zip(stamps, record['inputs'])]))
+        return False
+
+    # The file names that are not up to date
+    def filter(self, file_names):
+        names = [file_name for file_name in file_names if self.needs_processing(file_name)]
+        self.stores = {}
+        return names
+
+    def write_record(self, record):
+        self.records[record['path']] = record
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    # outputs: the files written for the scan. timing: dict with the time spent on the scan. inputs: the
+    # get_input_stamps taken before the scan was processed (taken now when None). store: (file name, index) of the
+    # record of the scan in a LandmarkStore
+    def mark_done(self, file_name, outputs, timing=None, inputs=None, store=None):
+        if inputs is None:
+            inputs = self.get_input_stamps(file_name)
+        record = {'path': os.path.abspath(file_name), 'status': 'done', 'inputs': inputs,
+                  'config': self.config_identity, 'model': self.model_identity,
+                  'outputs': [os.path.abspath(name) for name in outputs], 'timing': timing or {}, 'time': time.time()}
+        if store is not None:
+            record['store'] = {'name': os.path.abspath(store[0]), 'index': store[1]}
+        self.write_record(record)
+
+    def mark_failed(self, file_name, error):
+        self.write_record({'path': os.path.abspath(file_name), 'status': 'failed', 'error': str(error),
+                           'config': self.config_identity, 'model': self.model_identity, 'time': time.time()})
+
+    # The number of scans with the given status
+    def count(self, status='done'):
+        return sum(1 for record in self.records.values() if record['status'] == status)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
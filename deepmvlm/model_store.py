@@ -0,0 +1,126 @@
+import json
+import os
+import pickle
+import re
+import warnings
+
+from utils import file_sha256
+
+# The checkpoint file names end with the first digits of their SHA256 hash (as torch.hub)
+HASH_REGEX = re.compile(r'-([a-f0-9]+)\.pth$')
+
+
+class ModelStore:
+    """
+    Local store of the trained models, keyed by the names in models_urls ('MVLMModel_DTU3D-RGB' etc.).
+
+    The checkpoints are kept in model_dir with the file names of their URLs. Missing checkpoints are downloaded
+    unless offline is True, in which case model_dir must be pre-populated (by copying the files or by running
+    once with network access). The SHA256 hash of a checkpoint is checked against the hash prefix of its file
+    name. The result is written to a small .sha256 file next to the checkpoint, so the hash is only computed
+    again when the size or modification time of the checkpoint changes.
+    """
+    def __init__(self, model_dir, urls, offline=False):
+        self.model_dir = model_dir
+        self.urls = urls
+        self.offline = offline
+
+    def get_file_name(self, name):
+        if name not in self.urls:
+            raise KeyError('No trained model named {} - available models: {}'.format(name, ', '.join(self.urls)))
+        return os.path.join(self.model_dir, os.path.basename(self.urls[name]))
+
+    def get_checkpoint(self, name):
+        file_name = self.get_file_name(name)
+        hash_prefix = self.get_hash_prefix(file_name)
+        if not os.path.isfile(file_name):
+            if self.offline:
+                raise FileNotFoundError('Model {} not found in the model store {} (offline)'.format(
+                    name, self.model_dir))
+            from torch.hub import download_url_to_file
+
+            os.makedirs(self.model_dir, exist_ok=True)
+            print('Downloading', self.urls[name], 'to', file_name)
+            download_url_to_file(self.urls[name], file_name, hash_prefix)
+            self._write_verified(file_name, self.compute_sha256(file_name))
+        elif not self._is_verified(file_name):
+            sha256 = self.compute_sha256(file_name)
+            if hash_prefix is not None and not sha256.startswith(hash_prefix):
+                raise RuntimeError('Checksum of {} does not match - expected a SHA256 starting with {} got {}. '
+                                   'Delete the file to download it again'.format(file_name, hash_prefix, sha256))
+            self._write_verified(file_name, sha256)
+        return file_name
+
+    # Returns the state dict of the named model. The tensors are memory-mapped from the checkpoint instead of
+    # being read into new memory, when the checkpoint is in the zip format of torch.save.
+    # trusted: also load checkpoints that need the full pickle loader (which can run code from the file)
+    def load_state_dict(self, name, trusted=False):
+        file_name = self.get_checkpoint(name)
+        return load_state_dict_mmap(file_name, trusted)
+
+    @staticmethod
+    def get_hash_prefix(file_name):
+        match = HASH_REGEX.search(os.path.basename(file_name))
+        return match.group(1) if match else None
+
+    @staticmethod
+    def compute_sha256(file_name):
+        return file_sha256(file_name)
+
+    @staticmethod
+    def _file_stamp(file_name):
+        stat = os.stat(file_name)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def _is_verified(self, file_name):
+        try:
+            with open(file_name + '.sha256') as f:
+                verified = json.load(f)
+        except (OSError, ValueError):
+            return False
+        hash_prefix = self.get_hash_prefix(file_name)
+        return verified.get('stamp') == self._file_stamp(file_name) and \
+            (hash_prefix is None or verified.get('sha256', '').startswith(hash_prefix))
+
+    def _write_verified(self, file_name, sha256):
+        try:
+            with open(file_name + '.sha256', 'w') as f:
+                json.dump({'sha256': sha256, 'stamp': self._file_stamp(file_name)}, f)
+        except OSError:
+            # A read-only store is verified on every start
+            pass
+
+
+# Full training checkpoints also contain the config and the optimizer state, which can not be loaded with
+# weights_only. They are only loaded with the full pickle loader when the checkpoint is trusted
+def load_state_dict_mmap(file_name, trusted=False):
+    import torch
+
+    try:
+        checkpoint = torch.load(file_name, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError:
+        # Checkpoints written in the legacy (non zip) format can not be memory-mapped
+        checkpoint = torch.load(file_name, map_location='cpu', weights_only=True)
+    except pickle.UnpicklingError as error:
+        if not trusted:
+            raise RuntimeError('{} contains more than weights and can only be loaded with the full pickle loader, '
+                               'which can run code from the file. Set inference.trusted_checkpoint to true if the '
+                               'file is trusted'.format(file_name)) from error
+        warnings.warn('Loading {} with the full pickle loader (trusted_checkpoint)'.format(file_name))
+        checkpoint = torch.load(file_name, map_location='cpu', mmap=True, weights_only=False)
+    # Some checkpoints also contain the training state
+    if 'state_dict' in checkpoint:
+        checkpoint = checkpoint['state_dict']
+    # Checkpoints saved from torch.nn.DataParallel
+    return {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in checkpoint.items()}
+
+
+# Creates the model from the arch section of the config without allocating and randomly initialising the
+# parameters, and assigns the tensors of the state dict as parameters
+def create_model_from_state_dict(config, module, state_dict):
+    import torch
+
+    with torch.device('meta'):
+        model = config.initialize('arch', module)
+    model.load_state_dict(state_dict, assign=True)
+    return model
@@ -0,0 +1,280 @@
+import collections
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing.connection import wait
+
+from utils3d import Utils3D
+from utils3d import Render3D
+from utils3d import Mesh3D
+from deepmvlm.landmark_store import LandmarkStore
+from deepmvlm.manifest import RunManifest
+from utils import json_sha256
+
+
+def landmark_file_names(file_name):
+    name_lm_vtk = os.path.splitext(file_name)[0] + '_landmarks.vtk'
+    name_lm_txt = os.path.splitext(file_name)[0] + '_landmarks.txt'
+    return name_lm_vtk, name_lm_txt
+
+
+# Stage 1: load and render meshes. Runs in several worker processes that each receive file names on their own
+# connection and send (file_name, image_stack, transform_stack, timing, inputs, surface) back on it, until None is
+# received. With a manifest, inputs are the RunManifest.get_input_stamps taken before the scan is loaded.
+# surface is the SurfaceIndex of the scan and the matrix of the inverse pre-transformation, which are passed on to the
+# 3D reconstruction, so the scan is only read here. Sending blocks the worker when inference can not keep up
+def _render_worker(config, conn):
+    render_3d = Render3D(config)
+    with_manifest = config['process_3d'].get('manifest') is not None
+    while True:
+        file_name = conn.recv()
+        if file_name is None:
+            break
+
+        image_stack = None
+        transform_stack = None
+        timing = {}
+        inputs = None
+        surface = None
+        try:
+            if with_manifest:
+                inputs = RunManifest.get_input_stamps(file_name)
+            start = time.time()
+            mesh = Mesh3D(config, file_name)
+            timing['load'] = time.time() - start
+            image_stack, transform_stack = render_3d.render_3d_file(mesh)
+            timing['render'] = time.time() - start - timing['load']
+            if image_stack is not None:
+                start = time.time()
+                surface = (mesh.get_surface_index(), Utils3D.get_transformation_matrix(mesh.pre_transform.GetInverse()))
+                timing['reconstruct'] = time.time() - start
+        except Exception as e:
+            print('Rendering failed for', file_name, ':', e)
+        conn.send((file_name, image_stack, transform_stack, timing, inputs, surface))
+    conn.close()
+
+
+# Stage 3: compute 3D landmarks from the heatmap maxima and write them to disk, as text files per scan and/or
+# as records of the landmark store. With a manifest (file name, config and model identity) the status of each scan
+# is added to the RunManifest, and with process_3d.write_view_artifacts a view artifact is written next to the scan.
+# Scans that could not be rendered arrive without heatmap maxima
+def _reconstruction_worker(config, landmark_queue, write_text, write_vtk, store_name, manifest_args):
+    store = None
+    if store_name is not None:
+        store = LandmarkStore(store_name, config['arch']['args']['n_landmarks'])
+    manifest = None
+    if manifest_args is not None:
+        manifest = RunManifest(*manifest_args)
+    while True:
+        item = landmark_queue.get()
+        if item is None:
+            break
+
+        file_name, heatmap_maxima, transform_stack, timing, inputs, surface = item
+        if heatmap_maxima is None:
+            if manifest is not None:
+                manifest.mark_failed(file_name, 'Rendering failed')
+            continue
+        try:
+            start = time.time()
+            u3d = Utils3D(config)
+            u3d.heatmap_maxima = heatmap_maxima
+            u3d.transformations_3d = transform_stack
+            u3d.compute_lines_from_heatmap_maxima()
+            u3d.compute_all_landmarks_from_view_lines()
+            u3d.project_landmarks_to_surface_index(*surface)
+
+            # Includes the time spent on the surface index by the render worker
+            timing['reconstruct'] = timing.get('reconstruct', 0) + time.time() - start
+            # The time spent on the scan, without the time waiting in the queues
+            timing['total'] = sum(timing.values())
+
+            name_lm_vtk, name_lm_txt = landmark_file_names(file_name)
+            outputs = []
+            if write_text:
+                Utils3D.write_landmarks_as_text_external(u3d.landmarks, name_lm_txt)
+                outputs.append(name_lm_txt)
+            if write_vtk:
+                Utils3D.write_landmarks_as_vtk_points_external(u3d.landmarks, name_lm_vtk)
+                outputs.append(name_lm_vtk)
+            store_record = None
+            if store is not None:
+                store_record = (store_name, store.put(file_name, u3d.landmarks, u3d.landmark_errors,
+                                                      u3d.landmark_inliers, transform_stack.shape[0], timing))
+            if config['process_3d'].get('write_view_artifacts', False):
+                artifact_name = Utils3D.get_view_artifact_name(file_name)
+                u3d.write_view_artifact(artifact_name, config['process_3d'].get('view_artifact_lines', False),
+                                        {'file_name': os.path.abspath(file_name)})
+                outputs.append(artifact_name)
+            if manifest is not None:
+                manifest.mark_done(file_name, outputs, timing, inputs, store_record)
+        except Exception as e:
+            print('Landmark computation failed for', file_name, ':', e)
+            if manifest is not None:
+                manifest.mark_failed(file_name, e)
+    if store is not None:
+        store.close()
+    if manifest is not None:
+        manifest.close()
+
+
+class PredictionPipeline:
+    """
+    Pipelined prediction of landmarks on many meshes.
+
+    Rendering runs ahead in a pool of worker processes, the model consumes the rendered
+    view stacks as they arrive and the 3D reconstruction and writing of landmarks is done
+    in a separate process. At most queue_size scans are handed to the renderers at a time and the landmark queue is
+    bounded, so the renderers will not run further ahead of inference than the queue size allows.
+    With process_3d.landmark_store the landmarks of all scans are put in that LandmarkStore, and the text
+    files per scan are only written when process_3d.write_landmark_files is true. With process_3d.manifest the
+    status of each scan is added to that RunManifest (the scans to skip are filtered out before run is called).
+    A render worker that dies (a crash in VTK/OpenGL or the OOM killer) is dropped and the scans it was handed are
+    reported as failed, and the pipeline stops with an error when the reconstruction process dies, instead of
+    waiting forever.
+    """
+    # Seconds between the checks of the worker processes while waiting on a queue
+    poll_interval = 1.0
+
+    def __init__(self, config, dm, n_workers=None, queue_size=None, write_vtk=False):
+        self.config = config
+        self.dm = dm
+        if n_workers is None:
+            n_workers = config['process_3d'].get('pipeline_workers', 0)
+        if n_workers < 1:
+            n_workers = max(1, multiprocessing.cpu_count() - 2)
+        if queue_size is None:
+            queue_size = config['process_3d'].get('pipeline_queue_size', 2 * n_workers)
+        self.n_workers = n_workers
+        self.queue_size = max(1, queue_size)
+        self.write_vtk = write_vtk
+        self.store_name = config['process_3d'].get('landmark_store')
+        self.write_text = config['process_3d'].get('write_landmark_files', self.store_name is None)
+        self.manifest_args = None
+        if config['process_3d'].get('manifest') is not None:
+            self.manifest_args = (config['process_3d']['manifest'], json_sha256(dm.get_config_identity()),
+                                  json_sha256(dm.get_model_identity()))
+
+    def run(self, file_names):
+        # spawn is used since neither OpenGL contexts nor CUDA survive a fork
+        ctx = multiprocessing.get_context('spawn')
+        landmark_queue = ctx.Queue(maxsize=self.queue_size)
+
+        print('Starting pipeline with', self.n_workers, 'render workers')
+        start = time.time()
+        # Each render worker has its own connection, so a worker that dies while sending an image stack only
+        # breaks its own connection. This process holds no copy of the worker end, so that shows up as EOFError
+        renderers = []
+        connections = []
+        for _ in range(self.n_workers):
+            conn, worker_conn = ctx.Pipe()
+            p = ctx.Process(target=_render_worker, args=(self.config, worker_conn))
+            p.start()
+            worker_conn.close()
+            renderers.append(p)
+            connections.append(conn)
+        reconstructor = ctx.Process(target=_reconstruction_worker,
+                                    args=(self.config, landmark_queue, self.write_text, self.write_vtk,
+                                          self.store_name, self.manifest_args))
+        reconstructor.start()
+
+        # The scans are handed out here, at most queue_size (and at least one per worker) at a time, so the
+        # renderers do not run further ahead of inference than that and the scans of each worker are known
+        tasks = collections.deque(file_names)
+        in_flight = [collections.deque() for _ in renderers]
+        max_in_flight = max(1, -(-self.queue_size // self.n_workers))
+
+        # A worker that has stopped since its last scan keeps the scan for the other workers
+        def hand_out(idx):
+            while tasks and len(in_flight[idx]) < max_in_flight:
+                in_flight[idx].append(tasks.popleft())
+                try:
+                    connections[idx].send(in_flight[idx][-1])
+                except OSError:
+                    tasks.appendleft(in_flight[idx].pop())
+                    return
+
+        # Stage 2: inference in this process, where the model is loaded
+        n_done = 0
+        live = set(range(self.n_workers))
+        try:
+            for idx in live:
+                hand_out(idx)
+            while any(in_flight[idx] for idx in live):
+                ready = wait([connections[idx] for idx in live if in_flight[idx]], timeout=self.poll_interval)
+                self.check_reconstructor(reconstructor, landmark_queue)
+                for conn in ready:
+                    idx = connections.index(conn)
+                    try:
+                        file_name, image_stack, transform_stack, timing, inputs, surface = conn.recv()
+                    except (EOFError, OSError):
+                        renderers[idx].join(self.poll_interval)
+                        print('Render worker', idx, 'stopped with exit code', renderers[idx].exitcode)
+                        live.discard(idx)
+                        for file_name in in_flight[idx]:
+                            n_done += 1
+                            print('Could not render', file_name, '- the render worker stopped')
+                            self.put_landmarks(landmark_queue, reconstructor, (file_name, None, None, {}, None, None))
+                        in_flight[idx].clear()
+                        continue
+
+                    in_flight[idx].popleft()
+                    hand_out(idx)
+                    n_done += 1
+                    print('Processing ', file_name, '(', n_done, 'of', len(file_names), ')')
+                    if image_stack is None:
+                        print('Could not render', file_name, '- skipping')
+                        self.put_landmarks(landmark_queue, reconstructor, (file_name, None, None, timing, None, None))
+                        continue
+
+                    start_predict = time.time()
+                    heatmap_maxima = self.dm.predict_heatmap_maxima(image_stack)
+                    timing['predict'] = time.time() - start_predict
+                    self.put_landmarks(landmark_queue, reconstructor,
+                                       (file_name, heatmap_maxima, transform_stack, timing, inputs, surface))
+
+            # Left over when all render workers have stopped
+            for file_name in tasks:
+                print('Could not render', file_name, '- no render workers left')
+                self.put_landmarks(landmark_queue, reconstructor, (file_name, None, None, {}, None, None))
+            for idx in live:
+                try:
+                    connections[idx].send(None)
+                except OSError:
+                    pass
+        except BaseException:
+            # workers may be blocked on sending an image stack
+            for p in renderers:
+                p.terminate()
+            raise
+        finally:
+            try:
+                self.put_landmarks(landmark_queue, reconstructor, None)
+            except RuntimeError:
+                pass
+            for p in renderers:
+                p.join()
+            for conn in connections:
+                conn.close()
+            reconstructor.join()
+
+        end = time.time()
+        print('Pipeline processed', n_done, 'meshes in', end - start, 'seconds')
+
+    # Data put on the queue of a stopped process is not waited for when this process exits
+    def check_reconstructor(self, reconstructor, landmark_queue):
+        if not reconstructor.is_alive():
+            landmark_queue.cancel_join_thread()
+            raise RuntimeError('The landmark computation process stopped with exit code {}'.format(
+                reconstructor.exitcode))
+
+    # The landmark queue is bounded, so putting blocks while the reconstruction process is busy - or dead
+    def put_landmarks(self, landmark_queue, reconstructor, item):
+        while True:
+            self.check_reconstructor(reconstructor, landmark_queue)
+            try:
+                landmark_queue.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                pass
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+from utils import file_sha256, json_sha256
+from utils3d import Utils3D
+
+
+class ResultCache:
+    """
+    Predicted landmarks on disk, addressed by the content of the scan and the settings and model that predicted them.
+
+    The key of a result is the SHA256 of the content hashes of the input files (the mesh, its texture and material
+    file), the config identity (which includes the view set and the RANSAC seed) and the model identity. The same scan content gives the
+    same key from any path, and a changed scan, setting or model gives a new key. A result is an .npz file with the
+    Utils3D fields in fields.
+    The content hash of a file is remembered by its path, size and modification time (also on disk), so a hit on
+    a known file does not read the mesh. Files are written to a temporary file and renamed, so processes sharing
+    the cache only see complete files. A hit updates the modification time of the result (and a read content hash
+    that of its hash file), and the least recently used files are removed when the cache is larger than max_size_mb.
+    """
+    fields = ['landmarks', 'landmark_errors', 'landmark_inliers', 'transformations_3d']
+
+    def __init__(self, cache_dir, config_identity, model_identity, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.hash_dir = os.path.join(cache_dir, 'hashes')
+        self.identity = json_sha256({'config': config_identity, 'model': model_identity})
+        self.max_size = max_size_mb * 1024 * 1024
+        self.content_hashes = {}
+        os.makedirs(self.hash_dir, exist_ok=True)
+
+    @staticmethod
+    def write_file(file_name, write):
+        temp_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with open(temp_name, 'wb') as f:
+            write(f)
+        os.replace(temp_name, file_name)
+
+    def get_content_hash(self, file_name):
+        stat = os.stat(file_name)
+        stamp = '{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+        content_hash = self.content_hashes.get(stamp)
+        if content_hash is not None:
+            return content_hash
+
+        hash_name = os.path.join(self.hash_dir, hashlib.sha1(stamp.encode()).hexdigest() + '.txt')
+        try:
+            with open(hash_name) as f:
+                content_hash = f.read().strip()
+            # The hash files are evicted as the results, so a used hash file is also marked as recently used
+            os.utime(hash_name)
+        except OSError:
+            pass
+        if content_hash is None or len(content_hash) != 64:
+            content_hash = file_sha256(file_name)
+            self.write_file(hash_name, lambda f: f.write(content_hash.encode()))
+        self.content_hashes[stamp] = content_hash
+        return content_hash
+
+    def get_key(self, file_name):
+        content_hashes = [self.get_content_hash(name) for name in Utils3D.get_input_file_names(file_name)]
+        return json_sha256({'inputs': content_hashes, 'identity': self.identity})
+
+    def get_result_name(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    # Returns a dict with the fields of the result or None when the key is not in the cache
+    def get(self, key):
+        result_name = self.get_result_name(key)
+        try:
+            with np.load(result_name) as result:
+                values = {name: result[name] for name in result.files}
+            os.utime(result_name)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        return values
+
+    # result: dict with some of the fields
+    def put(self, key, result):
+        values = {name: np.asarray(value) for name, value in result.items() if value is not None}
+        self.write_file(self.get_result_name(key), lambda f: np.savez(f, **values))
+        self.evict()
+
+    # Removes the least recently used files until the cache is not larger than max_size
+    def evict(self):
+        entries = []
+        for directory in [self.cache_dir, self.hash_dir]:
+            for entry in os.scandir(directory):
+                if not entry.is_file() or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Removed by another process
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
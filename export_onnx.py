@@ -0,0 +1,50 @@
+import argparse
+from parse_config import ConfigParser
+import deepmvlm
+import numpy as np
+import torch
+
+
+def check_onnx_model(config, dm, file_name):
+    import onnxruntime
+
+    image_size = config['data_loader']['args']['image_size']
+    batch_size = config['data_loader']['args']['batch_size']
+    model = dm.model.module if isinstance(dm.model, torch.nn.DataParallel) else dm.model
+    images = np.random.uniform(0, 1, (batch_size, model.in_channels, image_size, image_size)).astype(np.float32)
+
+    with torch.no_grad():
+        heatmaps = model(torch.from_numpy(images).to(dm.device))
+    if heatmaps.dim() == 5:
+        heatmaps = heatmaps[1]
+    heatmaps = heatmaps.cpu().numpy()
+
+    session = onnxruntime.InferenceSession(file_name, providers=['CPUExecutionProvider'])
+    heatmaps_onnx = session.run(None, {session.get_inputs()[0].name: images})[0]
+    print('Max difference between PyTorch and ONNX Runtime heatmaps', np.max(np.abs(heatmaps - heatmaps_onnx)))
+
+
+def main(config, file_name, verify):
+    # The graph is exported from the PyTorch model
+    config.config.setdefault('inference', {})['backend'] = 'torch'
+    dm = deepmvlm.DeepMVLM(config)
+    file_name = dm.export_onnx(file_name)
+    print('ONNX model written to', file_name)
+    if verify:
+        check_onnx_model(config, dm, file_name)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Deep-MVLM export to ONNX')
+    args.add_argument('-c', '--config', default=None, type=str,
+                      help='config file path (default: None)')
+    args.add_argument('-d', '--device', default=None, type=str,
+                      help='indices of GPUs to enable (default: all)')
+    args.add_argument('-o', '--output', default=None, type=str,
+                      help='name of the ONNX file (default: next to the downloaded model in saved/trained)')
+    args.add_argument('--verify', action='store_true',
+                      help='compare the ONNX Runtime output with the PyTorch output on random images')
+
+    cli_args = args.parse_args()
+    global_config = ConfigParser(args)
+    main(global_config, cli_args.output, cli_args.verify)
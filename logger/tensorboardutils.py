@@ -1,7 +1,7 @@
-from torch.utils.tensorboard import SummaryWriter
-
-
 class TensorboardWriter:
     def __init__(self, log_dir, logger, enabled):
+        # tensorboard (and torch) is only imported when training
+        from torch.utils.tensorboard import SummaryWriter
+
         log_dir = str(log_dir)
         self.writer = SummaryWriter(log_dir)
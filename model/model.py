@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -10,6 +11,18 @@ def conv3x3(in_planes, out_planes, strd=1, padding=1, bias=False):
                      stride=strd, padding=padding, bias=bias)
 
 
+# Convolution that computes bn(conv(x)) using the running statistics of the batch normalisation
+def fuse_conv_and_batchnorm(conv, bn):
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size,
+                      stride=conv.stride, padding=conv.padding, bias=True)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
 # Residual block
 # Inspired from https://github.com/1adrianb/face-alignment
 class ResidualBlock(nn.Module):
@@ -223,3 +236,55 @@ class MVLMModel(BaseModel):
 
         outputs = torch.stack([up_out, up_out2])
         return outputs
+
+
+# MVLMModel for prediction only
+# It is built from a trained MVLMModel and only computes the heatmaps of the second stack. The first stack
+# output (conv8 at full resolution) is not computed, dropout is removed and the batch normalisations that follow
+# a convolution (bn1, bn2 and bn3) are folded into the convolution. The batch normalisations in the residual blocks
+# come before their ReLU and convolution and the un-normalised output of the previous convolution is also used in
+# the residual sum, so they are kept as they are.
+# With half_resolution the 128 x 128 heatmaps from conv10 are returned, skipping the upsampling and conv11.
+# With in_place the modules of model are reused instead of copied, so model should not be used afterwards.
+class MVLMInferenceModel(BaseModel):
+    def __init__(self, model, half_resolution=False, in_place=False):
+        super().__init__()
+        self.half_resolution = half_resolution
+        if not in_place:
+            model = copy.deepcopy(model)
+        model = model.eval()
+        self.out_features = model.out_features
+        self.features = model.features
+        self.in_channels = model.in_channels
+        self.conv1 = fuse_conv_and_batchnorm(model.conv1, model.bn1)
+        self.conv2 = model.conv2
+        self.conv3 = model.conv3
+        self.conv4 = model.conv4
+        self.hg1 = model.hg1
+        self.hg2 = model.hg2
+        self.conv5 = fuse_conv_and_batchnorm(model.conv5, model.bn2)
+        self.conv6 = model.conv6
+        self.conv7 = model.conv7
+        self.conv9 = fuse_conv_and_batchnorm(model.conv9, model.bn3)
+        self.conv10 = model.conv10
+        self.conv11 = None if half_resolution else model.conv11
+        self.eval()
+
+    def forward(self, x):
+        # returns the heatmaps of the second stack (batch x NL x 256 x 256), the same as MVLMModel(x)[1]
+        x = F.relu(self.conv1(x))  # x: (256 x 256 x 64)
+        x = self.conv2(x)  # x: (256 x 256 x 128)
+        x = F.max_pool2d(x, 2)  # x: (128 x 128 x 128)
+        x = self.conv3(x)  # x: (128 x 128 x 128)
+        r3 = self.conv4(x)  # r3: (128 x 128 x 256)
+        x = self.hg1(r3)  # x: (128 x 128 x 256)
+        ll1 = F.relu(self.conv5(x), True)  # x: (128 x 128 x 256)
+        x = self.conv7(self.conv6(ll1))  # x: (128 x 128 x 256)
+
+        x = self.hg2(r3 + ll1 + x)
+        x = F.relu(self.conv9(x), True)  # x: (128 x 128 x 256)
+        x = self.conv10(x)  # x: (128 x 128 x NL)
+        if self.half_resolution:
+            return x
+        x = F.interpolate(x, scale_factor=2, mode='nearest')  # (256 x 256 x NL)
+        return self.conv11(x)  # (256 x 256 x NL)
@@ -0,0 +1,42 @@
+import copy
+import warnings
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+# Static post-training int8 quantization of an MVLMInferenceModel for CPU inference
+# FX graph mode quantization is used, so the convolution, batch normalisation and ReLU stacks in the
+# residual blocks and hourglass modules are quantized without changing the model code.
+def prepare_model_for_quantization(model, example_input, backend='x86'):
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    model = copy.deepcopy(model).cpu().eval()
+    return prepare_fx(model, qconfig_mapping, (example_input,))
+
+
+# image_batches: iterable of float tensors (batch, channels, image_size, image_size) used to calibrate the
+# ranges of the activations
+def quantize_model_int8(model, image_batches, backend='x86'):
+    prepared = None
+    with torch.no_grad():
+        for images in image_batches:
+            if prepared is None:
+                prepared = prepare_model_for_quantization(model, images, backend)
+            prepared(images)
+    if prepared is None:
+        raise ValueError('At least one batch of images is needed to calibrate the quantization')
+    return convert_fx(prepared)
+
+
+# Creates the quantized model structure from the float model and loads the quantized weights and
+# activation ranges from a file written with torch.save(quantized_model.state_dict(), file_name)
+def load_quantized_model_int8(model, file_name, example_input, backend='x86'):
+    prepared = prepare_model_for_quantization(model, example_input, backend)
+    with warnings.catch_warnings():
+        # The observers have not seen any data - the ranges are loaded from the file
+        warnings.simplefilter('ignore')
+        quantized = convert_fx(prepared)
+    quantized.load_state_dict(torch.load(file_name, map_location='cpu'))
+    return quantized
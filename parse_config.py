@@ -82,6 +82,10 @@ class ConfigParser:
     def __getitem__(self, name):
         return self.config[name]
 
+    def get(self, name, default=None):
+        """returns the config section name, or default for optional sections that are not in the config file"""
+        return self.config.get(name, default)
+
     def get_logger(self, name, verbosity=2):
         msg_verbosity = 'verbosity option {} is invalid. Valid options are {}.'.format(verbosity, self.log_levels.keys())
         assert verbosity in self.log_levels, msg_verbosity
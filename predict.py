@@ -1,6 +1,11 @@
 import argparse
+import collections
 from parse_config import ConfigParser
 import deepmvlm
+from deepmvlm.pipeline import PredictionPipeline
+from deepmvlm.landmark_store import LandmarkStore
+from deepmvlm.manifest import RunManifest
+from utils import json_sha256
 from utils3d import Utils3D
 import os
 
@@ -16,6 +21,76 @@ def process_one_file(config, file_name):
     dm.visualise_mesh_and_landmarks(file_name, landmarks)
 
 
+def get_manifest(config, dm):
+    manifest_name = config['process_3d'].get('manifest')
+    if manifest_name is None:
+        return None
+    return RunManifest(manifest_name, json_sha256(dm.get_config_identity()), json_sha256(dm.get_model_identity()))
+
+
+# With process_3d.landmark_store the landmarks of all scans are put in that file (see LandmarkStore) and the
+# text files per scan are only written when process_3d.write_landmark_files is true.
+# With process_3d.manifest the scans that are up to date in that RunManifest are skipped and the status of each
+# processed scan is added to it, so a stopped run can be resumed and a rerun only processes new and changed scans
+def process_names(config, dm, names):
+    manifest = get_manifest(config, dm)
+    if manifest is not None:
+        n_names = len(names)
+        names = manifest.filter(names)
+        print('Skipping', n_names - len(names), 'of', n_names, 'meshes that are up to date in', manifest.file_name)
+
+    if config['process_3d'].get('pipeline_workers', 0) > 0:
+        if manifest is not None:
+            # The manifest is written by the reconstruction stage of the pipeline
+            manifest.close()
+        PredictionPipeline(config, dm).run(names)
+        return
+
+    store_name = config['process_3d'].get('landmark_store')
+    write_text = config['process_3d'].get('write_landmark_files', store_name is None)
+    store = None
+    if store_name is not None:
+        store = LandmarkStore(store_name, config['arch']['args']['n_landmarks'])
+        print('Writing landmarks to', store_name, 'with', store.n_records, 'scans')
+    try:
+        for file_name in names:
+            print('Processing ', file_name)
+            try:
+                # The inputs are hashed before they are processed, so the manifest describes the processed files
+                inputs = manifest.get_input_stamps(file_name) if manifest is not None else None
+                u3d, timing = dm.predict_one_file_with_details(file_name)
+            except Exception as e:
+                if manifest is None:
+                    raise
+                print('Could not process', file_name, ':', e)
+                manifest.mark_failed(file_name, e)
+                continue
+            if u3d is None:
+                print('Could not process', file_name)
+                if manifest is not None:
+                    manifest.mark_failed(file_name, 'Rendering failed')
+                continue
+            outputs = []
+            if write_text:
+                name_lm_txt = os.path.splitext(file_name)[0] + '_landmarks.txt'
+                dm.write_landmarks_as_text(u3d.landmarks, name_lm_txt)
+                outputs.append(name_lm_txt)
+            store_record = None
+            if store is not None:
+                store_record = (store_name, store.put(file_name, u3d.landmarks, u3d.landmark_errors,
+                                                      u3d.landmark_inliers, u3d.transformations_3d.shape[0], timing))
+            artifact_name = Utils3D.get_view_artifact_name(file_name)
+            if config['process_3d'].get('write_view_artifacts', False) and os.path.isfile(artifact_name):
+                outputs.append(artifact_name)
+            if manifest is not None:
+                manifest.mark_done(file_name, outputs, timing, inputs, store_record)
+    finally:
+        if store is not None:
+            store.close()
+        if manifest is not None:
+            manifest.close()
+
+
 def process_file_list(config, file_name):
     print('Processing filelist ', file_name)
     names = []
@@ -26,11 +101,7 @@ def process_file_list(config, file_name):
                 names.append(line)
     print('Processing ', len(names), ' meshes')
     dm = deepmvlm.DeepMVLM(config)
-    for file_name in names:
-        print('Processing ', file_name)
-        name_lm_txt = os.path.splitext(file_name)[0] + '_landmarks.txt'
-        landmarks = dm.predict_one_file(file_name)
-        dm.write_landmarks_as_text(landmarks, name_lm_txt)
+    process_names(config, dm, names)
 
 
 def process_files_in_dir(config, dir_name):
@@ -38,11 +109,7 @@ def process_files_in_dir(config, dir_name):
     names = Utils3D.get_mesh_files_in_dir(dir_name)
     print('Processing ', len(names), ' meshes')
     dm = deepmvlm.DeepMVLM(config)
-    for file_name in names:
-        print('Processing ', file_name)
-        name_lm_txt = os.path.splitext(file_name)[0] + '_landmarks.txt'
-        landmarks = dm.predict_one_file(file_name)
-        dm.write_landmarks_as_text(landmarks, name_lm_txt)
+    process_names(config, dm, names)
 
 
 def main(config):
@@ -66,5 +133,13 @@ if __name__ == '__main__':
     args.add_argument('-n', '--name', default=None, type=str,
                       help='name of file, filelist (.txt) or directory to be processed')
 
-    global_config = ConfigParser(args)
+    # custom cli options to modify configuration from default values given in json file.
+    CustomArgs = collections.namedtuple('CustomArgs', 'flags type target')
+    options = [
+        CustomArgs(['-w', '--workers'], type=int, target=('process_3d', 'pipeline_workers')),
+        CustomArgs(['-r', '--render_workers'], type=int, target=('process_3d', 'render_workers')),
+        CustomArgs(['-s', '--store'], type=str, target=('process_3d', 'landmark_store')),
+        CustomArgs(['-m', '--manifest'], type=str, target=('process_3d', 'manifest'))
+    ]
+    global_config = ConfigParser(args, options)
     main(global_config)
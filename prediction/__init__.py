@@ -1 +1,2 @@
 from .predict2d import *
+from .backends import *
@@ -0,0 +1,155 @@
+import numpy as np
+
+
+# Offset added to the (row, col) position of the heatmap maxima. It was found by trial and places the landmarks best
+MAXIMA_OFFSET = (-1, -0.5)
+# Maxima with a higher value are spurious (the heatmaps sometimes have such maxima) and are given the value 0
+MAX_HEATMAP_VALUE = 1.2
+
+
+def _arange(xp, n, like, dtype=None):
+    return xp.arange(n, dtype=dtype) if xp is np else xp.arange(n, dtype=dtype, device=like.device)
+
+
+def refine_maxima_with_moments(xp, hms, highest_idx, sz=15, scale=1):
+    """ xp: numpy or torch, the module of hms and highest_idx
+    hms: (n, hm_size, hm_size) heatmaps, highest_idx: (n) index of the maximum in each flattened heatmap
+    The positions of the maxima refined with the first moment of the window of 2 * sz + 1 values around them as
+    Predict2D.find_heat_map_maxima with method 'moment', done for all heatmaps at once.
+    scale: size of the full resolution heatmap divided by hm_size. The positions are returned in
+    full resolution coordinates, where pixel i covers the full resolution pixels i * scale to (i + 1) * scale - 1
+    Returns (n, 3) with (row, col, value) """
+    n_heatmaps, hm_size = hms.shape[0:2]
+    hm_ids = _arange(xp, n_heatmaps, hms)
+    value = hms.reshape(n_heatmaps, -1)[hm_ids, highest_idx]
+    px = highest_idx // hm_size
+    py = highest_idx % hm_size
+
+    # Window of 2 * sz + 1 values around max gathered for all heatmaps
+    a_len = 2 * sz + 1
+    ar = _arange(xp, a_len, hms)
+    rows = xp.clip(px[:, None] + ar - sz, 0, hm_size - 1)
+    cols = xp.clip(py[:, None] + ar - sz, 0, hm_size - 1)
+    slc = hms[hm_ids[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+    ar = _arange(xp, a_len, hms, dtype=hms.dtype)
+    sum_x = slc.sum(2)
+    pos_x = (ar * sum_x).sum(1) / sum_x.sum(1) - sz
+    sum_y = slc.sum(1)
+    pos_y = (ar * sum_y).sum(1) / sum_y.sum(1) - sz
+
+    # Only refine maxima where the full window is inside the heatmap
+    inside = (px > sz) & (hm_size - px > sz) & (py > sz) & (hm_size - py > sz)
+    px = px + xp.where(inside, pos_x, 0)
+    py = py + xp.where(inside, pos_y, 0)
+    if scale != 1:
+        px = px * scale + (scale - 1) / 2
+        py = py * scale + (scale - 1) / 2
+    return xp.stack((px + MAXIMA_OFFSET[0], py + MAXIMA_OFFSET[1], value), 1)
+
+
+def find_maxima_in_batch_of_heatmaps_numpy(heatmaps, sz=15, scale=1):
+    """ heatmaps: numpy array (batch, #LM, hm_size, hm_size)
+    Same as TorchBackend.find_maxima_in_batch_of_heatmaps_on_device using numpy.
+    Returns an array (batch, #LM, 3) with (row, col, value) """
+    batch_size, out_dim, hm_size, _ = heatmaps.shape
+    hms = heatmaps.reshape(batch_size * out_dim, hm_size, hm_size)
+    highest_idx = np.argmax(hms.reshape(batch_size * out_dim, -1), axis=1)
+    coordinates = refine_maxima_with_moments(np, hms, highest_idx, sz, scale)
+    return coordinates.reshape(batch_size, out_dim, 3)
+
+
+class TorchBackend:
+    """
+    Predicts heatmaps with a PyTorch module (MVLMModel, MVLMInferenceModel or a quantized model) on the given
+    device. The heatmap maxima are found on the device so only the maxima are copied back.
+    torch is imported when the backend is used, so the prediction package can be imported without torch.
+    """
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+    # images: numpy array (batch, image_size, image_size, channels)
+    def predict_heatmaps(self, images):
+        import torch
+
+        with torch.no_grad():
+            data = self.images_to_tensor(images, self.device)
+            output = self.model(data)
+        # MVLMModel returns both stacks [stack (0 or 1), batch, lm, hm_size, hm_size]
+        # MVLMInferenceModel only returns the final heatmaps [batch, lm, hm_size, hm_size]
+        if output.dim() == 5:
+            return output[1]
+        return output
+
+    # images: numpy array (batch, image_size, image_size, channels) with unsigned char values from 0 to 255 as
+    # rendered by Render3D, or float values from 0 to 1. The images are copied to the device before they are
+    # scaled and permuted from NHWC to NCHW, so only a quarter of the bytes are copied for unsigned char images
+    @staticmethod
+    def images_to_tensor(images, device='cpu'):
+        import torch
+
+        data = torch.from_numpy(images).to(device)
+        if data.dtype == torch.uint8:
+            data = data.float().div_(255)
+        return data.permute(0, 3, 1, 2)
+
+    def find_heatmap_maxima(self, heatmaps, sz=15, scale=1):
+        coordinates = self.find_maxima_in_batch_of_heatmaps_on_device(heatmaps, sz, scale)
+        return coordinates.cpu().numpy()
+
+    @staticmethod
+    def heatmaps_to_numpy(heatmaps):
+        return heatmaps.cpu().numpy()
+
+    @staticmethod
+    def find_maxima_in_batch_of_heatmaps_on_device(heatmaps, sz=15, scale=1):
+        """ heatmaps: tensor (batch, #LM, hm_size, hm_size) on any device
+        Same as Predict2D.find_heat_map_maxima with method 'moment' done for all heatmaps at once on the device
+        of the heatmaps. Returns a tensor (batch, #LM, 3) with (row, col, value) on the same device
+        scale: size of the full resolution heatmap divided by hm_size (see refine_maxima_with_moments) """
+        import torch
+
+        if heatmaps.device.type == 'cpu':
+            # the numpy argmax is considerably faster than the torch one on the CPU and shares memory
+            return torch.from_numpy(find_maxima_in_batch_of_heatmaps_numpy(heatmaps.numpy(), sz, scale))
+
+        batch_size, out_dim, hm_size, _ = heatmaps.shape
+        hms = heatmaps.reshape(batch_size * out_dim, hm_size, hm_size)
+        _, highest_idx = torch.max(hms.reshape(batch_size * out_dim, -1), dim=1)
+        coordinates = refine_maxima_with_moments(torch, hms, highest_idx, sz, scale)
+        return coordinates.reshape(batch_size, out_dim, 3)
+
+
+class OnnxRuntimeBackend:
+    """
+    Predicts heatmaps with an ONNX graph exported by export_onnx.py using ONNX Runtime on the CPU.
+    The graph takes images (batch, channels, image_size, image_size) and returns the final heatmaps.
+    intra_op_num_threads and inter_op_num_threads of 0 lets ONNX Runtime choose.
+    """
+    def __init__(self, model_file, intra_op_num_threads=0, inter_op_num_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_num_threads
+        options.inter_op_num_threads = inter_op_num_threads
+        self.session = onnxruntime.InferenceSession(model_file, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    # images: numpy array (batch, image_size, image_size, channels) with unsigned char values from 0 to 255 or float
+    # values from 0 to 1
+    def predict_heatmaps(self, images):
+        data = np.ascontiguousarray(images.transpose(0, 3, 1, 2), dtype=np.float32)  # from NHWC to NCHW
+        if images.dtype == np.uint8:
+            data /= 255
+        return self.session.run(None, {self.input_name: data})[0]
+
+    @staticmethod
+    def find_heatmap_maxima(heatmaps, sz=15, scale=1):
+        return find_maxima_in_batch_of_heatmaps_numpy(heatmaps, sz, scale)
+
+    @staticmethod
+    def heatmaps_to_numpy(heatmaps):
+        return heatmaps
@@ -1,18 +1,20 @@
-import imageio
-import torch
 import numpy as np
 import time
-import matplotlib.pyplot as plt
-import copy
 import random
 import math
+from prediction.backends import TorchBackend, MAXIMA_OFFSET, MAX_HEATMAP_VALUE
 
 
 class Predict2D:
-    def __init__(self, config, model, device):
+    # backend: an object with predict_heatmaps, find_heatmap_maxima and heatmaps_to_numpy as the backends in
+    # prediction/backends.py. When no backend is given the model is run with PyTorch on the device
+    def __init__(self, config, model, device, backend=None):
         self.config = config
         self.model = model
         self.device = device
+        if backend is None:
+            backend = TorchBackend(model, device)
+        self.backend = backend
 
     def find_heat_map_maxima(self, heatmaps, sigma=None, method="simple"):
         """ heatmaps: (#LM, hm_size,hm_size) """
@@ -25,12 +27,12 @@ class Predict2D:
         # simple: Use only maximum pixel value in HM
         if method == "simple":
             for k in range(out_dim):
-                hm = copy.copy(heatmaps[k, :, :])
+                hm = heatmaps[k, :, :].copy()
                 highest_idx = np.unravel_index(np.argmax(hm), (hm_size, hm_size))
                 px = highest_idx[0]
                 py = highest_idx[1]
                 value = hm[px, py]  # TODO check if values is equal to np.max(hm)
-                coordinates[k, :] = (px - 1, py - 0.5, value)  # TODO find out why it works with the subtractions
+                coordinates[k, :] = (px + MAXIMA_OFFSET[0], py + MAXIMA_OFFSET[1], value)
 
         if method == "moment":
             for k in range(out_dim):
@@ -59,13 +61,26 @@ class Predict2D:
                     pos = s / ss - sz
                     py = py + pos
 
-                coordinates[k, :] = (px-1, py-0.5, value)  # TODO find out why it works with the subtractions
+                coordinates[k, :] = (px + MAXIMA_OFFSET[0], py + MAXIMA_OFFSET[1], value)
 
         return coordinates
 
+    @staticmethod
+    def store_maxima_of_batch(coordinates, cur_id, heatmap_maxima):
+        """ coordinates: (batch, #LM, 3) as returned by find_heatmap_maxima of the backends """
+        batch_size = coordinates.shape[0]
+        values = coordinates[:, :, 2]
+        for idx, lm_no in zip(*np.nonzero(values > MAX_HEATMAP_VALUE)):
+            px, py, value = coordinates[idx, lm_no]
+            print("Found heatmap with value > {} LM {} value {} pos {} {}  ".format(MAX_HEATMAP_VALUE, lm_no, value,
+                                                                                   px, py))
+            coordinates[idx, lm_no, 2] = 0
+        # heatmap_maxima: [n_landmarks, n_views, x, y, value]
+        heatmap_maxima[:, cur_id:cur_id + batch_size, :] = np.transpose(coordinates, (1, 0, 2))
+
+    # heatmaps: numpy array (batch, #LM, hm_size, hm_size)
     def find_maxima_in_batch_of_heatmaps(self, heatmaps, cur_id, heatmap_maxima):
         write_heatmaps = False
-        heatmaps = heatmaps.numpy()
         batch_size = heatmaps.shape[0]
 
         f = None
@@ -79,8 +94,9 @@ class Predict2D:
                 px = coordinates[lm_no][0]
                 py = coordinates[lm_no][1]
                 value = coordinates[lm_no][2]
-                if value > 1.2:  # TODO debug - really bad hack due to weird max in heatmaps
-                    print("Found heatmap with value > 1.2 LM {} value {} pos {} {}  ".format(lm_no, value, px, py))
+                if value > MAX_HEATMAP_VALUE:
+                    print("Found heatmap with value > {} LM {} value {} pos {} {}  ".format(MAX_HEATMAP_VALUE, lm_no,
+                                                                                           value, px, py))
                     value = 0
                 # if lm_no == 0:
                 # print('LM value and pos', lm_no, value, px, py)
@@ -117,9 +133,12 @@ class Predict2D:
                         i[x, y, 2] = 1  # blue
         return i
 
+    # image: numpy array (channels, image_size, image_size), heat_map: numpy array (#LM, hm_size, hm_size)
     def show_image_and_heatmap(self, image, heat_map):
-        heat_map = heat_map.numpy()
-        im_size = image.size(2)
+        # matplotlib is only needed for this debug view
+        import matplotlib.pyplot as plt
+
+        im_size = image.shape[2]
         hm_size = heat_map.shape[2]
 
         # Super hacky way to convert gray to RGB
@@ -159,13 +178,14 @@ class Predict2D:
         plt.show()
 
     def write_batch_of_heatmaps(self, heatmaps, images, cur_id):
+        import imageio
+
         batch_size = heatmaps.shape[0]
 
         for idx in range(batch_size):
             name_hm_maxima = str(self.config.temp_dir / ('heatmap' + str(cur_id + idx) + '.png'))
             name_hm_maxima_2 = str(self.config.temp_dir / ('heatmap_max' + str(cur_id + idx) + '.png'))
             heatmap = heatmaps[idx, :, :, :]
-            heatmap = heatmap.numpy()
             hm_size = heatmap.shape[2]
 
             hm = np.zeros((hm_size, hm_size, 3))
@@ -190,9 +210,10 @@ class Predict2D:
             imageio.imwrite(name_hm_maxima_2, im_marked)
 
     def predict_heatmaps_from_images(self, image_stack):
-        n_views = self.config['data_loader']['args']['n_views']
+        n_views = image_stack.shape[0]
         batch_size = self.config['data_loader']['args']['batch_size']
         n_landmarks = self.config['arch']['args']['n_landmarks']
+        hm_size = self.config['data_loader']['args']['heatmap_size']
 
         write_heatmaps = False
         show_result_image = False
@@ -200,30 +221,26 @@ class Predict2D:
 
         print('Predicting heatmaps for all views')
         start = time.time()
-        # process the views in batch sized chunks
+        # process the views in batch sized chunks (the last chunk may be smaller)
         cur_id = 0
-        while cur_id + batch_size <= n_views:
+        while cur_id < n_views:
             cur_images = image_stack[cur_id:cur_id + batch_size, :, :, :]
 
-            data = torch.from_numpy(cur_images)
-            # data = torch.from_numpy(image_stack)
-            data = data.permute(0, 3, 1, 2)  # from NHWC to NCHW
-
-            with torch.no_grad():
-                # print('predicting heatmaps for batch ', cur_id, ' to ', cur_id + batch_size)
-                data = data.to(self.device)
-                output = self.model(data)
+            # print('predicting heatmaps for batch ', cur_id, ' to ', cur_id + batch_size)
+            heatmaps = self.backend.predict_heatmaps(cur_images)
 
-                if cur_id == 0 and show_result_image:
-                    image = data[0, :, :, :].cpu()
-                    heat_map = output[1, 0, :, :, :].cpu()
-                    self.show_image_and_heatmap(image, heat_map)
+            if cur_id == 0 and show_result_image:
+                image = cur_images[0, :, :, :].transpose(2, 0, 1) / 255
+                heat_map = self.backend.heatmaps_to_numpy(heatmaps[0, :, :, :])
+                self.show_image_and_heatmap(image, heat_map)
 
-                # output [stack (0 or 1), batch, lm, hm_size, hm_size]
-                heatmaps = output[1, :, :, :, :].cpu()
-                self.find_maxima_in_batch_of_heatmaps(heatmaps, cur_id, heatmap_maxima)
-                if write_heatmaps:
-                    self.write_batch_of_heatmaps(heatmaps, cur_images, cur_id)
+            # only the maxima are copied from the device
+            # half resolution heatmaps are decoded with a correspondingly smaller window
+            scale = hm_size // heatmaps.shape[-1]
+            coordinates = self.backend.find_heatmap_maxima(heatmaps, sz=15 // scale, scale=scale)
+            self.store_maxima_of_batch(coordinates, cur_id, heatmap_maxima)
+            if write_heatmaps:
+                self.write_batch_of_heatmaps(self.backend.heatmaps_to_numpy(heatmaps), cur_images / 255, cur_id)
 
             cur_id = cur_id + batch_size
 
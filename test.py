@@ -1,13 +1,23 @@
 import argparse
+import copy
 import datetime
+import shutil
+import tempfile
 import time
 
 import torch
 import model.model as module_arch
+import model.quantization as quantization
 from parse_config import ConfigParser
 from utils3d import Utils3D
 from utils3d import Render3D
+from utils3d import Mesh3D
+from utils3d import ViewSet
+from utils3d import SoftwareRenderer
 from prediction import Predict2D
+from prediction import TorchBackend
+from deepmvlm import DeepMVLM
+from deepmvlm.result_cache import ResultCache
 import os
 import numpy as np
 from scipy.spatial import distance
@@ -60,8 +70,9 @@ def get_device_and_load_model(config):
 def predict_one_subject(config, file_name):
     device, model = get_device_and_load_model(config)
 
+    mesh = Mesh3D(config, file_name)
     render_3d = Render3D(config)
-    image_stack, transform_stack = render_3d.render_3d_file(file_name)
+    image_stack, transform_stack = render_3d.render_3d_file(mesh)
 
     predict_2d = Predict2D(config, model, device)
     heatmap_maxima = predict_2d.predict_heatmaps_from_images(image_stack)
@@ -74,7 +85,7 @@ def predict_one_subject(config, file_name):
     u3d.compute_lines_from_heatmap_maxima()
     # u3d.visualise_one_landmark_lines(40, 'saved/temp/DeepMVLM_DTU3D/0904_104414')
     u3d.compute_all_landmarks_from_view_lines()
-    u3d.project_landmarks_to_surface(file_name)
+    u3d.project_landmarks_to_surface(mesh)
     # u3d.write_landmarks_as_vtk_points()
     return u3d.landmarks
 
@@ -205,13 +216,9 @@ def write_lm_names_to_result_file(res_f):
 
 
 
-def test_on_bu_3d_fe(config):
+def read_bu_3d_fe_test_set(config):
     test_set_file = config['data_loader']['args']['data_dir'] + '/dataset_test.txt'
     # test_set_file = config['data_loader']['args']['data_dir'] + '/face_dataset_debug.txt'
-    result_file = config.temp_dir / 'results.csv'
-
-    device, model = get_device_and_load_model(config)
-
     files = []
     with open(test_set_file) as f:
         for line in f:
@@ -221,6 +228,25 @@ def test_on_bu_3d_fe(config):
             if len(clean_name) > 0:
                 files.append(clean_name)
     print('Read', len(files), 'files to run test on')
+    return files
+
+
+def compute_landmarks(config, mesh, heatmap_maxima, transform_stack):
+    u3d = Utils3D(config)
+    u3d.heatmap_maxima = heatmap_maxima
+    u3d.transformations_3d = transform_stack
+    u3d.compute_lines_from_heatmap_maxima()
+    u3d.compute_all_landmarks_from_view_lines()
+    u3d.project_landmarks_to_surface(mesh)
+    return u3d.landmarks
+
+
+def test_on_bu_3d_fe(config):
+    result_file = config.temp_dir / 'results.csv'
+
+    device, model = get_device_and_load_model(config)
+
+    files = read_bu_3d_fe_test_set(config)
 
     bu_3dfe_dir = config['preparedata']['raw_data_dir']
 
@@ -236,8 +262,9 @@ def test_on_bu_3d_fe(config):
         if os.path.isfile(wrl_name):
             print('Computing file ', idx, ' of ', len(files))
 
+            mesh = Mesh3D(config, wrl_name)
             render_3d = Render3D(config)
-            image_stack, transform_stack = render_3d.render_3d_file(wrl_name)
+            image_stack, transform_stack = render_3d.render_3d_file(mesh)
 
             predict_2d = Predict2D(config, model, device)
             heatmap_maxima = predict_2d.predict_heatmaps_from_images(image_stack)
@@ -250,7 +277,7 @@ def test_on_bu_3d_fe(config):
             # u3d.visualise_one_landmark_lines(83)
             # u3d.visualise_one_landmark_lines(26)
             u3d.compute_all_landmarks_from_view_lines()
-            u3d.project_landmarks_to_surface(wrl_name)
+            u3d.project_landmarks_to_surface(mesh)
             pred_lms = u3d.landmarks
 
             res_f.write(f_name + ', ')
@@ -268,8 +295,277 @@ def test_on_bu_3d_fe(config):
             print('File', wrl_name, ' does not exists')
 
 
-def main(config):
-    test_on_bu_3d_fe(config)
+# Compare the landmark accuracy when decoding the full resolution heatmaps and the half resolution heatmaps
+# of MVLMInferenceModel. The same renderings are used for both.
+def test_heatmap_resolutions_on_bu_3d_fe(config):
+    result_file = config.temp_dir / 'results_heatmap_resolution.csv'
+
+    device, model = get_device_and_load_model(config)
+    if isinstance(model, torch.nn.DataParallel):
+        model = model.module
+    models = {'full': module_arch.MVLMInferenceModel(model).to(device),
+              'half': module_arch.MVLMInferenceModel(model, half_resolution=True).to(device)}
+
+    files = read_bu_3d_fe_test_set(config)
+    bu_3dfe_dir = config['preparedata']['raw_data_dir']
+
+    errors = {'full': [], 'half': []}
+    times = {'full': 0, 'half': 0}
+    res_f = open(result_file, "w")
+    res_f.write('name, mean error full resolution, mean error half resolution\n')
+    for f_name in files:
+        lm_name = bu_3dfe_dir + f_name + '_RAW_84_LMS.txt'
+        wrl_name = bu_3dfe_dir + f_name + '_RAW.wrl'
+        if not os.path.isfile(wrl_name):
+            print('File', wrl_name, ' does not exists')
+            continue
+
+        gt_lms = np.array(read_3d_landmarks(lm_name))
+        mesh = Mesh3D(config, wrl_name)
+        render_3d = Render3D(config)
+        image_stack, transform_stack = render_3d.render_3d_file(mesh)
+
+        for name, m in models.items():
+            start = time.time()
+            heatmap_maxima = Predict2D(config, m, device).predict_heatmaps_from_images(image_stack)
+            times[name] += time.time() - start
+            pred_lms = compute_landmarks(config, mesh, heatmap_maxima, transform_stack)
+            errors[name].append(np.mean(np.linalg.norm(pred_lms - gt_lms, axis=1)))
+
+        res_f.write('{}, {}, {}\n'.format(f_name, errors['full'][-1], errors['half'][-1]))
+        res_f.flush()
+    res_f.close()
+
+    n_files = len(errors['full'])
+    for name in models:
+        print('{} resolution heatmaps: mean landmark error {:.3f} prediction time per scan {:.3f} s'.format(
+            name, np.mean(errors[name]), times[name] / max(n_files, 1)))
+    print('Mean difference in landmark error (half - full)', np.mean(np.array(errors['half']) - np.array(errors['full'])))
+
+
+# Compare the landmark accuracy and the prediction time on CPU of the float MVLMInferenceModel and the int8
+# quantized model. The quantization is calibrated on the first calibration_views views of the first
+# n_calibration_files files of the test set. The same renderings are used for both.
+def test_quantization_on_bu_3d_fe(config, n_calibration_files=4):
+    result_file = config.temp_dir / 'results_quantization.csv'
+
+    _, model = get_device_and_load_model(config)
+    if isinstance(model, torch.nn.DataParallel):
+        model = model.module
+    device = torch.device('cpu')
+    fp32_model = module_arch.MVLMInferenceModel(model).to(device).eval()
+
+    files = read_bu_3d_fe_test_set(config)
+    bu_3dfe_dir = config['preparedata']['raw_data_dir']
+    wrl_names = [bu_3dfe_dir + f_name + '_RAW.wrl' for f_name in files]
+    wrl_names = [name for name in wrl_names if os.path.isfile(name)]
+
+    n_views = config.get('inference', {}).get('calibration_views', 16)
+    batch_size = config['data_loader']['args']['batch_size']
+
+    def calibration_batches():
+        for wrl_name in wrl_names[:n_calibration_files]:
+            image_stack, _ = Render3D(config).render_3d_file(Mesh3D(config, wrl_name))
+            image_stack = image_stack[:n_views]
+            for cur_id in range(0, image_stack.shape[0], batch_size):
+                yield TorchBackend.images_to_tensor(image_stack[cur_id:cur_id + batch_size])
+
+    print('Calibrating int8 quantization on', min(n_calibration_files, len(wrl_names)), 'files')
+    models = {'fp32': fp32_model, 'int8': quantization.quantize_model_int8(fp32_model, calibration_batches())}
+
+    errors = {'fp32': [], 'int8': []}
+    times = {'fp32': 0, 'int8': 0}
+    differences = []
+    res_f = open(result_file, "w")
+    res_f.write('name, mean error fp32, mean error int8, mean distance int8 to fp32\n')
+    for f_name in files:
+        lm_name = bu_3dfe_dir + f_name + '_RAW_84_LMS.txt'
+        wrl_name = bu_3dfe_dir + f_name + '_RAW.wrl'
+        if not os.path.isfile(wrl_name):
+            print('File', wrl_name, ' does not exists')
+            continue
+
+        gt_lms = np.array(read_3d_landmarks(lm_name))
+        mesh = Mesh3D(config, wrl_name)
+        render_3d = Render3D(config)
+        image_stack, transform_stack = render_3d.render_3d_file(mesh)
+
+        pred_lms = {}
+        for name, m in models.items():
+            start = time.time()
+            heatmap_maxima = Predict2D(config, m, device).predict_heatmaps_from_images(image_stack)
+            times[name] += time.time() - start
+            pred_lms[name] = compute_landmarks(config, mesh, heatmap_maxima, transform_stack)
+            errors[name].append(np.mean(np.linalg.norm(pred_lms[name] - gt_lms, axis=1)))
+        differences.append(np.mean(np.linalg.norm(pred_lms['int8'] - pred_lms['fp32'], axis=1)))
+
+        res_f.write('{}, {}, {}, {}\n'.format(f_name, errors['fp32'][-1], errors['int8'][-1], differences[-1]))
+        res_f.flush()
+    res_f.close()
+
+    n_files = len(errors['fp32'])
+    for name in models:
+        print('{} model: mean landmark error {:.3f} prediction time per scan {:.3f} s'.format(
+            name, np.mean(errors[name]), times[name] / max(n_files, 1)))
+    print('Mean distance between int8 and fp32 landmarks', np.mean(differences))
+
+
+# Check that the fused MVLMInferenceModel and the inference model built by DeepMVLM predict the heatmaps of the
+# training model (the second stack of MVLMModel) on random images on the CPU. With -r the weights of the checkpoint
+# are used, otherwise random weights and batch normalization statistics, so the fused batch normalization is not an
+# identity. Raises an AssertionError when the heatmaps differ by more than rtol and atol
+def check_inference_model(config, n_images=2, rtol=1e-4, atol=1e-5):
+    if config.resume is not None:
+        _, model = get_device_and_load_model(config)
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        model = model.cpu()
+    else:
+        torch.manual_seed(0)
+        model = config.initialize('arch', module_arch)
+        for m in model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                torch.nn.init.uniform_(m.weight, 0.5, 1.5)
+                torch.nn.init.uniform_(m.bias, -0.1, 0.1)
+                torch.nn.init.uniform_(m.running_mean, -0.1, 0.1)
+                torch.nn.init.uniform_(m.running_var, 0.5, 1.5)
+    model = model.eval()
+
+    torch.manual_seed(0)
+    image_size = config['data_loader']['args']['image_size']
+    images = torch.rand(n_images, model.in_channels, image_size, image_size)
+    models = {'MVLMInferenceModel': module_arch.MVLMInferenceModel(model),
+              'DeepMVLM inference model': DeepMVLM._get_inference_model(copy.deepcopy(model), [])}
+    with torch.no_grad():
+        heatmaps = model(images)[1]
+        for name, inference_model in models.items():
+            heatmaps_inference = inference_model(images)
+            print('{}: max difference in heatmaps {:.2e} (max value {:.2e})'.format(
+                name, torch.max(torch.abs(heatmaps_inference - heatmaps)).item(), torch.max(heatmaps).item()))
+            torch.testing.assert_close(heatmaps_inference, heatmaps, rtol=rtol, atol=atol,
+                                       msg=lambda msg: name + ': ' + msg)
+    print('The inference models predict the heatmaps of the training model')
+
+
+# Largest distance from a point in the (normalised) angle ranges to the closest view - lower is better coverage
+def view_set_dispersion(config, transform_stack, n_probes=4096, seed=0):
+    process_3d = config['process_3d']
+    low = np.array([process_3d['min_' + name + '_angle'] for name in ['x', 'y', 'z']], dtype=np.float64)
+    high = np.array([process_3d['max_' + name + '_angle'] for name in ['x', 'y', 'z']], dtype=np.float64)
+    views = (transform_stack[:, 0:3] - low) / (high - low)
+    probes = np.random.RandomState(seed).uniform(0, 1, (n_probes, 3))
+    distances = np.linalg.norm(probes[:, np.newaxis, :] - views[np.newaxis, :, :], axis=2)
+    return np.max(np.min(distances, axis=1))
+
+
+# Check that the Halton view sets cover the angle ranges better (with a lower dispersion) than the mean of
+# n_random_sets random view sets, and that the view lines computed with the cached tables of a view set are the
+# lines of the VTK reference implementation within atol
+def check_view_sets(config, n_random_sets=10, atol=1e-3):
+    render_3d = Render3D(config)
+    for n_views in [16, 32, 64, 96]:
+        dispersion_random = []
+        for seed in range(n_random_sets):
+            np.random.seed(seed)
+            random_set = np.array([render_3d.random_transform() for _ in range(n_views)])
+            dispersion_random.append(view_set_dispersion(config, random_set))
+        dispersion_halton = view_set_dispersion(config, ViewSet.generate_halton_transformations(config, n_views))
+        print('{} views: dispersion of the angles random {:.3f} (mean of {} sets) halton {:.3f}'.format(
+            n_views, np.mean(dispersion_random), n_random_sets, dispersion_halton))
+        assert dispersion_halton < np.mean(dispersion_random), \
+            'The Halton view set of {} views covers the angles worse than random view sets'.format(n_views)
+
+    n_landmarks = config['arch']['args']['n_landmarks']
+    n_views = config['data_loader']['args']['n_views']
+    hm_size = config['data_loader']['args']['heatmap_size']
+    rng = np.random.RandomState(0)
+    u3d = Utils3D(config)
+    u3d.heatmap_maxima = np.concatenate((rng.uniform(0, hm_size, (n_landmarks, n_views, 2)),
+                                         rng.uniform(0, 1, (n_landmarks, n_views, 1))), axis=2)
+    u3d.transformations_3d = ViewSet.generate_halton_transformations(config, n_views)
+    u3d.compute_lines_from_heatmap_maxima()
+    lm_start, lm_end = u3d.lm_start, u3d.lm_end
+    u3d.compute_lines_from_heatmap_maxima_vtk()
+    np.testing.assert_allclose(lm_start, u3d.lm_start, rtol=0, atol=atol, err_msg='View line start points')
+    np.testing.assert_allclose(lm_end, u3d.lm_end, rtol=0, atol=atol, err_msg='View line end points')
+    print('The view lines of', n_landmarks, 'landmarks in', n_views, 'views are the VTK view lines')
+
+
+# Check that the software renderer renders the geometry and depth channels of the bundled test mesh as VTK does,
+# within the tolerances of SoftwareRenderer.check_parity (which raises a RuntimeError). The surface has float point
+# scalars, which color the geometry, and it is also rendered without them
+def check_software_rendering(config, n_views=16):
+    file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'testmesh_bumpy.vtk')
+    render_3d = Render3D(config)
+    transform_stack = ViewSet.generate_halton_transformations(config, n_views)
+    channels = ['geometry', 'depth']
+    for with_scalars in [True, False]:
+        mesh = Mesh3D(config, file_name)
+        if not with_scalars:
+            mesh.polydata.GetPointData().SetScalars(None)
+        images_vtk = render_3d.render_3d_multi_rgb_geometry_depth(transform_stack, mesh, channels)
+        images = render_3d.render_3d_geometry_depth_software(transform_stack, mesh, channels)
+        # The background of the depth images is 1
+        foreground = images_vtk[..., channels.index('depth')] != 1
+        for idx, channel in enumerate(channels):
+            stats = SoftwareRenderer.check_parity(images[..., idx], images_vtk[..., idx], foreground)
+            print('{} {:8s}: mean abs difference {:.3f} grey levels, pixels off by more than {} grey levels '
+                  '{:.3%} (away from the silhouette {:.3f} and {:.4%})'.format(
+                      'with scalars   ' if with_scalars else 'without scalars', channel, stats['mean_difference'],
+                      SoftwareRenderer.parity_large_difference, stats['large_fraction'],
+                      stats['mean_difference_off_silhouette'], stats['large_fraction_off_silhouette']))
+    print('The software renderings of', n_views, 'views are within the tolerances of the VTK renderings')
+
+
+# Check that a result put in the result cache is returned for a copy of the bundled test mesh under another name by
+# a new cache object, and that a cache with another config identity (here another RANSAC seed) misses it
+def check_result_cache(config):
+    file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'testmesh_bumpy.vtk')
+    n_landmarks = config['arch']['args']['n_landmarks']
+    n_views = config['data_loader']['args']['n_views']
+    rng = np.random.RandomState(0)
+    result = {'landmarks': rng.normal(0, 50, (n_landmarks, 3)), 'landmark_errors': rng.uniform(0, 5, n_landmarks),
+              'landmark_inliers': rng.randint(0, n_views, n_landmarks),
+              'transformations_3d': rng.normal(0, 1, (n_views, 6))}
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_dir = os.path.join(work_dir, 'result_cache')
+        cache = ResultCache(cache_dir, {'process_3d': {'ransac_seed': 0}}, {'checkpoint': 'check'})
+        cache.put(cache.get_key(file_name), result)
+
+        copy_name = os.path.join(work_dir, 'copy.vtk')
+        shutil.copyfile(file_name, copy_name)
+        new_cache = ResultCache(cache_dir, {'process_3d': {'ransac_seed': 0}}, {'checkpoint': 'check'})
+        hit = new_cache.get(new_cache.get_key(copy_name))
+        assert hit is not None, 'The result cache misses a copy of the mesh'
+        for name in ResultCache.fields:
+            np.testing.assert_array_equal(hit[name], result[name], err_msg=name)
+
+        other_cache = ResultCache(cache_dir, {'process_3d': {'ransac_seed': 1}}, {'checkpoint': 'check'})
+        assert other_cache.get(other_cache.get_key(file_name)) is None, \
+            'The result cache returns a result predicted with another RANSAC seed'
+    print('The result cache returns the result for a copy of the mesh and misses it with another config')
+
+
+# The checks run with --check. Each raises an exception when it fails, so the script exits with an error
+checks = {
+    'inference_model': check_inference_model,
+    'view_sets': check_view_sets,
+    'software_rendering': check_software_rendering,
+    'result_cache': check_result_cache,
+}
+
+
+def main(config, compare_heatmap_resolutions=False, compare_quantization=False, check_names=None):
+    if compare_heatmap_resolutions:
+        test_heatmap_resolutions_on_bu_3d_fe(config)
+    elif compare_quantization:
+        test_quantization_on_bu_3d_fe(config)
+    elif check_names:
+        for name in check_names:
+            print('=== Check', name, '===')
+            checks[name](config)
+    else:
+        test_on_bu_3d_fe(config)
 
 
 if __name__ == '__main__':
@@ -281,6 +577,16 @@ if __name__ == '__main__':
                       help='path to latest checkpoint (default: None)')
     args.add_argument('-d', '--device', default=None, type=str,
                       help='indices of GPUs to enable (default: all)')
-
+    args.add_argument('--heatmap_resolution_test', action='store_true',
+                      help='compare accuracy of full and half resolution heatmaps')
+    args.add_argument('--quantization_test', action='store_true',
+                      help='compare accuracy and CPU prediction time of the fp32 and int8 quantized models')
+    args.add_argument('--check', default=None, type=str, nargs='+', choices=list(checks.keys()),
+                      help='run the given checks instead of the test (inference_model: the fused inference models '
+                           'predict the heatmaps of the training model, view_sets: coverage and view lines of '
+                           'the view sets, software_rendering: the software renderings of the bundled test mesh '
+                           'match the VTK renderings, result_cache: hits and misses of the result cache)')
+
+    cli_args = args.parse_args()
     cfg_global = ConfigParser(args)
-    main(cfg_global)
+    main(cfg_global, cli_args.heatmap_resolution_test, cli_args.quantization_test, cli_args.check)
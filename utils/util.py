@@ -1,3 +1,4 @@
+import hashlib
 import json
 from pathlib import Path
 from datetime import datetime
@@ -21,6 +22,20 @@ def write_json(content, fname):
         json.dump(content, handle, indent=4, sort_keys=False)
 
 
+# The SHA256 hash of a file as a hex string, read in blocks of 1 MB
+def file_sha256(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+# The SHA256 hash of the JSON of the content with sorted keys, so equal content gives the same hash
+def json_sha256(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
 def inf_loop(data_loader):
     # wrapper function for endless data loader.
     for loader in repeat(data_loader):
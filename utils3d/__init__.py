@@ -1,2 +1,8 @@
 from .utils3d import *
 from .render3d import *
+from .mesh3d import *
+from .viewset import *
+from .rasterizer import *
+from .parallel_render3d import *
+from .surface_index import *
+from .view_artifact import *
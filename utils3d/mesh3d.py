@@ -0,0 +1,343 @@
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+from utils3d import vtk_lazy as vtk
+
+from utils3d.utils3d import Utils3D
+from utils3d.surface_index import SurfaceIndex
+
+
+# The numeric arrays of point or cell data as (name, values, attribute type) with -1 for arrays that are not an
+# attribute (scalars, normals, texture coordinates, ...)
+def _attributes_to_arrays(attributes):
+    arrays = []
+    for i in range(attributes.GetNumberOfArrays()):
+        array = attributes.GetArray(i)
+        if array is not None:
+            arrays.append((array.GetName(), vtk.vtk_to_numpy(array), attributes.IsArrayAnAttribute(i)))
+    return arrays
+
+
+def _arrays_to_attributes(arrays, attributes):
+    for name, values, attribute in arrays:
+        array = vtk.numpy_to_vtk(values, deep=True)
+        if name is not None:
+            array.SetName(name)
+        if attribute >= 0:
+            attributes.SetAttribute(array, attribute)
+        else:
+            attributes.AddArray(array)
+
+
+# A polydata as numpy arrays, so it can be sent to another process without writing and parsing a file
+def _polydata_to_arrays(pd):
+    cells = {}
+    for kind in ['Verts', 'Lines', 'Polys', 'Strips']:
+        cell_array = getattr(pd, 'Get' + kind)()
+        if cell_array.GetNumberOfCells() > 0:
+            cells[kind] = (vtk.vtk_to_numpy(cell_array.GetOffsetsArray()).astype(np.int64),
+                           vtk.vtk_to_numpy(cell_array.GetConnectivityArray()).astype(np.int64))
+    points = vtk.vtk_to_numpy(pd.GetPoints().GetData()) if pd.GetPoints() is not None else None
+    return {'points': points, 'cells': cells, 'point_data': _attributes_to_arrays(pd.GetPointData()),
+            'cell_data': _attributes_to_arrays(pd.GetCellData())}
+
+
+def _arrays_to_polydata(arrays):
+    pd = vtk.vtkPolyData()
+    if arrays['points'] is not None:
+        points = vtk.vtkPoints()
+        points.SetData(vtk.numpy_to_vtk(arrays['points'], deep=True))
+        pd.SetPoints(points)
+    for kind, (offsets, connectivity) in arrays['cells'].items():
+        cell_array = vtk.vtkCellArray()
+        cell_array.SetData(vtk.numpy_to_vtk(offsets, deep=True, array_type=vtk.VTK_ID_TYPE),
+                           vtk.numpy_to_vtk(connectivity, deep=True, array_type=vtk.VTK_ID_TYPE))
+        getattr(pd, 'Set' + kind)(cell_array)
+    _arrays_to_attributes(arrays['point_data'], pd.GetPointData())
+    _arrays_to_attributes(arrays['cell_data'], pd.GetCellData())
+    return pd
+
+
+def _image_to_arrays(image):
+    return {'dimensions': image.GetDimensions(), 'origin': image.GetOrigin(), 'spacing': image.GetSpacing(),
+            'point_data': _attributes_to_arrays(image.GetPointData())}
+
+
+def _arrays_to_image(arrays):
+    image = vtk.vtkImageData()
+    image.SetDimensions(arrays['dimensions'])
+    image.SetOrigin(arrays['origin'])
+    image.SetSpacing(arrays['spacing'])
+    _arrays_to_attributes(arrays['point_data'], image.GetPointData())
+    return image
+
+
+# An actor of a material of a textured OBJ file as numpy arrays. Only the surface and texture are kept, since the
+# property of the actor is replaced when rendering (see Render3D.render_3d_obj)
+def _actor_to_arrays(actor):
+    mapper = actor.GetMapper()
+    texture = actor.GetTexture()
+    texture_arrays = None
+    if texture is not None:
+        if texture.GetInputAlgorithm() is not None:
+            texture.GetInputAlgorithm().Update()
+        texture_arrays = (_image_to_arrays(texture.GetInput()), texture.GetInterpolate(), texture.GetRepeat())
+    return _polydata_to_arrays(mapper.GetInput()), mapper.GetScalarVisibility(), texture_arrays
+
+
+def _arrays_to_actor(arrays):
+    pd_arrays, scalar_visibility, texture_arrays = arrays
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputData(_arrays_to_polydata(pd_arrays))
+    mapper.SetScalarVisibility(scalar_visibility)
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    if texture_arrays is not None:
+        image_arrays, interpolate, repeat = texture_arrays
+        texture = vtk.vtkTexture()
+        texture.SetInputData(_arrays_to_image(image_arrays))
+        texture.SetInterpolate(interpolate)
+        texture.SetRepeat(repeat)
+        actor.SetTexture(texture)
+    return actor
+
+
+class Mesh3D:
+    """
+    A surface that is read once and shared by rendering, 3D reconstruction and surface projection.
+
+    Holds the surface as read from file, the pre-alignment transformation from the 'pre-align' section of the
+    config and, read or computed when first needed, the texture, the pre-aligned surface, the cleaned pre-aligned
+    surface, the index used to project landmarks to the surface and the actors of a textured (multi material) OBJ
+    file.
+    A textured OBJ file that is rendered with its materials (the RGB image channels) is only parsed by the
+    vtkOBJImporter and the surface is taken from its actors. With for_rendering False the mesh is only used for
+    the 3D reconstruction, and the surface of an OBJ file is read without its materials and textures.
+    """
+    def __init__(self, config, file_name, for_rendering=True):
+        self.config = config
+        self.file_name = file_name
+        self.center_of_mass = (0, 0, 0)
+        self.pre_transform = None
+        self._texture_image = None
+        self._texture_read = False
+        self._aligned_polydata = None
+        self._clean_polydata = None
+        self._surface_index = None
+        self._obj_importer = None
+        self._obj_actors = None
+        if for_rendering and self.is_rendered_with_materials():
+            self.polydata = self.get_obj_surface()
+        else:
+            self.polydata = Utils3D.multi_read_surface(file_name)
+
+        if not self.is_valid():
+            print('Could not read', file_name)
+            return
+
+        if self.config['pre-align']['align_center_of_mass']:
+            vtk_cm = vtk.vtkCenterOfMass()
+            vtk_cm.SetInputData(self.polydata)
+            vtk_cm.SetUseScalarsAsWeights(False)
+            vtk_cm.Update()
+            self.center_of_mass = vtk_cm.GetCenter()
+        self.pre_transform = self.get_pre_transformation(include_scale=True)
+
+    # A mesh is sent to other processes (see ParallelRender3D) as numpy arrays of what was read from the file: the
+    # surface, the texture when rendering RGB and the actors of a textured OBJ file, so the file is not read again
+    # there. The pre-aligned surface, the cleaned surface and the surface index are computed again when needed
+    def __getstate__(self):
+        state = {'config': self.config, 'file_name': self.file_name, 'center_of_mass': self.center_of_mass,
+                 'polydata': None, 'texture_image': None, 'texture_read': False, 'obj_actors': None}
+        if not self.is_valid():
+            return state
+        state['polydata'] = _polydata_to_arrays(self.polydata)
+        if self.is_rendered_with_materials() or self._obj_actors is not None:
+            state['obj_actors'] = [_actor_to_arrays(actor) for actor in self.get_obj_actors()]
+        elif 'RGB' in self.config['data_loader']['args']['image_channels']:
+            if self.texture_image is not None:
+                state['texture_image'] = _image_to_arrays(self.texture_image)
+            state['texture_read'] = True
+        return state
+
+    def __setstate__(self, state):
+        self.config = state['config']
+        self.file_name = state['file_name']
+        self.center_of_mass = state['center_of_mass']
+        self.pre_transform = None
+        self._texture_image = None
+        self._texture_read = False
+        self._aligned_polydata = None
+        self._clean_polydata = None
+        self._surface_index = None
+        self._obj_importer = None
+        self._obj_actors = None
+        self.polydata = None
+        if state['polydata'] is None:
+            return
+        self.polydata = _arrays_to_polydata(state['polydata'])
+        if state['obj_actors'] is not None:
+            self._obj_actors = [_arrays_to_actor(arrays) for arrays in state['obj_actors']]
+        if state['texture_image'] is not None:
+            self._texture_image = _arrays_to_image(state['texture_image'])
+        self._texture_read = state['texture_read']
+        self.pre_transform = self.get_pre_transformation(include_scale=True)
+
+    def is_valid(self):
+        return self.polydata is not None and self.polydata.GetNumberOfPoints() > 0
+
+    # As in Render3D.render_3d_file, the RGB channels of an OBJ file are rendered from the actors of its materials
+    def is_rendered_with_materials(self):
+        image_channels = self.config['data_loader']['args']['image_channels']
+        return os.path.splitext(self.file_name)[1].lower() == '.obj' and image_channels in ['RGB', 'RGB+depth']
+
+    def has_texture(self):
+        return Utils3D.get_texture_file_name(self.file_name) is not None
+
+    # The texture image next to the file (see Utils3D.get_texture_file_name) or None. Only read when it is used
+    @property
+    def texture_image(self):
+        if not self._texture_read:
+            self._texture_image = Utils3D.multi_read_texture(self.file_name) if self.is_valid() else None
+            self._texture_read = True
+        return self._texture_image
+
+    def get_pre_transformation(self, include_scale=True):
+        cm = self.center_of_mass
+        translation = [-cm[0], -cm[1], -cm[2]]
+
+        t = vtk.vtkTransform()
+        t.Identity()
+
+        rx = self.config['pre-align']['rot_x']
+        ry = self.config['pre-align']['rot_y']
+        rz = self.config['pre-align']['rot_z']
+        # When rendering textured OBJ files the scale is handled by doing magic with the view frustrum
+        if include_scale:
+            s = self.config['pre-align']['scale']
+            t.Scale(s, s, s)
+        t.RotateY(ry)
+        t.RotateX(rx)
+        t.RotateZ(rz)
+        t.Translate(translation)
+        t.Update()
+        return t
+
+    # The surface transformed with the pre-transformation
+    def get_aligned_surface(self):
+        if self._aligned_polydata is None:
+            # Transform (assuming only one mesh)
+            trans = vtk.vtkTransformPolyDataFilter()
+            trans.SetInputData(self.polydata)
+            trans.SetTransform(self.pre_transform)
+            trans.Update()
+            self._aligned_polydata = trans.GetOutput()
+
+            if self.has_texture():
+                self._aligned_polydata.GetPointData().SetScalars(None)
+
+            if self.config['pre-align']['write_pre_aligned']:
+                name_out = str(self.config.temp_dir / ('pre_transform_mesh.vtk'))
+                writer = vtk.vtkPolyDataWriter()
+                writer.SetInputData(self._aligned_polydata)
+                writer.SetFileName(name_out)
+                writer.Write()
+        return self._aligned_polydata
+
+    # The pre-aligned surface with duplicate points merged. Used for projection of landmarks
+    def get_clean_surface(self):
+        if self._clean_polydata is None:
+            clean = vtk.vtkCleanPolyData()
+            clean.SetInputData(self.get_aligned_surface())
+            clean.Update()
+            self._clean_polydata = clean.GetOutput()
+        return self._clean_polydata
+
+    # The index of the surface used for closest point queries. It is in the coordinates of the file, so it does not
+    # depend on the pre-alignment. With process_3d.surface_index_dir the index is saved in that directory and read
+    # from there the next time the same (unchanged) file is used
+    def get_surface_index(self):
+        if self._surface_index is None:
+            index_dir = self.config['process_3d'].get('surface_index_dir')
+            index_name = os.path.join(index_dir, self.get_surface_index_name()) if index_dir else None
+            if index_name is not None and os.path.isfile(index_name):
+                try:
+                    self._surface_index = SurfaceIndex.load(index_name)
+                except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                    print('Could not read the surface index', index_name, ':', e)
+            if self._surface_index is None:
+                self._surface_index = SurfaceIndex.from_polydata(self.polydata)
+                if index_name is not None:
+                    os.makedirs(index_dir, exist_ok=True)
+                    # Written to a temporary file first, so other processes never read a partial index
+                    temp_name = index_name + '.' + str(os.getpid()) + '.tmp'
+                    with open(temp_name, 'wb') as f:
+                        self._surface_index.save(f)
+                    os.replace(temp_name, index_name)
+        return self._surface_index
+
+    # Name of the saved surface index of the file, which changes when the file or the index format is changed
+    def get_surface_index_name(self):
+        stat = os.stat(self.file_name)
+        key = '{}:{}:{}'.format(os.path.abspath(self.file_name), stat.st_size, stat.st_mtime_ns)
+        base_name = os.path.splitext(os.path.basename(self.file_name))[0]
+        return '{}_{}_v{}.npz'.format(base_name, hashlib.sha1(key.encode()).hexdigest()[:16],
+                                      SurfaceIndex.format_version)
+
+    # The actors of a textured OBJ file with one actor per material as created by the vtkOBJImporter
+    def get_obj_actors(self):
+        if self._obj_actors is None:
+            mtl_name = os.path.splitext(self.file_name)[0] + '.mtl'
+            obj_dir = os.path.dirname(self.file_name)
+            self._obj_importer = vtk.vtkOBJImporter()
+            self._obj_importer.SetFileName(self.file_name)
+            self._obj_importer.SetFileNameMTL(mtl_name)
+            self._obj_importer.SetTexturePath(obj_dir)
+            # The importer creates its own renderer that is only used as a container for the actors
+            self._obj_importer.Update()
+
+            self._obj_actors = []
+            actors = self._obj_importer.GetRenderer().GetActors()
+            actors.InitTraversal()
+            actor = actors.GetNextItem()
+            while actor:
+                self._obj_actors.append(actor)
+                actor = actors.GetNextItem()
+        return self._obj_actors
+
+    # The surface of the actors of a textured OBJ file as one polydata. The actors of the materials can share one
+    # set of points, which is then used once. Returns None when the file has no surface
+    def get_obj_surface(self):
+        surfaces = [actor.GetMapper().GetInput() for actor in self.get_obj_actors()]
+        surfaces = [pd for pd in surfaces if pd is not None and pd.GetNumberOfCells() > 0]
+        if len(surfaces) == 0:
+            return None
+        if len(surfaces) == 1:
+            return surfaces[0]
+
+        points = surfaces[0].GetPoints()
+        if all(pd.GetPoints() is points for pd in surfaces):
+            offsets = [np.zeros(1, dtype=np.int64)]
+            connectivity = []
+            for pd in surfaces:
+                polys = pd.GetPolys()
+                offsets.append(vtk.vtk_to_numpy(polys.GetOffsetsArray())[1:].astype(np.int64) +
+                               offsets[-1][-1])
+                connectivity.append(vtk.vtk_to_numpy(polys.GetConnectivityArray()).astype(np.int64))
+            polys = vtk.vtkCellArray()
+            polys.SetData(vtk.numpy_to_vtk(np.concatenate(offsets), deep=True, array_type=vtk.VTK_ID_TYPE),
+                          vtk.numpy_to_vtk(np.concatenate(connectivity), deep=True, array_type=vtk.VTK_ID_TYPE))
+            pd = vtk.vtkPolyData()
+            pd.SetPoints(points)
+            pd.GetPointData().ShallowCopy(surfaces[0].GetPointData())
+            pd.SetPolys(polys)
+            return pd
+
+        append = vtk.vtkAppendPolyData()
+        for pd in surfaces:
+            append.AddInputData(pd)
+        append.Update()
+        return append.GetOutput()
@@ -0,0 +1,201 @@
+import atexit
+import multiprocessing
+import os
+import pickle
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from utils3d.render3d import Render3D
+from utils3d.mesh3d import Mesh3D
+
+
+# Renders parts of the views of a scan. Each worker keeps its Render3D (and with that its offscreen render window)
+# and the last mesh it has used, so rendering more views of the same scan does not need the mesh again.
+# The tasks are received on the connection of the worker, with the pickled Mesh3D when the worker does not have it
+# yet or None when the worker reads the file itself. The views are rendered directly into the shared image stack
+# of the task and the first view is sent back (with None as the number of views when rendering failed)
+def _view_render_worker(config, conn):
+    render_3d = Render3D(config)
+    mesh = None
+    mesh_stamp = None
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        file_name, stamp, mesh_data, transform_stack, shm_name, shape, first_view = task
+        n_views = None
+        try:
+            if mesh_data is not None:
+                mesh = pickle.loads(mesh_data)
+                mesh_stamp = stamp
+            elif mesh is None or stamp is None or mesh_stamp != stamp:
+                mesh = Mesh3D(config, file_name)
+                mesh_stamp = stamp
+            shm = shared_memory.SharedMemory(name=shm_name)
+            shared_stack = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            image_stack, _ = render_3d.render_3d_file(
+                mesh, transform_stack, shared_stack[first_view:first_view + transform_stack.shape[0]])
+            if image_stack is not None:
+                n_views = transform_stack.shape[0]
+            del shared_stack, image_stack
+            shm.close()
+        except Exception as e:
+            print('Rendering failed for', file_name, ':', e)
+        conn.send((first_view, n_views))
+    conn.close()
+
+
+class ParallelRender3D:
+    """
+    Renders the views of one scan in a pool of worker processes, to lower the time spent on a single scan.
+
+    The views are split evenly between the workers. The workers are started once and live until close() is
+    called, each with its own offscreen render window and the last mesh it has used. A Mesh3D given to render_3d_file
+    is sent to the workers that do not have it yet, so the mesh file is only read once. The rendered views are written
+    directly into an image stack in shared memory, which is returned by render_3d_file. The returned image stack
+    is only valid until the next call of render_3d_file or close().
+    Each worker has its own connection. A worker that dies (a crash in VTK/OpenGL or the OOM killer) is replaced by a
+    new worker and render_3d_file returns None for the scan, instead of waiting forever.
+    """
+    # Seconds between the checks of the worker processes while waiting for the views
+    poll_interval = 1.0
+
+    def __init__(self, config, n_workers=None):
+        self.config = config
+        if n_workers is None:
+            n_workers = config['process_3d'].get('render_workers', 0)
+        if n_workers < 1:
+            n_workers = multiprocessing.cpu_count()
+        self.n_workers = n_workers
+        self.shm = None
+        self._retired_shm = []
+
+        # spawn is used since neither OpenGL contexts nor CUDA survive a fork
+        self.ctx = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.connections = []
+        # The (file name, modification time) of the mesh each worker has
+        self.worker_stamps = [None] * self.n_workers
+        for _ in range(self.n_workers):
+            p, conn = self.start_worker()
+            self.workers.append(p)
+            self.connections.append(conn)
+        atexit.register(self.close)
+
+    # This process holds no copy of the worker end of the connection, so a dead worker shows up as EOFError
+    def start_worker(self):
+        conn, worker_conn = self.ctx.Pipe()
+        p = self.ctx.Process(target=_view_render_worker, args=(self.config, worker_conn), daemon=True)
+        p.start()
+        worker_conn.close()
+        return p, conn
+
+    def restart_worker(self, idx):
+        self.workers[idx].join(self.poll_interval)
+        print('Render worker', idx, 'stopped with exit code', self.workers[idx].exitcode, '- starting a new worker')
+        self.connections[idx].close()
+        self.workers[idx], self.connections[idx] = self.start_worker()
+        self.worker_stamps[idx] = None
+
+    def generate_3d_transformations(self, n_views=None):
+        return Render3D(self.config).generate_3d_transformations(n_views)
+
+    def get_n_channels(self):
+        image_channels = self.config['data_loader']['args']['image_channels']
+        return sum(3 if channel == 'RGB' else 1 for channel in image_channels.split('+'))
+
+    # The shared image stack is reused when it is large enough
+    def get_shared_image_stack(self, shape):
+        n_bytes = int(np.prod(shape))
+        if self.shm is None or self.shm.size < n_bytes:
+            self.release_shared_memory()
+            self.shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    # An image stack returned by render_3d_file may still be in use, in which case the shared memory is unlinked
+    # now and unmapped in close()
+    def release_shared_memory(self):
+        if self.shm is not None:
+            self.shm.unlink()
+            self._retired_shm.append(self.shm)
+            self.shm = None
+        for shm in list(self._retired_shm):
+            try:
+                shm.close()
+                self._retired_shm.remove(shm)
+            except BufferError:
+                pass
+
+    # mesh is either a Mesh3D, which is sent to the workers that do not have it, or the name of a mesh file that the
+    # workers read
+    # transformation_stack: the views to render. When None n_views views are generated
+    def render_3d_file(self, mesh, transformation_stack=None):
+        file_name = mesh.file_name if isinstance(mesh, Mesh3D) else mesh
+        try:
+            stamp = (file_name, os.stat(file_name).st_mtime_ns)
+        except OSError:
+            stamp = None
+        mesh_data = None
+        if transformation_stack is None:
+            transformation_stack = Render3D(self.config).generate_3d_transformations()
+        n_views = transformation_stack.shape[0]
+        win_size = self.config['data_loader']['args']['image_size']
+        shape = (n_views, win_size, win_size, self.get_n_channels())
+
+        start = time.time()
+        image_stack = self.get_shared_image_stack(shape)
+        view_parts = [part for part in np.array_split(np.arange(n_views), self.n_workers) if len(part) > 0]
+        failed = False
+        pending = set()
+        for idx, part in enumerate(view_parts):
+            send_mesh = isinstance(mesh, Mesh3D) and (stamp is None or self.worker_stamps[idx] != stamp)
+            if send_mesh and mesh_data is None:
+                mesh_data = pickle.dumps(mesh, protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                self.connections[idx].send((file_name, stamp, mesh_data if send_mesh else None,
+                                            transformation_stack[part], self.shm.name, shape, part[0]))
+                self.worker_stamps[idx] = stamp
+                pending.add(idx)
+            except OSError:
+                self.restart_worker(idx)
+                failed = True
+
+        while pending:
+            ready = wait([self.connections[idx] for idx in pending], timeout=self.poll_interval)
+            for idx in list(pending):
+                if self.connections[idx] in ready:
+                    try:
+                        _, n_rendered = self.connections[idx].recv()
+                        failed = failed or n_rendered is None
+                    except (EOFError, OSError):
+                        self.restart_worker(idx)
+                        failed = True
+                    pending.discard(idx)
+                elif self.workers[idx].exitcode is not None:
+                    self.restart_worker(idx)
+                    failed = True
+                    pending.discard(idx)
+        end = time.time()
+        print('Rendered', n_views, 'views with', len(view_parts), 'workers in', end - start, 'seconds')
+        if failed:
+            return None, None
+        return image_stack, transformation_stack
+
+    def close(self):
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for p in self.workers:
+            p.join()
+        for conn in self.connections:
+            conn.close()
+        self.workers = []
+        self.connections = []
+        self.release_shared_memory()
+        atexit.unregister(self.close)
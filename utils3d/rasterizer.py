@@ -0,0 +1,237 @@
+"""
+Orthographic software rasterizer written in numpy, used as an alternative to the VTK/OpenGL rendering of the
+geometry and depth channels.
+
+The camera model is the one of Render3D.render_3d_multi_rgb_geometry_depth: a parallel projection of the
+VIEW_MIN to VIEW_MAX square seen from z = CAMERA_DISTANCE (see utils3d.utils3d), one headlight, Lambert shading of
+a white (or vertex colored) surface with two-sided lighting and the Z-buffer scaled to the depth range of the
+surface in the view. Since no OpenGL context is needed, it runs in any process and the views can be rendered in
+parallel.
+"""
+import numpy as np
+
+from utils3d import vtk_lazy as vtk
+from utils3d.utils3d import VIEW_MIN, VIEW_MAX
+
+
+# vertices: (n_points, 3) in view coordinates, where the camera looks down the negative z-axis
+# triangles: (n_triangles, 3) point ids
+# Returns for each pixel (with the first row at the top of the image) the id of the closest triangle (-1 for the
+# background), the z value and the barycentric coordinates of the pixel centre in the triangle. A pixel is covered
+# when its centre is inside the triangle
+def rasterize_triangles(vertices, triangles, win_size, x_min=VIEW_MIN, x_max=VIEW_MAX, y_min=VIEW_MIN, y_max=VIEW_MAX,
+                        max_fragments=1 << 22):
+    # Pixel coordinates where integer values are pixel centres
+    px = (vertices[:, 0] - x_min) / (x_max - x_min) * win_size - 0.5
+    py = (y_max - vertices[:, 1]) / (y_max - y_min) * win_size - 0.5
+    tx = px[triangles]
+    ty = py[triangles]
+    tz = vertices[triangles, 2]
+    area = (tx[:, 1] - tx[:, 0]) * (ty[:, 2] - ty[:, 0]) - (tx[:, 2] - tx[:, 0]) * (ty[:, 1] - ty[:, 0])
+
+    col_min = np.maximum(np.ceil(np.min(tx, axis=1)), 0).astype(np.int64)
+    col_max = np.minimum(np.floor(np.max(tx, axis=1)), win_size - 1).astype(np.int64)
+    row_min = np.maximum(np.ceil(np.min(ty, axis=1)), 0).astype(np.int64)
+    row_max = np.minimum(np.floor(np.max(ty, axis=1)), win_size - 1).astype(np.int64)
+    box_size = np.maximum(col_max - col_min, row_max - row_min) + 1
+    visible = np.nonzero((area != 0) & (col_max >= col_min) & (row_max >= row_min))[0]
+
+    # The triangles are rasterized in groups with the same (power of two) size of the pixel grid covering them
+    grid_sizes = 2 ** np.ceil(np.log2(box_size[visible])).astype(np.int64)
+    fragment_ids = []
+    fragment_pixels = []
+    fragment_z = []
+    fragment_w = []
+    for grid_size in np.unique(grid_sizes):
+        group = visible[grid_sizes == grid_size]
+        offsets = np.arange(grid_size)
+        n_chunk = max(1, max_fragments // (grid_size * grid_size))
+        for start in range(0, len(group), n_chunk):
+            ids = group[start:start + n_chunk]
+            cols = col_min[ids, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+            rows = row_min[ids, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+            x = tx[ids, :, np.newaxis, np.newaxis]
+            y = ty[ids, :, np.newaxis, np.newaxis]
+            a = area[ids, np.newaxis, np.newaxis]
+            w0 = ((x[:, 1] - cols) * (y[:, 2] - rows) - (x[:, 2] - cols) * (y[:, 1] - rows)) / a
+            w1 = ((x[:, 2] - cols) * (y[:, 0] - rows) - (x[:, 0] - cols) * (y[:, 2] - rows)) / a
+            w2 = 1 - w0 - w1
+            inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0) & \
+                (cols <= col_max[ids, np.newaxis, np.newaxis]) & (rows <= row_max[ids, np.newaxis, np.newaxis])
+            t_idx, r_idx, c_idx = np.nonzero(inside)
+            w = np.stack((w0[t_idx, r_idx, c_idx], w1[t_idx, r_idx, c_idx], w2[t_idx, r_idx, c_idx]), axis=1)
+            tri = ids[t_idx]
+            fragment_ids.append(tri)
+            fragment_pixels.append((row_min[tri] + r_idx) * win_size + col_min[tri] + c_idx)
+            fragment_z.append(np.sum(w * tz[tri], axis=1))
+            fragment_w.append(w)
+
+    triangle_id = np.full(win_size * win_size, -1, dtype=np.int64)
+    z_buffer = np.full(win_size * win_size, -np.inf)
+    barycentric = np.zeros((win_size * win_size, 3))
+    if fragment_ids:
+        fragment_ids = np.concatenate(fragment_ids)
+        fragment_pixels = np.concatenate(fragment_pixels)
+        fragment_z = np.concatenate(fragment_z)
+        fragment_w = np.concatenate(fragment_w)
+        # Keep the fragment closest to the camera (highest z) in each pixel
+        order = np.lexsort((-fragment_z, fragment_pixels))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = fragment_pixels[order[1:]] != fragment_pixels[order[:-1]]
+        closest = order[first]
+        pixels = fragment_pixels[closest]
+        triangle_id[pixels] = fragment_ids[closest]
+        z_buffer[pixels] = fragment_z[closest]
+        barycentric[pixels] = fragment_w[closest]
+    shape = (win_size, win_size)
+    return triangle_id.reshape(shape), z_buffer.reshape(shape), barycentric.reshape(shape + (3,))
+
+
+class SoftwareRenderer:
+    """
+    Renders the 'geometry' and 'depth' channels of a surface with rasterize_triangles.
+
+    geometry: Lambert shading with a headlight and two-sided lighting of the surface colored as the VTK mapper
+    colors it (RGB(A) unsigned char scalars as they are, other scalars through the default lookup table, white if
+    it has no scalars) using the interpolated point normals, or the triangle normals when the surface has no point
+    normals. The first channel of the shaded image is used.
+    depth: the Z-buffer as 0 at z_max + slack and 1 at z_min - slack, converted to unsigned char by
+    vtkImageShiftScale with a scale of -255 (which wraps around, so the background is 1).
+
+    The VTK render windows use multisampling, so the surface is sampled at the positions of the standard 4x
+    multisample pattern. The geometry is the average of the samples (which smooths the silhouette) and the depth
+    is the depth of the first sample, as read from a multisampled Z-buffer. multi_samples=1 samples the
+    pixel centres, which is faster.
+    """
+    # Sample positions of the 4x multisample pattern relative to the pixel centre (x to the right, y up)
+    sample_offsets_4x = [(-0.125, -0.375), (0.375, -0.125), (-0.375, 0.125), (0.125, 0.375)]
+    # The largest accepted differences to the VTK renderings of the same views (see check_parity). The pixels within
+    # parity_silhouette_width pixels of the silhouette are left out, since the edges are sampled differently there
+    parity_silhouette_width = 2
+    parity_max_mean_difference = 0.25
+    parity_large_difference = 16
+    parity_max_large_fraction = 1e-4
+
+    def __init__(self, pd, win_size, slack=5, multi_samples=4):
+        self.win_size = win_size
+        self.slack = slack
+        self.sample_offsets = self.sample_offsets_4x if multi_samples == 4 else [(0, 0)]
+
+        # Polygons and triangle strips are split into triangles
+        triangle_filter = vtk.vtkTriangleFilter()
+        triangle_filter.SetInputData(pd)
+        triangle_filter.PassVertsOff()
+        triangle_filter.PassLinesOff()
+        triangle_filter.Update()
+        triangulated = triangle_filter.GetOutput()
+
+        self.points = vtk.vtk_to_numpy(triangulated.GetPoints().GetData()).astype(np.float64)
+        self.triangles = vtk.vtk_to_numpy(triangulated.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
+        normals = triangulated.GetPointData().GetNormals()
+        self.normals = vtk.vtk_to_numpy(normals).astype(np.float64) if normals is not None else None
+
+        # The colors are made by a VTK mapper, so scalars are colored as in the VTK renderings. Point colors are
+        # interpolated over the triangles and cell colors are constant
+        self.colors = None
+        self.cell_colors = None
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputData(triangulated)
+        colors = mapper.MapScalars(1.0)
+        if colors is not None:
+            red = vtk.vtk_to_numpy(colors)[:, 0] / 255
+            if len(red) == len(self.points):
+                self.colors = red
+            elif len(red) == len(self.triangles):
+                self.cell_colors = red
+
+    # rotation: the view rotation (3, 3). z_min, z_max: depth range of the surface in the view
+    # Returns an unsigned char image (win_size, win_size, n_channels) with the channels in the given order
+    def render(self, rotation, z_min, z_max, channels):
+        for channel in channels:
+            if channel not in ['geometry', 'depth']:
+                raise ValueError('The software renderer can not render the channel ' + str(channel))
+
+        vertices = np.dot(self.points, rotation.T)
+        x_min = VIEW_MIN
+        x_max = VIEW_MAX
+        y_min = VIEW_MIN
+        y_max = VIEW_MAX
+        pixel_size = (x_max - x_min) / self.win_size
+
+        geometry = np.zeros((self.win_size, self.win_size))
+        depth = None
+        for offset_x, offset_y in self.sample_offsets:
+            triangle_id, z_buffer, barycentric = rasterize_triangles(
+                vertices, self.triangles, self.win_size, x_min + offset_x * pixel_size, x_max + offset_x * pixel_size,
+                y_min + offset_y * pixel_size, y_max + offset_y * pixel_size)
+            foreground = triangle_id >= 0
+            if 'geometry' in channels:
+                tri = self.triangles[triangle_id[foreground]]
+                w = barycentric[foreground]
+                intensity = self.shade(vertices, tri, w, rotation)
+                if self.colors is not None:
+                    intensity = intensity * np.sum(w * self.colors[tri], axis=1)
+                elif self.cell_colors is not None:
+                    intensity = intensity * self.cell_colors[triangle_id[foreground]]
+                sample = np.ones((self.win_size, self.win_size))
+                sample[foreground] = intensity
+                geometry += sample
+            if depth is None:
+                depth = np.ones((self.win_size, self.win_size))
+                depth[foreground] = (z_max + self.slack - z_buffer[foreground]) / (z_max - z_min + 2 * self.slack)
+
+        image = np.zeros((self.win_size, self.win_size, len(channels)), dtype=np.uint8)
+        for idx, channel in enumerate(channels):
+            if channel == 'geometry':
+                image[:, :, idx] = np.round(geometry / len(self.sample_offsets) * 255)
+            else:
+                # The cast of a negative value to unsigned char in vtkImageShiftScale keeps the lowest 8 bits
+                image[:, :, idx] = np.trunc(-255 * depth).astype(np.int64) & 0xFF
+        return image
+
+    # Diffuse lighting from a light at the camera. Back facing triangles are lit from behind (two-sided lighting)
+    def shade(self, vertices, tri, w, rotation):
+        v0 = vertices[tri[:, 0]]
+        face_normals = np.cross(vertices[tri[:, 1]] - v0, vertices[tri[:, 2]] - v0)
+        if self.normals is None:
+            return np.abs(face_normals[:, 2]) / np.maximum(np.linalg.norm(face_normals, axis=1), 1e-12)
+        normals = np.einsum('fk,fkj->fj', w, self.normals[tri])
+        normals = np.dot(normals, rotation.T)
+        facing = np.where(face_normals[:, 2] < 0, -1, 1)
+        cos_angle = facing * normals[:, 2] / np.maximum(np.linalg.norm(normals, axis=1), 1e-12)
+        return np.maximum(cos_angle, 0)
+
+    # Differences between software renderings and VTK renderings of the same views, both (n_views, win_size,
+    # win_size) unsigned char images of one channel. foreground: (n_views, win_size, win_size) mask of the surface
+    # in the VTK renderings. Returns a dict with the mean absolute difference and the fraction of pixels that differ
+    # by more than parity_large_difference grey levels, over all pixels and away from the silhouette
+    @staticmethod
+    def parity(images, images_vtk, foreground):
+        from scipy import ndimage
+
+        diff = np.abs(images.astype(np.int64) - images_vtk.astype(np.int64))
+        width = SoftwareRenderer.parity_silhouette_width
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[1] = ndimage.generate_binary_structure(2, 1)
+        silhouette = ndimage.binary_dilation(foreground, structure, width) & \
+            ~ndimage.binary_erosion(foreground, structure, width, border_value=1)
+        large = diff > SoftwareRenderer.parity_large_difference
+        return {'mean_difference': np.mean(diff), 'large_fraction': np.mean(large),
+                'mean_difference_off_silhouette': np.mean(diff[~silhouette]),
+                'large_fraction_off_silhouette': np.mean(large[~silhouette]),
+                'silhouette_fraction': np.mean(silhouette)}
+
+    # Raises a RuntimeError when the differences away from the silhouette (see parity) are larger than accepted
+    @staticmethod
+    def check_parity(images, images_vtk, foreground):
+        stats = SoftwareRenderer.parity(images, images_vtk, foreground)
+        if stats['mean_difference_off_silhouette'] > SoftwareRenderer.parity_max_mean_difference or \
+                stats['large_fraction_off_silhouette'] > SoftwareRenderer.parity_max_large_fraction:
+            raise RuntimeError('The software renderings differ from the VTK renderings: mean difference {:.3f} grey '
+                               'levels (at most {}), {:.4%} of the pixels off by more than {} grey levels (at most '
+                               '{:.4%}) away from the silhouette'.format(
+                                   stats['mean_difference_off_silhouette'], SoftwareRenderer.parity_max_mean_difference,
+                                   stats['large_fraction_off_silhouette'], SoftwareRenderer.parity_large_difference,
+                                   SoftwareRenderer.parity_max_large_fraction))
+        return stats
@@ -1,13 +1,16 @@
 import math
 
-import vtk
+from utils3d import vtk_lazy as vtk
 import numpy as np
 import time
 # from tqdm import tqdm
-from vtk.util.numpy_support import vtk_to_numpy
 import os
 
 from utils3d import Utils3D
+from utils3d.utils3d import VIEW_MIN, VIEW_MAX, CAMERA_DISTANCE
+from utils3d.mesh3d import Mesh3D
+from utils3d.viewset import ViewSet
+from utils3d.rasterizer import SoftwareRenderer
 
 
 def no_transform():
@@ -24,6 +27,50 @@ class Render3D:
     def __init__(self, config):
         self.config = config
         self.logger = config.get_logger('Render3D')
+        self._ren_win = None
+        self._readback_buffers = None
+
+    # The render window is created the first time it is needed and reused by all renderings of this Render3D,
+    # since creating the (offscreen) OpenGL context is slow
+    def get_render_window(self):
+        if self._ren_win is None:
+            win_size = self.config['data_loader']['args']['image_size']
+            self._ren_win = vtk.vtkRenderWindow()
+            self._ren_win.SetSize(win_size, win_size)
+            self._ren_win.SetOffScreenRendering(self.config['process_3d']['off_screen_rendering'])
+        return self._ren_win
+
+    # Buffers for reading the pixels and the Z-buffer of the render window. The VTK arrays share the memory of the
+    # numpy arrays, so the render window writes directly into them
+    def get_readback_buffers(self):
+        if self._readback_buffers is None:
+            win_size = self.config['data_loader']['args']['image_size']
+            pixels = np.zeros((win_size, win_size, 3), dtype=np.uint8)
+            pixel_array = vtk.vtkUnsignedCharArray()
+            pixel_array.SetNumberOfComponents(3)
+            pixel_array.SetVoidArray(pixels, pixels.size, 1)
+            z_buffer = np.zeros((win_size, win_size), dtype=np.float32)
+            z_array = vtk.vtkFloatArray()
+            z_array.SetVoidArray(z_buffer, z_buffer.size, 1)
+            self._readback_buffers = (pixels, pixel_array, z_buffer, z_array)
+        return self._readback_buffers
+
+    # Reads the RGB pixels of the last rendering into the image stack. The rows are flipped while copying, since
+    # OpenGL images start at the bottom
+    def read_pixels(self, ren_win, image_stack, view, first_channel, n_channels):
+        pixels, pixel_array, _, _ = self.get_readback_buffers()
+        rows, cols, _ = pixels.shape
+        ren_win.GetPixelData(0, 0, cols - 1, rows - 1, 1, pixel_array, 0)
+        image_stack[view, ::-1, :, first_channel:first_channel + n_channels] = pixels[:, :, 0:n_channels]
+
+    # Reads the Z-buffer of the last rendering into a channel of the image stack. The values are the ones of
+    # vtkImageShiftScale with a scale of -255, where the cast of a negative value to unsigned char keeps the lowest
+    # 8 bits (so the background is 1)
+    def read_depth(self, ren_win, image_stack, view, channel):
+        _, _, z_buffer, z_array = self.get_readback_buffers()
+        rows, cols = z_buffer.shape
+        ren_win.GetZbufferData(0, 0, cols - 1, rows - 1, z_array)
+        image_stack[view, ::-1, :, channel] = np.trunc(-255 * z_buffer.astype(np.float64)).astype(np.int64) & 0xFF
 
     def random_transform(self):
         min_x = self.config['process_3d']['min_x_angle']
@@ -33,19 +80,22 @@ class Render3D:
         min_z = self.config['process_3d']['min_z_angle']
         max_z = self.config['process_3d']['max_z_angle']
 
-        rx = np.double(np.random.randint(min_x, max_x, 1))
-        ry = np.double(np.random.randint(min_y, max_y, 1))
-        rz = np.double(np.random.randint(min_z, max_z, 1))
+        rx = np.double(np.random.randint(min_x, max_x))
+        ry = np.double(np.random.randint(min_y, max_y))
+        rz = np.double(np.random.randint(min_z, max_z))
         # the following values are currently not used
-        scale = np.double(np.random.uniform(1.4, 1.9, 1))
-        tx = np.double(np.random.randint(-20, 20, 1))
-        ty = np.double(np.random.randint(-20, 20, 1))
+        scale = np.double(np.random.uniform(1.4, 1.9))
+        tx = np.double(np.random.randint(-20, 20))
+        ty = np.double(np.random.randint(-20, 20))
 
         return rx, ry, rz, scale, tx, ty
 
     # Generate nview 3D transformations and return them as a stack
-    def generate_3d_transformations(self):
-        n_views = self.config['data_loader']['args']['n_views']
+    def generate_3d_transformations(self, n_views=None):
+        if n_views is None:
+            n_views = self.config['data_loader']['args']['n_views']
+        if self.config['process_3d'].get('view_set', 'halton') == 'halton':
+            return ViewSet.generate_halton_transformations(self.config, n_views)
         transform_stack = np.zeros((n_views, 6), dtype=np.float32)
 
         for idx in range(n_views):
@@ -54,57 +104,24 @@ class Render3D:
 
         return transform_stack
 
-    def compute_pre_transformation(self, file_name):
-        translation = [0, 0, 0]
-        if self.config['pre-align']['align_center_of_mass']:
-            # hack to avoid how the objimporter deals with multiple polydata
-            pd = Utils3D.multi_read_surface(file_name)
-            if pd.GetNumberOfPoints() < 1:
-                print('Could not read', file_name)
-                return None
-
-            vtk_cm = vtk.vtkCenterOfMass()
-            vtk_cm.SetInputData(pd)
-            vtk_cm.SetUseScalarsAsWeights(False)
-            vtk_cm.Update()
-            cm = vtk_cm.GetCenter()
-            translation = [-cm[0], -cm[1], -cm[2]]
-
-        t = vtk.vtkTransform()
-        t.Identity()
-
-        rx = self.config['pre-align']['rot_x']
-        ry = self.config['pre-align']['rot_y']
-        rz = self.config['pre-align']['rot_z']
-        # Scale is handling by doing magic with the view frustrum elsewhere
-        # s = self.config['pre-align']['scale']
-
-        # t.Scale(s, s, s)
-        t.RotateY(ry)
-        t.RotateX(rx)
-        t.RotateZ(rz)
-        t.Translate(translation)
-        t.Update()
-
-        return t
-
-    def render_3d_obj_rgb(self, transform_stack, file_name):
+    # Renders the actors of a textured (multi material) OBJ file. channels: 'RGB' and optionally 'depth' (the Z-buffer)
+    # in the order they are put in the image stack. Both are read from the same rendering of each view
+    # image_stack: when given the views are rendered into it instead of into a new image stack
+    def render_3d_obj(self, transform_stack, mesh, channels=('RGB',), image_stack=None):
         write_image_files = self.config['process_3d']['write_renderings']
-        off_screen_rendering = self.config['process_3d']['off_screen_rendering']
-        n_views = self.config['data_loader']['args']['n_views']
+        n_views = transform_stack.shape[0]
         img_size = self.config['data_loader']['args']['image_size']
         win_size = img_size
+        slack = 5
 
-        n_channels = 3
-        image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
-
-        mtl_name = os.path.splitext(file_name)[0] + '.mtl'
-        obj_dir = os.path.dirname(file_name)
-        obj_in = vtk.vtkOBJImporter()
-        obj_in.SetFileName(file_name)
-        obj_in.SetFileNameMTL(mtl_name)
-        obj_in.SetTexturePath(obj_dir)
-        obj_in.Update()
+        channel_sizes = {'RGB': 3, 'depth': 1}
+        first_channels = {}
+        n_channels = 0
+        for channel in channels:
+            first_channels[channel] = n_channels
+            n_channels += channel_sizes[channel]
+        if image_stack is None:
+            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.uint8)
 
         # Initialize Camera
         ren = vtk.vtkRenderer()
@@ -115,152 +132,153 @@ class Render3D:
         ren.GetActiveCamera().SetParallelProjection(1)
 
         # Initialize RenderWindow
-        ren_win = vtk.vtkRenderWindow()
+        ren_win = self.get_render_window()
         ren_win.AddRenderer(ren)
-        ren_win.SetSize(win_size, win_size)
-        ren_win.SetOffScreenRendering(off_screen_rendering)
-
-        obj_in.SetRenderWindow(ren_win)
-        obj_in.Update()
-
-        props = vtk.vtkProperty()
-        props.SetDiffuse(0)
-        props.SetSpecular(0)
-        props.SetAmbient(1)
+        # The render window is kept, so the renderer is removed again also when rendering fails
+        try:
 
-        actors = ren.GetActors()
-        actors.InitTraversal()
-        actor = actors.GetNextItem()
-        while actor:
-            actor.SetProperty(props)
-            actor = actors.GetNextItem()
-        del props
+            props = vtk.vtkProperty()
+            props.SetDiffuse(0)
+            props.SetSpecular(0)
+            props.SetAmbient(1)
 
-        t_pre_trans = self.compute_pre_transformation(file_name)
+            for actor in mesh.get_obj_actors():
+                actor.SetProperty(props)
+                ren.AddActor(actor)
+            del props
 
-        t = vtk.vtkTransform()
-        t.Identity()
-        t.Update()
-
-        w2if = vtk.vtkWindowToImageFilter()
-        w2if.SetInput(ren_win)
-        writer_png = vtk.vtkPNGWriter()
-        writer_png.SetInputConnection(w2if.GetOutputPort())
-
-        start = time.time()
-        # for idx in tqdm(range(n_views)):
-        for idx in range(n_views):
-            name_rendering = self.config.temp_dir / ('rendering' + str(idx) + '_RGB.png')
+            # Scale is handled by doing magic with the view frustrum
+            t_pre_trans = mesh.get_pre_transformation(include_scale=False)
+            s = self.config['pre-align']['scale']
 
-            rx, ry, rz, s, tx, ty = transform_stack[idx]
-            # rx,ry,rz,s,tx,ty = no_transform() # debug
-            # rx = -20
-            # ry = 40
-            # rz = 10
+            # The Z-buffer is scaled to the depth range of the view as in render_3d_multi_rgb_geometry_depth. The depth
+            # range is found from the pre-aligned (and scaled) surface and divided by the scale, since the camera is
+            # moved around the unscaled OBJ file
+            if 'depth' in channels:
+                depth_ranges = self.get_view_depth_ranges(mesh.get_aligned_surface(), transform_stack)
 
+            t = vtk.vtkTransform()
             t.Identity()
-            t.RotateY(ry)
-            t.RotateX(rx)
-            t.RotateZ(rz)
-            t.Concatenate(t_pre_trans)
             t.Update()
 
-            xmin = -150
-            xmax = 150
-            ymin = -150
-            ymax = 150
-            xlen = xmax - xmin
-            ylen = ymax - ymin
-
-            cx = 0
-            cy = 0
-            # extend_factor = 1.0
-            s = self.config['pre-align']['scale']
-            extend_factor = 1.0 / s
-            # The side length of the view frustrum which is rectangular since we use a parallel projection
-            side_length = max([xlen, ylen]) * extend_factor
-            # zoom_factor = win_size / side_length
-
-            ren.GetActiveCamera().SetParallelScale(side_length / 2)
-            ren.GetActiveCamera().SetPosition(cx, cy, 500)
-            ren.GetActiveCamera().SetFocalPoint(cx, cy, 0)
-            ren.GetActiveCamera().SetViewUp(0, 1, 0)
-            ren.GetActiveCamera().ApplyTransform(t.GetInverse())
-            ren.ResetCameraClippingRange()  # This approach is not recommended when doing depth rendering
-
-            ren_win.Render()
-
+            # The images are read directly from the render window into the image stack. The image files are written
+            # from the last rendering instead of rendering the window again
             if write_image_files:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                writer_png.SetFileName(str(name_rendering))
-                writer_png.Write()
-            else:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                w2if.Update()
-
-            # add rendering to image stack
-            im = w2if.GetOutput()
-            rows, cols, _ = im.GetDimensions()
-            sc = im.GetPointData().GetScalars()
-            a = vtk_to_numpy(sc)
-            components = sc.GetNumberOfComponents()
-            a = a.reshape(rows, cols, components)
-            a = np.flipud(a)
-
-            image_stack[idx, :, :, :] = a[:, :, :]
+                w2if = vtk.vtkWindowToImageFilter()
+                w2if.SetInput(ren_win)
+                w2if.ShouldRerenderOff()
+                writer_png = vtk.vtkPNGWriter()
+                writer_png.SetInputConnection(w2if.GetOutputPort())
+
+                scale = vtk.vtkImageShiftScale()
+                scale.SetOutputScalarTypeToUnsignedChar()
+                scale.SetInputConnection(w2if.GetOutputPort())
+                scale.SetShift(0)
+                scale.SetScale(-255)
+
+                writer_png_2 = vtk.vtkPNGWriter()
+                writer_png_2.SetInputConnection(scale.GetOutputPort())
+
+            start = time.time()
+            # for idx in tqdm(range(n_views)):
+            for idx in range(n_views):
+                rx, ry, rz, _, tx, ty = transform_stack[idx]
+                # rx,ry,rz,s,tx,ty = no_transform() # debug
+                # rx = -20
+                # ry = 40
+                # rz = 10
+
+                t.Identity()
+                t.RotateY(ry)
+                t.RotateX(rx)
+                t.RotateZ(rz)
+                t.Concatenate(t_pre_trans)
+                t.Update()
+
+                xmin = VIEW_MIN
+                xmax = VIEW_MAX
+                ymin = VIEW_MIN
+                ymax = VIEW_MAX
+                xlen = xmax - xmin
+                ylen = ymax - ymin
+
+                cx = 0
+                cy = 0
+                # extend_factor = 1.0
+                extend_factor = 1.0 / s
+                # The side length of the view frustrum which is rectangular since we use a parallel projection
+                side_length = max([xlen, ylen]) * extend_factor
+                # zoom_factor = win_size / side_length
+
+                ren.GetActiveCamera().SetParallelScale(side_length / 2)
+                ren.GetActiveCamera().SetPosition(cx, cy, CAMERA_DISTANCE)
+                ren.GetActiveCamera().SetFocalPoint(cx, cy, 0)
+                ren.GetActiveCamera().SetViewUp(0, 1, 0)
+                ren.GetActiveCamera().ApplyTransform(t.GetInverse())
+                if 'depth' in channels:
+                    zmin, zmax = depth_ranges[idx]
+                    ren.GetActiveCamera().SetClippingRange(CAMERA_DISTANCE - (zmax + slack) / s,
+                                                          CAMERA_DISTANCE - (zmin - slack) / s)
+                else:
+                    ren.ResetCameraClippingRange()  # This approach is not recommended when doing depth rendering
+
+                ren_win.Render()
+
+                if 'RGB' in channels:
+                    self.read_pixels(ren_win, image_stack, idx, first_channels['RGB'], 3)
+                    if write_image_files:
+                        w2if.SetInputBufferTypeToRGB()
+                        w2if.Modified()  # Needed here else only first rendering is put to file
+                        name_rendering = self.config.temp_dir / ('rendering' + str(idx) + '_RGB.png')
+                        writer_png.SetFileName(str(name_rendering))
+                        writer_png.Write()
+
+                if 'depth' in channels:
+                    self.read_depth(ren_win, image_stack, idx, first_channels['depth'])
+                    if write_image_files:
+                        w2if.SetInputBufferTypeToZBuffer()
+                        w2if.Modified()
+                        name_depth = self.config.temp_dir / ('rendering' + str(idx) + '_zbuffer.png')
+                        writer_png_2.SetFileName(str(name_depth))
+                        writer_png_2.Write()
+
+            end = time.time()
+            print("OBJ rendering time: " + str(end - start))
 
-        end = time.time()
-        print("Pure RGB rendering time: " + str(end - start))
-
-        del obj_in
-        del writer_png, w2if
-        del ren, ren_win, t
+            if write_image_files:
+                del writer_png_2, writer_png, scale, w2if
+        finally:
+            for actor in mesh.get_obj_actors():
+                ren.RemoveActor(actor)
+            ren_win.RemoveRenderer(ren)
+        del ren, t
         return image_stack
 
-    def apply_pre_transformation(self, pd):
-        translation = [0, 0, 0]
-        if self.config['pre-align']['align_center_of_mass']:
-            vtk_cm = vtk.vtkCenterOfMass()
-            vtk_cm.SetInputData(pd)
-            vtk_cm.SetUseScalarsAsWeights(False)
-            vtk_cm.Update()
-            cm = vtk_cm.GetCenter()
-            translation = [-cm[0], -cm[1], -cm[2]]
-
-        t = vtk.vtkTransform()
-        t.Identity()
-
-        rx = self.config['pre-align']['rot_x']
-        ry = self.config['pre-align']['rot_y']
-        rz = self.config['pre-align']['rot_z']
-        s = self.config['pre-align']['scale']
-
-        t.Scale(s, s, s)
-        t.RotateY(ry)
-        t.RotateX(rx)
-        t.RotateZ(rz)
-        t.Translate(translation)
-        t.Update()
-
-        # Transform (assuming only one mesh)
-        trans = vtk.vtkTransformPolyDataFilter()
-        trans.SetInputData(pd)
-        trans.SetTransform(t)
-        trans.Update()
-
-        if self.config['pre-align']['write_pre_aligned']:
-            name_out = str(self.config.temp_dir / ('pre_transform_mesh.vtk'))
-            writer = vtk.vtkPolyDataWriter()
-            writer.SetInputData(trans.GetOutput())
-            writer.SetFileName(name_out)
-            writer.Write()
-
-        return trans.GetOutput()
-
-    def render_3d_multi_rgb_geometry_depth(self, transform_stack, file_name):
+    # The depth range (z_min, z_max) of the surface in each view. The same as the z bounds of the surface transformed
+    # with the view rotations, found by projecting the points on the view directions instead of transforming the surface
+    # All views are done at once for blocks of points
+    @staticmethod
+    def get_view_depth_ranges(pd, transform_stack, block_size=1 << 16):
+        points = vtk.vtk_to_numpy(pd.GetPoints().GetData())
+        directions = Utils3D.get_view_rotation_matrices(transform_stack)[:, 2, :].astype(points.dtype)
+        n_views = transform_stack.shape[0]
+        depth_ranges = np.zeros((n_views, 2))
+        depth_ranges[:, 0] = np.inf
+        depth_ranges[:, 1] = -np.inf
+        for start in range(0, points.shape[0], block_size):
+            z = np.dot(points[start:start + block_size], directions.T)
+            depth_ranges[:, 0] = np.minimum(depth_ranges[:, 0], np.min(z, axis=0))
+            depth_ranges[:, 1] = np.maximum(depth_ranges[:, 1], np.max(z, axis=0))
+        return depth_ranges
+
+    # channels: the images to render for each view in the order they are put in the image stack. 'RGB' (3 channels)
+    # is the textured or colored surface, 'geometry' (1 channel) the shaded surface and 'depth' (1 channel) the
+    # Z-buffer. Only the passes needed for the channels are rendered and the Z-buffer is read from the last pass
+    # image_stack: when given the views are rendered into it instead of into a new image stack
+    def render_3d_multi_rgb_geometry_depth(self, transform_stack, mesh, channels=('RGB', 'geometry', 'depth'),
+                                           image_stack=None):
         write_image_files = self.config['process_3d']['write_renderings']
-        off_screen_rendering = self.config['process_3d']['off_screen_rendering']
-        n_views = self.config['data_loader']['args']['n_views']
+        n_views = transform_stack.shape[0]
         img_size = self.config['data_loader']['args']['image_size']
         win_size = img_size
         slack = 5
@@ -268,19 +286,23 @@ class Render3D:
         start = time.time()
         self.logger.debug('Rendering')
 
-        n_channels = 5  # 3 for RGB, 1 for depth and 1 for geometry
-        image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
+        channel_sizes = {'RGB': 3, 'geometry': 1, 'depth': 1}
+        first_channels = {}
+        n_channels = 0
+        for channel in channels:
+            first_channels[channel] = n_channels
+            n_channels += channel_sizes[channel]
+        if image_stack is None:
+            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.uint8)
 
-        pd = Utils3D.multi_read_surface(file_name)
-        if pd.GetNumberOfPoints() < 1:
-            print('Could not read', file_name)
+        if not mesh.is_valid():
             return None
 
-        pd = self.apply_pre_transformation(pd)
+        pd = mesh.get_aligned_surface()
 
-        texture_img = Utils3D.multi_read_texture(file_name)
+        # The texture is only read when the RGB channels are rendered
+        texture_img = mesh.texture_image if 'RGB' in channels else None
         if texture_img is not None:
-            pd.GetPointData().SetScalars(None)
             texture = vtk.vtkTexture()
             texture.SetInterpolate(1)
             texture.SetQualityTo32Bit()
@@ -295,243 +317,200 @@ class Render3D:
         ren.GetActiveCamera().SetParallelProjection(1)
 
         # Initialize RenderWindow
-        ren_win = vtk.vtkRenderWindow()
+        ren_win = self.get_render_window()
         ren_win.AddRenderer(ren)
-        ren_win.SetSize(win_size, win_size)
-        ren_win.SetOffScreenRendering(off_screen_rendering)
-
-        t = vtk.vtkTransform()
-        t.Identity()
-        t.Update()
-
-        # Transform (assuming only one mesh)
-        trans = vtk.vtkTransformPolyDataFilter()
-        trans.SetInputData(pd)
-        trans.SetTransform(t)
-        trans.Update()
-
-        mapper = vtk.vtkPolyDataMapper()
-        mapper.SetInputData(trans.GetOutput())
-
-        actor_text = vtk.vtkActor()
-        actor_text.SetMapper(mapper)
-        if texture_img is not None:
-            actor_text.SetTexture(texture)
-            actor_text.GetProperty().SetColor(1, 1, 1)
-            actor_text.GetProperty().SetAmbient(1.0)
-            actor_text.GetProperty().SetSpecular(0)
-            actor_text.GetProperty().SetDiffuse(0)
-        ren.AddActor(actor_text)
-
-        actor_geometry = vtk.vtkActor()
-        actor_geometry.SetMapper(mapper)
-        ren.AddActor(actor_geometry)
-
-        w2if = vtk.vtkWindowToImageFilter()
-        w2if.SetInput(ren_win)
-        writer_png = vtk.vtkPNGWriter()
-        writer_png.SetInputConnection(w2if.GetOutputPort())
-
-        scale = vtk.vtkImageShiftScale()
-        scale.SetOutputScalarTypeToUnsignedChar()
-        scale.SetInputConnection(w2if.GetOutputPort())
-        scale.SetShift(0)
-        scale.SetScale(-255)
-
-        writer_png_2 = vtk.vtkPNGWriter()
-        writer_png_2.SetInputConnection(scale.GetOutputPort())
-
-        for view in range(n_views):
-            name_rgb = str(self.config.temp_dir / ('rendering' + str(view) + '_RGB.png'))
-            name_depth = str(self.config.temp_dir / ('rendering' + str(view) + '_zbuffer.png'))
-            name_geometry = str(self.config.temp_dir / ('rendering' + str(view) + '_geometry.png'))
-
-            # print('Rendering ', name_rgb)
-            rx, ry, rz, s, tx, ty = transform_stack[view]
+        # The render window is kept, so the renderer is removed again also when rendering fails
+        try:
 
+            # The surface stays in place and the camera is moved around it for each view
+            t = vtk.vtkTransform()
             t.Identity()
-            t.RotateY(ry)
-            t.RotateX(rx)
-            t.RotateZ(rz)
             t.Update()
-            trans.Update()
-
-            xmin = -150
-            xmax = 150
-            ymin = -150
-            ymax = 150
-            zmin = trans.GetOutput().GetBounds()[4]
-            zmax = trans.GetOutput().GetBounds()[5]
-            xlen = xmax - xmin
-            ylen = ymax - ymin
-
-            cx = 0
-            cy = 0
-            extend_factor = 1.0
-            side_length = max([xlen, ylen]) * extend_factor
-            # zoom_fac = win_size / side_length
-
-            ren.GetActiveCamera().SetParallelScale(side_length / 2)
-            ren.GetActiveCamera().SetPosition(cx, cy, 500)
-            ren.GetActiveCamera().SetFocalPoint(cx, cy, 0)
-            ren.GetActiveCamera().SetClippingRange(500 - zmax - slack, 500 - zmin + slack)
-
-            # Save textured image
-            w2if.SetInputBufferTypeToRGB()
-
-            actor_geometry.SetVisibility(False)
-            actor_text.SetVisibility(True)
-            mapper.Modified()
-            ren.Modified()  # force actors to have the correct visibility
-            ren_win.Render()
+            depth_ranges = self.get_view_depth_ranges(pd, transform_stack)
 
-            if write_image_files:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                writer_png.SetFileName(name_rgb)
-                writer_png.Write()
-            else:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                w2if.Update()
-
-            # add rendering to image stack
-            im = w2if.GetOutput()
-            rows, cols, _ = im.GetDimensions()
-            sc = im.GetPointData().GetScalars()
-            a = vtk_to_numpy(sc)
-            components = sc.GetNumberOfComponents()
-            a = a.reshape(rows, cols, components)
-            a = np.flipud(a)
-
-            # get RGB data - 3 first channels
-            image_stack[view, :, :, 0:3] = a[:, :, :]
-
-            actor_text.SetVisibility(False)
-            actor_geometry.SetVisibility(True)
-            mapper.Modified()
-            ren.Modified()  # force actors to have the correct visibility
-            ren_win.Render()
+            mapper = vtk.vtkPolyDataMapper()
+            mapper.SetInputData(pd)
 
+            # A pass renders either the textured or the shaded surface and is read as an RGB image. The Z-buffer
+            # is read from the last pass, so the shaded surface is rendered for depth only
+            passes = []
+            if 'RGB' in channels:
+                actor_text = vtk.vtkActor()
+                actor_text.SetMapper(mapper)
+                if texture_img is not None:
+                    actor_text.SetTexture(texture)
+                    actor_text.GetProperty().SetColor(1, 1, 1)
+                    actor_text.GetProperty().SetAmbient(1.0)
+                    actor_text.GetProperty().SetSpecular(0)
+                    actor_text.GetProperty().SetDiffuse(0)
+                passes.append(('RGB', actor_text))
+            if 'geometry' in channels or not passes:
+                actor_geometry = vtk.vtkActor()
+                actor_geometry.SetMapper(mapper)
+                passes.append(('geometry' if 'geometry' in channels else None, actor_geometry))
+            for _, actor in passes:
+                ren.AddActor(actor)
+
+            # The images are read directly from the render window into the image stack. The image files are written
+            # from the last rendering instead of rendering the window again
             if write_image_files:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                writer_png.SetFileName(name_geometry)
-                writer_png.Write()
-            else:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                w2if.Update()
-
-            # add rendering to image stack
-            im = w2if.GetOutput()
-            rows, cols, _ = im.GetDimensions()
-            sc = im.GetPointData().GetScalars()
-            a = vtk_to_numpy(sc)
-            components = sc.GetNumberOfComponents()
-            a = a.reshape(rows, cols, components)
-            a = np.flipud(a)
-
-            # get geometry data
-            image_stack[view, :, :, 3:4] = a[:, :, 0:1]
-
-            ren.Modified()  # force actors to have the correct visibility
-            ren_win.Render()
-            w2if.SetInputBufferTypeToZBuffer()
-            w2if.Modified()
+                w2if = vtk.vtkWindowToImageFilter()
+                w2if.SetInput(ren_win)
+                w2if.ShouldRerenderOff()
+                writer_png = vtk.vtkPNGWriter()
+                writer_png.SetInputConnection(w2if.GetOutputPort())
+
+                scale = vtk.vtkImageShiftScale()
+                scale.SetOutputScalarTypeToUnsignedChar()
+                scale.SetInputConnection(w2if.GetOutputPort())
+                scale.SetShift(0)
+                scale.SetScale(-255)
+
+                writer_png_2 = vtk.vtkPNGWriter()
+                writer_png_2.SetInputConnection(scale.GetOutputPort())
+
+            for view in range(n_views):
+                rx, ry, rz, s, tx, ty = transform_stack[view]
+
+                t.Identity()
+                t.RotateY(ry)
+                t.RotateX(rx)
+                t.RotateZ(rz)
+                t.Update()
+
+                xmin = VIEW_MIN
+                xmax = VIEW_MAX
+                ymin = VIEW_MIN
+                ymax = VIEW_MAX
+                zmin, zmax = depth_ranges[view]
+                xlen = xmax - xmin
+                ylen = ymax - ymin
+
+                cx = 0
+                cy = 0
+                extend_factor = 1.0
+                side_length = max([xlen, ylen]) * extend_factor
+                # zoom_fac = win_size / side_length
+
+                ren.GetActiveCamera().SetParallelScale(side_length / 2)
+                ren.GetActiveCamera().SetPosition(cx, cy, CAMERA_DISTANCE)
+                ren.GetActiveCamera().SetFocalPoint(cx, cy, 0)
+                ren.GetActiveCamera().SetViewUp(0, 1, 0)
+                ren.GetActiveCamera().ApplyTransform(t.GetInverse())
+                ren.GetActiveCamera().SetClippingRange(CAMERA_DISTANCE - zmax - slack, CAMERA_DISTANCE - zmin + slack)
+
+                for channel, actor in passes:
+                    for _, other_actor in passes:
+                        other_actor.SetVisibility(other_actor is actor)
+                    mapper.Modified()
+                    ren.Modified()  # force actors to have the correct visibility
+                    ren_win.Render()
+
+                    if channel is None:
+                        continue
+                    self.read_pixels(ren_win, image_stack, view, first_channels[channel], channel_sizes[channel])
+                    if write_image_files:
+                        w2if.SetInputBufferTypeToRGB()
+                        w2if.Modified()  # Needed here else only first rendering is put to file
+                        name_rendering = str(self.config.temp_dir / ('rendering' + str(view) + '_' + channel + '.png'))
+                        writer_png.SetFileName(name_rendering)
+                        writer_png.Write()
+
+                if 'depth' in channels:
+                    self.read_depth(ren_win, image_stack, view, first_channels['depth'])
+                    if write_image_files:
+                        w2if.SetInputBufferTypeToZBuffer()
+                        w2if.Modified()
+                        name_depth = str(self.config.temp_dir / ('rendering' + str(view) + '_zbuffer.png'))
+                        writer_png_2.SetFileName(name_depth)
+                        writer_png_2.Write()
 
             if write_image_files:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                writer_png_2.SetFileName(name_depth)
-                writer_png_2.Write()
-            else:
-                w2if.Modified()  # Needed here else only first rendering is put to file
-                w2if.Update()
-
-            scale.Update()
-            im = scale.GetOutput()
-            rows, cols, _ = im.GetDimensions()
-            sc = im.GetPointData().GetScalars()
-            a = vtk_to_numpy(sc)
-            components = sc.GetNumberOfComponents()
-            a = a.reshape(rows, cols, components)
-            a = np.flipud(a)
-
-            # get depth data
-            image_stack[view, :, :, 4:5] = a[:, :, 0:1]
-
-            actor_geometry.SetVisibility(False)
-            actor_text.SetVisibility(True)
-            ren.Modified()
-
-        del writer_png_2, writer_png, ren_win, actor_geometry, actor_text, mapper, w2if, t, trans
-        if texture_img is not None:
-            del texture_img
+                del writer_png_2, writer_png, scale, w2if
+        finally:
+            ren_win.RemoveRenderer(ren)
+        del ren, passes, mapper, t
+        if texture_img is not None and 'RGB' in channels:
             del texture
-        # del texture_image
         end = time.time()
         self.logger.debug("File load and rendering time: " + str(end - start))
 
         return image_stack
 
-    def render_3d_file(self, file_name):
-        image_channels = self.config['data_loader']['args']['image_channels']
-        file_type = (os.path.splitext(file_name)[1]).lower()
-
-        image_stack = None
-        transformation_stack = None
-        n_views = self.config['data_loader']['args']['n_views']
+    # Renders the geometry and depth channels with the numpy rasterizer instead of VTK/OpenGL. Returns the same image
+    # stack as render_3d_multi_rgb_geometry_depth. Used when process_3d.renderer is 'numpy'
+    def render_3d_geometry_depth_software(self, transform_stack, mesh, channels=('geometry', 'depth'),
+                                          image_stack=None):
+        write_image_files = self.config['process_3d']['write_renderings']
+        n_views = transform_stack.shape[0]
         win_size = self.config['data_loader']['args']['image_size']
 
-        if file_type == ".obj" and image_channels == "RGB":
-            transformation_stack = self.generate_3d_transformations()
-            image_stack = self.render_3d_obj_rgb(transformation_stack, file_name)
-            image_stack = image_stack / 255
-        elif file_type == ".obj" and image_channels == "RGB+depth":
-            transformation_stack = self.generate_3d_transformations()
-            image_stack_rgb = self.render_3d_obj_rgb(transformation_stack, file_name)
-            image_stack_full = self.render_3d_multi_rgb_geometry_depth(
-                transformation_stack, file_name)
-            # image_stack_depth = self.render_3d_obj_depth(transformation_stack, file_name)
-            n_channels = 4
-            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
-            image_stack[:, :, :, 0:3] = image_stack_rgb / 255
-            image_stack[:, :, :, 3:4] = image_stack_full[:, :, :, 4:5] / 255
-        elif (file_type in [".vtk", ".vtp", ".stl", ".ply", ".wrl"]) and image_channels == "RGB":
-            transformation_stack = self.generate_3d_transformations()
-            image_stack_full = self.render_3d_multi_rgb_geometry_depth(
-                transformation_stack, file_name)
-            n_channels = 3
-            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
-            image_stack[:, :, :, 0:3] = image_stack_full[:, :, :, 0:3] / 255
-        elif (file_type in [".vtk", ".vtp", ".stl", ".ply", ".wrl", ".obj"]) and image_channels == "geometry":
-            transformation_stack = self.generate_3d_transformations()
-            image_stack_full = self.render_3d_multi_rgb_geometry_depth(
-                transformation_stack, file_name)
-            n_channels = 1
-            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
-            image_stack[:, :, :, 0:1] = image_stack_full[:, :, :, 3:4] / 255
-        elif (file_type in [".vtk", ".vtp", ".stl", ".ply", ".wrl", ".obj"]) and image_channels == "depth":
-            transformation_stack = self.generate_3d_transformations()
-            image_stack_full = self.render_3d_multi_rgb_geometry_depth(
-                transformation_stack, file_name)
-            n_channels = 1
-            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
-            image_stack[:, :, :, 0:1] = image_stack_full[:, :, :, 4:5] / 255
-        elif (file_type in [".vtk", ".vtp", ".stl", ".ply", ".wrl"]) and image_channels == "RGB+depth":
-            transformation_stack = self.generate_3d_transformations()
-            image_stack_full = self.render_3d_multi_rgb_geometry_depth(
-                transformation_stack, file_name)
-            n_channels = 4
-            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
-            image_stack[:, :, :, 0:3] = image_stack_full[:, :, :, 0:3] / 255
-            image_stack[:, :, :, 3:4] = image_stack_full[:, :, :, 4:5] / 255
-        elif (file_type in [".vtk", ".vtp", ".stl", ".ply", ".wrl", ".obj"]) and image_channels == "geometry+depth":
+        start = time.time()
+        pd = mesh.get_aligned_surface()
+        renderer = SoftwareRenderer(pd, win_size)
+        depth_ranges = self.get_view_depth_ranges(pd, transform_stack)
+        rotations = Utils3D.get_view_rotation_matrices(transform_stack)
+
+        if image_stack is None:
+            image_stack = np.zeros((n_views, win_size, win_size, len(channels)), dtype=np.uint8)
+        for view in range(n_views):
+            image_stack[view] = renderer.render(rotations[view], depth_ranges[view, 0], depth_ranges[view, 1], channels)
+            if write_image_files:
+                for idx, channel in enumerate(channels):
+                    name = 'geometry' if channel == 'geometry' else 'zbuffer'
+                    name_rendering = str(self.config.temp_dir / ('rendering' + str(view) + '_' + name + '.png'))
+                    self.write_png(image_stack[view, :, :, idx:idx + 1], name_rendering)
+        end = time.time()
+        self.logger.debug("Software rendering time: " + str(end - start))
+        return image_stack
+
+    # Writes an image (rows, cols, channels) with values from 0 to 255 with the first row at the top as a PNG file
+    @staticmethod
+    def write_png(image, file_name):
+        rows, cols, components = image.shape
+        im = vtk.vtkImageData()
+        im.SetDimensions(cols, rows, 1)
+        pixels = np.ascontiguousarray(np.flipud(image).reshape(rows * cols, components), dtype=np.uint8)
+        im.GetPointData().SetScalars(vtk.numpy_to_vtk(pixels, deep=True))
+        writer = vtk.vtkPNGWriter()
+        writer.SetInputData(im)
+        writer.SetFileName(file_name)
+        writer.Write()
+
+    # mesh is either a Mesh3D or the name of a mesh file
+    # transformation_stack: the views to render. When None n_views random views are generated
+    # image_stack: when given (an unsigned char array of n_views x image_size x image_size x channels) the views are
+    # rendered into it, for instance into shared memory, instead of into a new image stack
+    # Returns the image stack with values from 0 to 255 - the images are scaled to [0, 1] when they are given to the
+    # model (see prediction/backends.py)
+    def render_3d_file(self, mesh, transformation_stack=None, image_stack=None):
+        if not isinstance(mesh, Mesh3D):
+            mesh = Mesh3D(self.config, mesh)
+        if not mesh.is_valid():
+            return None, None
+        image_channels = self.config['data_loader']['args']['image_channels']
+        file_type = (os.path.splitext(mesh.file_name)[1]).lower()
+
+        if transformation_stack is None:
             transformation_stack = self.generate_3d_transformations()
-            image_stack_full = self.render_3d_multi_rgb_geometry_depth(
-                transformation_stack, file_name)
-            n_channels = 2
-            image_stack = np.zeros((n_views, win_size, win_size, n_channels), dtype=np.float32)
-            image_stack[:, :, :, 0:1] = image_stack_full[:, :, :, 3:4] / 255
-            image_stack[:, :, :, 1:2] = image_stack_full[:, :, :, 4:5] / 255
+
+        if file_type == ".obj" and image_channels in ["RGB", "RGB+depth"]:
+            # The texture and the Z-buffer are read from the same rendering of the OBJ file
+            image_stack = self.render_3d_obj(transformation_stack, mesh, image_channels.split('+'), image_stack)
+        elif ((file_type in [".vtk", ".vtp", ".stl", ".ply", ".wrl"]) and image_channels in ["RGB", "RGB+depth"]) or \
+                ((file_type in [".vtk", ".vtp", ".stl", ".ply", ".wrl", ".obj"]) and
+                 image_channels in ["geometry", "depth", "geometry+depth"]):
+            # The channels are rendered in the order of image_channels
+            channels = image_channels.split('+')
+            if self.config['process_3d'].get('renderer', 'vtk') == 'numpy' and 'RGB' not in channels:
+                image_stack = self.render_3d_geometry_depth_software(transformation_stack, mesh, channels, image_stack)
+            else:
+                image_stack = self.render_3d_multi_rgb_geometry_depth(transformation_stack, mesh, channels,
+                                                                      image_stack)
         else:
             print("Can not render filetype ", file_type, " using image_channels ", image_channels)
+            image_stack = None
+            transformation_stack = None
 
         return image_stack, transformation_stack
 
@@ -0,0 +1,175 @@
+import numpy as np
+
+from utils3d import vtk_lazy as vtk
+
+
+# Closest points on the triangles (a[i], b[i], c[i]) to the points p[i] (all (n, 3)), using the regions of
+# "Real-Time Collision Detection" (Ericson) for all triangles at once. Degenerate triangles give nan
+def closest_points_on_triangles(p, a, b, c):
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    bp = p - b
+    cp = p - c
+    d1 = np.einsum('ij,ij->i', ab, ap)
+    d2 = np.einsum('ij,ij->i', ac, ap)
+    d3 = np.einsum('ij,ij->i', ab, bp)
+    d4 = np.einsum('ij,ij->i', ac, bp)
+    d5 = np.einsum('ij,ij->i', ab, cp)
+    d6 = np.einsum('ij,ij->i', ac, cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # The regions are tested in the opposite order of Ericson, so the first matching region is set last
+        denom = va + vb + vc
+        closest = a + ab * (vb / denom)[:, np.newaxis] + ac * (vc / denom)[:, np.newaxis]
+
+        edge_bc = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        closest[edge_bc] = (b + (c - b) * w[:, np.newaxis])[edge_bc]
+
+        edge_ac = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        w = d2 / (d2 - d6)
+        closest[edge_ac] = (a + ac * w[:, np.newaxis])[edge_ac]
+
+        vertex_c = (d6 >= 0) & (d5 <= d6)
+        closest[vertex_c] = c[vertex_c]
+
+        edge_ab = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        v = d1 / (d1 - d3)
+        closest[edge_ab] = (a + ab * v[:, np.newaxis])[edge_ab]
+
+    vertex_b = (d3 >= 0) & (d4 <= d3)
+    closest[vertex_b] = b[vertex_b]
+    vertex_a = (d1 <= 0) & (d2 <= 0)
+    closest[vertex_a] = a[vertex_a]
+    return closest
+
+
+class SurfaceIndex:
+    """
+    Spatial index of the triangles of a surface for closest point queries.
+
+    The triangle centroids are put in a KD-tree. The closest triangle to a point is at most
+    the distance d to the triangle of its nearest centroid away, so only the triangles with a centroid closer
+    than d plus the largest triangle radius (the distance from the centroid to the farthest corner) have to be
+    checked. Triangles much larger than the typical triangle are kept out of the tree and checked for all points,
+    so a few large triangles do not make every query check many triangles.
+    All points are queried at once. The index only depends on the surface, so it can be saved with save() and read
+    again with load() instead of being built again. The arrays are saved as an .npz file (without pickles) and the
+    KD-tree is built again from them when the index is read.
+    """
+    # Triangles with a radius above this factor times the median radius are checked for all points
+    large_triangle_factor = 4
+    # Version of the saved index, which is part of the file names of saved indices
+    format_version = 2
+
+    def __init__(self, points, triangles):
+        self.points = np.ascontiguousarray(points, dtype=np.float64)
+        self.triangles = np.ascontiguousarray(triangles, dtype=np.int64)
+        a = self.points[self.triangles[:, 0]]
+        b = self.points[self.triangles[:, 1]]
+        c = self.points[self.triangles[:, 2]]
+        centroids = (a + b + c) / 3
+        radii2 = np.einsum('ij,ij->i', a - centroids, a - centroids)
+        np.maximum(radii2, np.einsum('ij,ij->i', b - centroids, b - centroids), out=radii2)
+        np.maximum(radii2, np.einsum('ij,ij->i', c - centroids, c - centroids), out=radii2)
+        radii = np.sqrt(radii2)
+
+        large = radii > self.large_triangle_factor * np.median(radii) if len(radii) > 0 else radii > 0
+        self.large_triangles = np.nonzero(large)[0]
+        self.tree_triangles = np.nonzero(~large)[0]
+        self.max_radius = np.max(radii[self.tree_triangles]) if len(self.tree_triangles) > 0 else 0
+        self.tree = self.build_tree()
+
+    # An unbalanced tree without shrunk nodes is built several times faster and is only slightly slower to query
+    def build_tree(self):
+        from scipy.spatial import cKDTree
+
+        if len(self.tree_triangles) == 0:
+            return None
+        centroids = np.mean(self.points[self.triangles[self.tree_triangles]], axis=1)
+        return cKDTree(centroids, balanced_tree=False, compact_nodes=False)
+
+    # The surface is triangulated, so polygons and triangle strips can be used
+    @staticmethod
+    def from_polydata(pd):
+        triangle_filter = vtk.vtkTriangleFilter()
+        triangle_filter.SetInputData(pd)
+        triangle_filter.PassVertsOff()
+        triangle_filter.PassLinesOff()
+        triangle_filter.Update()
+        triangulated = triangle_filter.GetOutput()
+        points = vtk.vtk_to_numpy(triangulated.GetPoints().GetData())
+        triangles = vtk.vtk_to_numpy(triangulated.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+        return SurfaceIndex(points, triangles)
+
+    @property
+    def n_triangles(self):
+        return self.triangles.shape[0]
+
+    # The closest points on the triangles with the given ids to the points with the given ids. Returns the closest
+    # points and the squared distances
+    def closest_points_on_candidates(self, query, point_ids, triangle_ids):
+        corners = self.points[self.triangles[triangle_ids]]
+        p = query[point_ids]
+        closest = closest_points_on_triangles(p, corners[:, 0], corners[:, 1], corners[:, 2])
+        dist2 = np.sum((closest - p) ** 2, axis=1)
+        dist2[np.isnan(dist2)] = np.inf
+        return closest, dist2
+
+    # query: points (n, 3). Returns the closest points on the surface (n, 3) and the distances (n)
+    def closest_points(self, query):
+        query = np.asarray(query, dtype=np.float64).reshape(-1, 3)
+        n_points = query.shape[0]
+        point_ids = [np.zeros(0, dtype=np.int64)]
+        triangle_ids = [np.zeros(0, dtype=np.int64)]
+
+        if self.tree is not None:
+            # The triangle of the nearest centroid gives an upper bound of the distance
+            _, nearest = self.tree.query(query)
+            _, dist2 = self.closest_points_on_candidates(query, np.arange(n_points), self.tree_triangles[nearest])
+            radius = np.sqrt(dist2) + self.max_radius
+            radius[~np.isfinite(radius)] = np.inf
+            candidates = self.tree.query_ball_point(query, radius)
+            counts = [len(c) for c in candidates]
+            point_ids.append(np.repeat(np.arange(n_points), counts))
+            triangle_ids.append(self.tree_triangles[np.concatenate(candidates).astype(np.int64)])
+        if len(self.large_triangles) > 0:
+            point_ids.append(np.repeat(np.arange(n_points), len(self.large_triangles)))
+            triangle_ids.append(np.tile(self.large_triangles, n_points))
+
+        point_ids = np.concatenate(point_ids)
+        triangle_ids = np.concatenate(triangle_ids)
+        closest, dist2 = self.closest_points_on_candidates(query, point_ids, triangle_ids)
+
+        # The candidate with the smallest distance for each point
+        order = np.lexsort((dist2, point_ids))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = point_ids[order[1:]] != point_ids[order[:-1]]
+        best = order[first]
+        projected = np.full((n_points, 3), np.nan)
+        distances = np.full(n_points, np.inf)
+        projected[point_ids[best]] = closest[best]
+        distances[point_ids[best]] = np.sqrt(dist2[best])
+        return projected, distances
+
+    # f: a file opened for binary writing
+    def save(self, f):
+        np.savez(f, format_version=self.format_version, points=self.points, triangles=self.triangles,
+                 large_triangles=self.large_triangles, tree_triangles=self.tree_triangles, max_radius=self.max_radius)
+
+    @staticmethod
+    def load(file_name):
+        index = SurfaceIndex.__new__(SurfaceIndex)
+        with np.load(file_name, allow_pickle=False) as arrays:
+            if int(arrays['format_version']) != SurfaceIndex.format_version:
+                raise ValueError('{} is a surface index of version {} - expected version {}'.format(
+                    file_name, int(arrays['format_version']), SurfaceIndex.format_version))
+            for name in ['points', 'triangles', 'large_triangles', 'tree_triangles']:
+                setattr(index, name, arrays[name])
+            index.max_radius = float(arrays['max_radius'])
+        index.tree = index.build_tree()
+        return index
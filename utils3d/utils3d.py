@@ -1,7 +1,14 @@
 import numpy as np
-import vtk
+from utils3d import vtk_lazy as vtk
+from utils3d.view_artifact import ViewArtifact
 import os
 
+# The views are rendered with a parallel projection of the square from VIEW_MIN to VIEW_MAX in x and y seen from a
+# camera at z = CAMERA_DISTANCE that looks at the origin. The view lines go from z = CAMERA_DISTANCE to -CAMERA_DISTANCE
+VIEW_MIN = -150
+VIEW_MAX = 150
+CAMERA_DISTANCE = 500
+
 
 class Utils3D:
     def __init__(self, config):
@@ -11,12 +18,18 @@ class Utils3D:
         self.lm_start = None
         self.lm_end = None
         self.landmarks = None
+        self.landmark_errors = None
+        self.landmark_inliers = None
         self.logger = config.get_logger('Utils3D')
 
+    # dir_name: directory with one text file per view or a view artifact file (see write_view_artifact)
     def read_heatmap_maxima(self, dir_name=None):
         if dir_name is None:
             dir_name = str(self.config.temp_dir)
         print('Reading from', dir_name)
+        if os.path.isfile(dir_name):
+            self.heatmap_maxima = ViewArtifact.read(dir_name, ['heatmap_maxima'])['heatmap_maxima']
+            return
 
         n_landmarks = self.config['arch']['args']['n_landmarks']
         n_views = self.config['data_loader']['args']['n_views']
@@ -40,10 +53,14 @@ class Utils3D:
             if id_lm != n_landmarks:
                 print('Too few landmarks in file ', name_hm_maxima)
 
+    # dir_name: directory with one text file per view or a view artifact file (see write_view_artifact)
     def read_3d_transformations(self, dir_name=None):
         if dir_name is None:
             dir_name = str(self.config.temp_dir)
         print('Reading from', dir_name)
+        if os.path.isfile(dir_name):
+            self.transformations_3d = ViewArtifact.read(dir_name, ['transformations_3d'])['transformations_3d']
+            return
 
         n_views = self.config['data_loader']['args']['n_views']
 
@@ -55,9 +72,55 @@ class Utils3D:
             rx, ry, rz, s, tx, ty = np.loadtxt(name_hm_maxima)
             self.transformations_3d[idx, :] = (rx, ry, rz, s, tx, ty)
 
+    # Writes the heatmap maxima and view transformations (and the view lines when include_lines is true) as one
+    # binary ViewArtifact, so the 3D reconstruction can be run again without rendering and inference
+    def write_view_artifact(self, file_name, include_lines=False, metadata=None):
+        arrays = {'heatmap_maxima': self.heatmap_maxima, 'transformations_3d': self.transformations_3d}
+        if include_lines:
+            arrays['lm_start'] = self.lm_start
+            arrays['lm_end'] = self.lm_end
+        ViewArtifact.write(file_name, arrays, metadata)
+
+    # Reads the heatmap maxima, view transformations and view lines (when written) of a ViewArtifact as memory maps
+    def read_view_artifact(self, file_name):
+        arrays = ViewArtifact.read(file_name)
+        self.heatmap_maxima = arrays['heatmap_maxima']
+        self.transformations_3d = arrays['transformations_3d']
+        self.lm_start = arrays.get('lm_start')
+        self.lm_end = arrays.get('lm_end')
+
+    # The view artifact written next to a mesh file
+    @staticmethod
+    def get_view_artifact_name(file_name):
+        return os.path.splitext(file_name)[0] + '_views.bin'
+
+    # The rotation matrices of the view transformations as (n_views, 3, 3)
+    # Same as a vtkTransform with RotateY(ry), RotateX(rx) and RotateZ(rz) applied in that order
+    @staticmethod
+    def get_view_rotation_matrices(transformations_3d):
+        angles = np.radians(np.asarray(transformations_3d, dtype=np.float64)[:, 0:3])
+        cx, cy, cz = np.cos(angles[:, 0]), np.cos(angles[:, 1]), np.cos(angles[:, 2])
+        sx, sy, sz = np.sin(angles[:, 0]), np.sin(angles[:, 1]), np.sin(angles[:, 2])
+        n_views = angles.shape[0]
+        ones = np.ones(n_views)
+        zeros = np.zeros(n_views)
+
+        rot_x = np.stack([ones, zeros, zeros, zeros, cx, -sx, zeros, sx, cx], axis=1).reshape(n_views, 3, 3)
+        rot_y = np.stack([cy, zeros, sy, zeros, ones, zeros, -sy, zeros, cy], axis=1).reshape(n_views, 3, 3)
+        rot_z = np.stack([cz, -sz, zeros, sz, cz, zeros, zeros, zeros, ones], axis=1).reshape(n_views, 3, 3)
+        return np.matmul(np.matmul(rot_y, rot_x), rot_z)
+
     # Each maxima in a heatmap corresponds to a line in 3D space of the original 3D shape
     # This function transforms the maxima to (start point, end point) pairs
+    # The back-projection tables of the views are computed once per set of transformations (see ViewSet)
     def compute_lines_from_heatmap_maxima(self):
+        from utils3d.viewset import get_view_set
+
+        view_set = get_view_set(self.config, self.transformations_3d)
+        self.lm_start, self.lm_end = view_set.compute_lines(self.heatmap_maxima)
+
+    # Reference implementation of compute_lines_from_heatmap_maxima that transforms each line using vtk
+    def compute_lines_from_heatmap_maxima_vtk(self):
         n_landmarks = self.heatmap_maxima.shape[0]
         n_views = self.heatmap_maxima.shape[1]
 
@@ -68,11 +131,10 @@ class Utils3D:
         hm_size = self.config['data_loader']['args']['heatmap_size']
         winsize = img_size
 
-        # TODO these fixed values should probably be in a config file
-        x_min = -150
-        x_max = 150
-        y_min = -150
-        y_max = 150
+        x_min = VIEW_MIN
+        x_max = VIEW_MAX
+        y_min = VIEW_MIN
+        y_max = VIEW_MAX
         x_len = x_max - x_min
         y_len = y_max - y_min
 
@@ -107,20 +169,20 @@ class Utils3D:
 
                 p_wc_s[0] = (x / winsize) * x_len + x_min
                 p_wc_s[1] = ((winsize - 1 - y) / winsize) * y_len + y_min
-                p_wc_s[2] = 500
+                p_wc_s[2] = CAMERA_DISTANCE
 
                 p_wc_e[0] = (x / winsize) * x_len + x_min
                 p_wc_e[1] = ((winsize - 1 - y) / winsize) * y_len + y_min
-                p_wc_e[2] = -500
+                p_wc_e[2] = -CAMERA_DISTANCE
 
                 # Insert line into vtk-framework to transform
                 points = vtk.vtkPoints()
                 lines = vtk.vtkCellArray()
 
                 lines.InsertNextCell(2)
-                pid = points.InsertNextPoint(p_wc_s)
+                pid = points.InsertNextPoint(p_wc_s[:, 0])
                 lines.InsertCellPoint(pid)
-                pid = points.InsertNextPoint(p_wc_e)
+                pid = points.InsertNextPoint(p_wc_e[:, 0])
                 lines.InsertCellPoint(pid)
 
                 pd.SetPoints(points)
@@ -289,8 +351,157 @@ class Utils3D:
         pb_new = pb[idx]
         return pa_new, pb_new
 
+    # Mask (n_landmarks, n_views) of the view lines that correspond to a high valued maxima in the heatmap
+    def get_view_line_mask(self):
+        max_values = self.heatmap_maxima[:, :, 2]
+        filter_type = self.config['process_3d']['filter_view_lines']
+        if filter_type == "abs_value":
+            threshold = self.config['process_3d']['heatmap_abs_threshold']
+            return max_values > threshold
+        elif filter_type == "quantile":
+            q = self.config['process_3d']['heatmap_max_quantile']
+            threshold = np.quantile(max_values, q, axis=1)
+            return max_values > threshold[:, np.newaxis]
+        return np.ones(max_values.shape, dtype=bool)
+
+    """
+    Batched version of compute_intersection_between_lines.
+    a      : (n_landmarks, n_lines, 3, 3) matrices n n^T - I, where n is the unit direction of each line
+    a_pa   : (n_landmarks, n_lines, 3) the matrices applied to the start point of each line
+    w      : (n_landmarks, n_sets, n_lines) weights selecting the lines used in each set
+    return : (n_landmarks, n_sets, 3) least squares intersection point of the lines in each set """
+    @staticmethod
+    def compute_intersection_between_line_sets(a, a_pa, w):
+        n_landmarks, n_lines = a.shape[0:2]
+        s = np.matmul(w, a.reshape(n_landmarks, n_lines, 9)).reshape(w.shape[0:2] + (3, 3))
+        c = np.matmul(w, a_pa)
+        p_intersect = np.matmul(np.linalg.pinv(s), c[..., np.newaxis])
+        return p_intersect[..., 0]
+
+    # Squared distances (n_landmarks, n_sets, n_lines) from the points p (n_landmarks, n_sets, 3) to all lines
+    # given by their start points pa and unit directions ni (n_landmarks, n_lines, 3)
+    @staticmethod
+    def compute_squared_distances_to_lines(p, pa, ni):
+        p_pa = p[:, :, np.newaxis, :] - pa[:, np.newaxis, :, :]
+        along = np.einsum('lsvk,lvk->lsv', p_pa, ni)
+        return np.einsum('lsvk,lsvk->lsv', p_pa, p_pa) - along ** 2
+
     # Each landmark can be computed by the intersection of the view lines going trough (or near) it
+    # RANSAC is done for all landmarks at once: all hypotheses are drawn up front, solved as a stack of
+    # 3x3 systems, scored against all lines and refitted on their inliers.
+    # Lines removed by the heatmap value filter are masked out.
+    # The hypotheses are drawn with process_3d.ransac_seed, so the same view lines give the same landmarks
     def compute_all_landmarks_from_view_lines(self):
+        # TODO should find a better way to esimtate dist_thres
+        dist_thres = 10 * 10
+        iterations = self.config['process_3d'].get('ransac_iterations', 100)
+        rng = np.random.RandomState(self.config['process_3d'].get('ransac_seed', 0))
+
+        pa = self.lm_start
+        pb = self.lm_end
+        n_landmarks, n_views = pa.shape[0:2]
+        valid = self.get_view_line_mask()
+        n_valid = np.sum(valid, axis=1)
+
+        si = pb - pa
+        ni = si / np.linalg.norm(si, axis=-1, keepdims=True)
+        a = ni[..., :, np.newaxis] * ni[..., np.newaxis, :] - np.eye(3)
+        a_pa = np.matmul(a, pa[..., np.newaxis])[..., 0]
+
+        # get 3 random valid lines per hypothesis
+        keys = rng.uniform(size=(n_landmarks, iterations, n_views))
+        keys[np.broadcast_to(~valid[:, np.newaxis, :], keys.shape)] = 2
+        ran_lines = np.argpartition(keys, 2, axis=-1)[:, :, 0:3]
+        w = np.zeros((n_landmarks, iterations, n_views))
+        np.put_along_axis(w, ran_lines, 1, axis=-1)
+
+        # Compute first estimate of intersection and distance from all lines to intersection
+        p_est = self.compute_intersection_between_line_sets(a, a_pa, w)
+        distances = self.compute_squared_distances_to_lines(p_est, pa, ni)
+        inliers = (distances < dist_thres) & valid[:, np.newaxis, :]
+        n_inliers = np.sum(inliers, axis=-1)
+
+        # reestimate based on inliers
+        p_est = self.compute_intersection_between_line_sets(a, a_pa, inliers.astype(np.float64))
+        distances = self.compute_squared_distances_to_lines(p_est, pa, ni)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_squared = np.sum(np.where(inliers, distances, 0), axis=-1) / n_inliers
+        accepted = n_inliers > n_valid[:, np.newaxis] / 3
+        sum_squared[~accepted] = np.inf
+
+        best = np.argmin(sum_squared, axis=1)
+        lm_ids = np.arange(n_landmarks)
+        self.landmarks = p_est[lm_ids, best]
+        self.landmark_errors = sum_squared[lm_ids, best]
+        self.landmark_inliers = n_inliers[lm_ids, best]
+
+        failed = ~np.any(accepted, axis=1)
+        if np.any(failed):
+            self.logger.warning('Ransac failed for {} landmarks - estimating from all lines'.format(np.sum(failed)))
+            p_all = self.compute_intersection_between_line_sets(a, a_pa, valid[:, np.newaxis, :].astype(np.float64))
+            self.landmarks[failed] = p_all[failed, 0]
+            self.landmark_errors[failed] = 100000000
+            self.landmark_inliers[failed] = 0
+
+        too_few = n_valid < 3
+        for lm_no in np.nonzero(too_few)[0]:
+            print('Not enough valid view lines for landmark ', lm_no)
+        self.landmarks[too_few] = (0, 0, 0)
+        self.landmark_errors[too_few] = 0
+        self.landmark_inliers[too_few] = 0
+
+        print("Ransac average error ", np.sum(self.landmark_errors) / n_landmarks)
+
+    # Re-estimates each landmark from all valid view lines within the RANSAC distance of its current estimate
+    # (its consensus set) and updates the number of inliers and the error accordingly. The RANSAC estimate
+    # is fitted to the inliers of a single hypothesis, which makes it vary with the random hypotheses.
+    # Landmarks without inliers are not changed
+    def refine_landmarks_on_consensus(self, iterations=2, dist_thres=10 * 10):
+        pa = self.lm_start
+        pb = self.lm_end
+        valid = self.get_view_line_mask()
+        ni = (pb - pa) / np.linalg.norm(pb - pa, axis=-1, keepdims=True)
+        a = ni[..., :, np.newaxis] * ni[..., np.newaxis, :] - np.eye(3)
+        a_pa = np.matmul(a, pa[..., np.newaxis])[..., 0]
+
+        refine = self.landmark_inliers > 0
+        p_est = self.landmarks[:, np.newaxis, :]
+        for _ in range(iterations):
+            distances = self.compute_squared_distances_to_lines(p_est, pa, ni)[:, 0]
+            inliers = (distances < dist_thres) & valid
+            n_inliers = np.sum(inliers, axis=-1)
+            # At least 3 lines are needed to determine the intersection
+            refine &= n_inliers >= 3
+            w = np.where(refine[:, np.newaxis], inliers, valid).astype(np.float64)
+            p_new = self.compute_intersection_between_line_sets(a, a_pa, w[:, np.newaxis, :])[:, 0]
+            p_est = np.where(refine[:, np.newaxis], p_new, self.landmarks)[:, np.newaxis, :]
+
+        distances = self.compute_squared_distances_to_lines(p_est, pa, ni)[:, 0]
+        inliers = (distances < dist_thres) & valid
+        n_inliers = np.sum(inliers, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            errors = np.sum(np.where(inliers, distances, 0), axis=-1) / n_inliers
+        self.landmarks[refine] = p_est[refine, 0]
+        self.landmark_inliers[refine] = n_inliers[refine]
+        self.landmark_errors[refine] = errors[refine]
+
+    # True when every landmark moved less than landmark_tolerance and its fraction of inlier view lines changed
+    # less than inlier_tolerance between two estimates from an increasing number of views.
+    # previous and current are (landmarks, landmark_inliers, n_views). Landmarks without inliers in both estimates
+    # (too few valid lines, for instance when the landmark is occluded, or RANSAC failed) are left out, and a
+    # landmark with inliers in only one of them has not converged. At least one landmark must have inliers
+    @staticmethod
+    def landmark_estimates_converged(previous, current, landmark_tolerance, inlier_tolerance):
+        prev_landmarks, prev_inliers, prev_n_views = previous
+        landmarks, inliers, n_views = current
+        found = (inliers > 0) | (prev_inliers > 0)
+        moved = np.linalg.norm(landmarks - prev_landmarks, axis=1)
+        ratio_change = np.abs(inliers / n_views - prev_inliers / prev_n_views)
+        stable = (moved < landmark_tolerance) & (ratio_change < inlier_tolerance) & (inliers > 0) & (prev_inliers > 0)
+        return bool(np.any(found) and np.all(stable[found]))
+
+    # Reference implementation of compute_all_landmarks_from_view_lines that runs RANSAC one landmark at a time
+    def compute_all_landmarks_from_view_lines_loop(self):
         n_landmarks = self.heatmap_maxima.shape[0]
         self.landmarks = np.zeros((n_landmarks, 3))
 
@@ -355,22 +566,41 @@ class Utils3D:
             print("Can not read files with extenstion", file_extension)
             return None
 
+    # The texture image next to the mesh file or None
     @staticmethod
-    def multi_read_texture(file_name, texture_file_name=None):
-        if texture_file_name is None:
-            img_texture = os.path.splitext(file_name)[0] + ".bmp"
-            if os.path.isfile(img_texture):
-                texture_file_name = img_texture
-            img_texture = os.path.splitext(file_name)[0] + ".png"
-            if os.path.isfile(img_texture):
-                texture_file_name = img_texture
-            img_texture = os.path.splitext(file_name)[0] + ".jpg"
+    def get_texture_file_name(file_name):
+        texture_file_name = None
+        img_texture = os.path.splitext(file_name)[0] + ".bmp"
+        if os.path.isfile(img_texture):
+            texture_file_name = img_texture
+        img_texture = os.path.splitext(file_name)[0] + ".png"
+        if os.path.isfile(img_texture):
+            texture_file_name = img_texture
+        img_texture = os.path.splitext(file_name)[0] + ".jpg"
+        if os.path.isfile(img_texture):
+            texture_file_name = img_texture
+        if file_name.find('RAW.wrl') > 0:
+            img_texture = file_name.replace('RAW.wrl', 'F3D.bmp')  # BU-3DFE RAW file hack
             if os.path.isfile(img_texture):
                 texture_file_name = img_texture
-            if file_name.find('RAW.wrl') > 0:
-                img_texture = file_name.replace('RAW.wrl', 'F3D.bmp')  # BU-3DFE RAW file hack
-                if os.path.isfile(img_texture):
-                    texture_file_name = img_texture
+        return texture_file_name
+
+    # The mesh file and the files next to it that are read with it: the texture image and the OBJ material file
+    @staticmethod
+    def get_input_file_names(file_name):
+        names = [file_name]
+        texture_file_name = Utils3D.get_texture_file_name(file_name)
+        if texture_file_name is not None:
+            names.append(texture_file_name)
+        mtl_name = os.path.splitext(file_name)[0] + '.mtl'
+        if file_name.lower().endswith('.obj') and os.path.isfile(mtl_name):
+            names.append(mtl_name)
+        return names
+
+    @staticmethod
+    def multi_read_texture(file_name, texture_file_name=None):
+        if texture_file_name is None:
+            texture_file_name = Utils3D.get_texture_file_name(file_name)
 
         # Load texture
         if texture_file_name is not None:
@@ -393,48 +623,19 @@ class Utils3D:
 
         return None
 
-    # TODO this is also present in render3D - should probably be merged
-    def apply_pre_transformation(self, pd):
-        translation = [0, 0, 0]
-        if self.config['pre-align']['align_center_of_mass']:
-            vtk_cm = vtk.vtkCenterOfMass()
-            vtk_cm.SetInputData(pd)
-            vtk_cm.SetUseScalarsAsWeights(False)
-            vtk_cm.Update()
-            cm = vtk_cm.GetCenter()
-            translation = [-cm[0], -cm[1], -cm[2]]
-
-        t = vtk.vtkTransform()
-        t.Identity()
-
-        rx = self.config['pre-align']['rot_x']
-        ry = self.config['pre-align']['rot_y']
-        rz = self.config['pre-align']['rot_z']
-        s = self.config['pre-align']['scale']
-
-        t.Scale(s, s, s)
-        t.RotateY(ry)
-        t.RotateX(rx)
-        t.RotateZ(rz)
-        t.Translate(translation)
-        t.Update()
-
-        # Transform (assuming only one mesh)
-        trans = vtk.vtkTransformPolyDataFilter()
-        trans.SetInputData(pd)
-        trans.SetTransform(t)
-        trans.Update()
-
-        if self.config['pre-align']['write_pre_aligned']:
-            name_out = str(self.config.temp_dir / ('pre_transform_mesh.vtk'))
-            writer = vtk.vtkPolyDataWriter()
-            writer.SetInputData(trans.GetOutput())
-            writer.SetFileName(name_out)
-            writer.Write()
-
-        return trans.GetOutput(), t
+    # The 4x4 matrix of a (linear) vtkTransform as a numpy array
+    @staticmethod
+    def get_transformation_matrix(t):
+        m = t.GetMatrix()
+        return np.array([[m.GetElement(i, j) for j in range(4)] for i in range(4)])
 
+    # Applies the inverse of the transformation t to the landmarks (n_landmarks, 3)
     def transform_landmarks_to_original_space(self, landmarks, t):
+        m = self.get_transformation_matrix(t.GetInverse())
+        return np.dot(landmarks, m[:3, :3].T) + m[:3, 3]
+
+    # Reference implementation of transform_landmarks_to_original_space using vtkTransformPolyDataFilter
+    def transform_landmarks_to_original_space_vtk(self, landmarks, t):
         points = vtk.vtkPoints()
         pd = vtk.vtkPolyData()
         # verts = vtk.vtkCellArray()
@@ -460,18 +661,32 @@ class Utils3D:
 
     # Project found landmarks to closest point on the target surface
     # return the landmarks in the original space
-    def project_landmarks_to_surface(self, mesh_name):
-        pd = self.multi_read_surface(mesh_name)
-
-        pd, t = self.apply_pre_transformation(pd)
-
-        clean = vtk.vtkCleanPolyData()
-        clean.SetInputData(pd)
-        # clean.SetInputConnection(pd.GetOutputPort())
-        clean.Update()
+    # mesh is either a Mesh3D or the name of a mesh file
+    # The landmarks are moved to the original space first and projected to the surface as read from the file, which
+    # gives the same points since the pre-transformation only rotates, translates and scales uniformly. All
+    # landmarks are projected at once using the surface index of the mesh (see Mesh3D.get_surface_index)
+    def project_landmarks_to_surface(self, mesh):
+        from utils3d.mesh3d import Mesh3D
+        if not isinstance(mesh, Mesh3D):
+            mesh = Mesh3D(self.config, mesh, for_rendering=False)
+
+        self.project_landmarks_to_surface_index(mesh.get_surface_index(),
+                                                self.get_transformation_matrix(mesh.pre_transform.GetInverse()))
+
+    # project_landmarks_to_surface with the SurfaceIndex of the surface and the matrix of the inverse
+    # pre-transformation, which can be sent to another process instead of the mesh
+    def project_landmarks_to_surface_index(self, surface_index, inverse_matrix):
+        landmarks = np.dot(self.landmarks, inverse_matrix[:3, :3].T) + inverse_matrix[:3, 3]
+        self.landmarks, _ = surface_index.closest_points(landmarks)
+
+    # Reference implementation of project_landmarks_to_surface using a vtkCellLocator
+    def project_landmarks_to_surface_vtk(self, mesh):
+        from utils3d.mesh3d import Mesh3D
+        if not isinstance(mesh, Mesh3D):
+            mesh = Mesh3D(self.config, mesh, for_rendering=False)
 
         locator = vtk.vtkCellLocator()
-        locator.SetDataSet(clean.GetOutput())
+        locator.SetDataSet(mesh.get_clean_surface())
         locator.SetNumberOfCellsPerBucket(1)
         locator.BuildLocator()
 
@@ -490,10 +705,8 @@ class Utils3D:
             projected_landmarks[i, :] = tcp
 
         # self.landmarks = projected_landmarks
-        self.landmarks = self.transform_landmarks_to_original_space(projected_landmarks, t)
+        self.landmarks = self.transform_landmarks_to_original_space_vtk(projected_landmarks, mesh.pre_transform)
 
-        del pd
-        del clean
         del locator
 
     def write_landmarks_as_vtk_points(self, dir_name=None):
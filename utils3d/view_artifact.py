@@ -0,0 +1,83 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+
+class ViewArtifact:
+    """
+    The intermediate results of the views of one scan in one binary file, so the 3D reconstruction can be run again
+    without rendering and inference.
+
+    The file starts with the magic string, the version and the length of a JSON header (both uint32), followed by
+    the header and the arrays. The header gives the dtype, shape and offset of each array (and optional metadata),
+    and the arrays are aligned to 64 bytes, so they are read as memory maps:
+        arrays = ViewArtifact.read(file_name)
+        heatmap_maxima = arrays['heatmap_maxima']          # (n_landmarks, n_views, 3)
+        transformations_3d = arrays['transformations_3d']  # (n_views, 6)
+    and lm_start and lm_end (n_landmarks, n_views, 3) when they were written.
+    """
+    magic = b'DMVLMVW\x00'
+    version = 1
+    alignment = 64
+
+    # arrays: dict with the arrays by name. metadata: dict that can be written as JSON
+    @staticmethod
+    def write(file_name, arrays, metadata=None):
+        arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items() if value is not None}
+        prefix_size = len(ViewArtifact.magic) + 8
+        header = b''
+        # The offsets depend on the header length, so the header is made until its length is stable
+        while True:
+            offset = prefix_size + len(header)
+            offset += -offset % ViewArtifact.alignment
+            entries = {}
+            for name, value in arrays.items():
+                entries[name] = {'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset}
+                offset += value.nbytes
+                offset += -offset % ViewArtifact.alignment
+            new_header = json.dumps({'arrays': entries, 'metadata': metadata or {}}).encode()
+            stable = len(new_header) == len(header)
+            header = new_header
+            if stable:
+                break
+
+        temp_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with open(temp_name, 'wb') as f:
+            f.write(ViewArtifact.magic + struct.pack('<II', ViewArtifact.version, len(header)) + header)
+            for name, value in arrays.items():
+                f.seek(entries[name]['offset'])
+                f.write(value.tobytes())
+        os.replace(temp_name, file_name)
+
+    @staticmethod
+    def read_header(file_name):
+        with open(file_name, 'rb') as f:
+            prefix = f.read(len(ViewArtifact.magic) + 8)
+            if prefix[:len(ViewArtifact.magic)] != ViewArtifact.magic:
+                raise ValueError('{} is not a view artifact'.format(file_name))
+            version, header_length = struct.unpack('<II', prefix[len(ViewArtifact.magic):])
+            if version > ViewArtifact.version:
+                raise ValueError('{} has the unknown view artifact version {}'.format(file_name, version))
+            return json.loads(f.read(header_length).decode())
+
+    # Returns a dict with the arrays as copy-on-write memory maps, so they can be changed without changing the file.
+    # names: the arrays to read (default all)
+    @staticmethod
+    def read(file_name, names=None):
+        header = ViewArtifact.read_header(file_name)
+        arrays = {}
+        for name, entry in header['arrays'].items():
+            if names is not None and name not in names:
+                continue
+            if np.prod(entry['shape']) == 0:
+                arrays[name] = np.zeros(entry['shape'], dtype=entry['dtype'])
+            else:
+                arrays[name] = np.memmap(file_name, dtype=entry['dtype'], mode='c', offset=entry['offset'],
+                                         shape=tuple(entry['shape']))
+        return arrays
+
+    @staticmethod
+    def read_metadata(file_name):
+        return ViewArtifact.read_header(file_name)['metadata']
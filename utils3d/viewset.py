@@ -0,0 +1,99 @@
+import functools
+
+import numpy as np
+
+from utils3d.utils3d import Utils3D, VIEW_MIN, VIEW_MAX, CAMERA_DISTANCE
+
+
+# Radical inverse of the indices in the given base - the Halton sequence for that base
+def halton_sequence(indices, base):
+    indices = np.asarray(indices, dtype=np.int64).copy()
+    result = np.zeros(indices.shape)
+    f = 1.0
+    while np.any(indices > 0):
+        f = f / base
+        result += f * (indices % base)
+        indices //= base
+    return result
+
+
+class ViewSet:
+    """
+    A set of view transformations with the tables needed to back-project heatmap maxima to view lines.
+
+    The view lines of a heatmap maximum at (row, col) in view v are
+        start = ray_origin[v] + row * ray_row[v] + col * ray_col[v]
+        end = start + ray_direction[v]
+    which is the same as applying the inverse view rotation to the end points computed in
+    Utils3D.compute_lines_from_heatmap_maxima. The tables only depend on the transformations and the image
+    and heatmap sizes, so they are computed once per view set (see get_view_set) and reused for every scan.
+    """
+    def __init__(self, transformations, img_size, hm_size):
+        self.transformations = transformations
+        self.rotations = Utils3D.get_view_rotation_matrices(transformations)
+
+        x_min = VIEW_MIN
+        y_min = VIEW_MIN
+        x_len = VIEW_MAX - VIEW_MIN
+        y_len = VIEW_MAX - VIEW_MIN
+        pixel_size_x = img_size / hm_size / img_size * x_len
+        pixel_size_y = img_size / hm_size / img_size * y_len
+
+        # The inverse of a rotation is its transpose, so the rows of the rotations are the camera axes
+        # in the original space
+        axis_x = self.rotations[:, 0, :]
+        axis_y = self.rotations[:, 1, :]
+        axis_z = self.rotations[:, 2, :]
+        self.ray_origin = (x_min * axis_x + ((img_size - 1) / img_size * y_len + y_min) * axis_y +
+                           CAMERA_DISTANCE * axis_z)
+        self.ray_row = -pixel_size_y * axis_y
+        self.ray_col = pixel_size_x * axis_x
+        self.ray_direction = -2 * CAMERA_DISTANCE * axis_z
+
+    @property
+    def n_views(self):
+        return self.transformations.shape[0]
+
+    # heatmap_maxima: [n_landmarks, n_views, row, col, value]. Returns the start and end points of the
+    # view lines as (n_landmarks, n_views, 3)
+    def compute_lines(self, heatmap_maxima):
+        row = heatmap_maxima[:, :, 0, np.newaxis]
+        col = heatmap_maxima[:, :, 1, np.newaxis]
+        lm_start = self.ray_origin + row * self.ray_row + col * self.ray_col
+        lm_end = lm_start + self.ray_direction
+        return lm_start, lm_end
+
+    # Deterministic, well spread view transformations inside the min/max angles of the process_3d section.
+    # The angles are given by the Halton sequences in base 2, 3 and 5 (starting at index 1, since index 0
+    # is the corner of the angle ranges), so the first n views of a larger set are also a good set.
+    @staticmethod
+    def generate_halton_transformations(config, n_views):
+        process_3d = config['process_3d']
+        indices = np.arange(1, n_views + 1)
+        transformations = np.zeros((n_views, 6), dtype=np.float32)
+        for axis, (name, base) in enumerate([('x', 2), ('y', 3), ('z', 5)]):
+            min_angle = process_3d['min_' + name + '_angle']
+            max_angle = process_3d['max_' + name + '_angle']
+            transformations[:, axis] = min_angle + halton_sequence(indices, base) * (max_angle - min_angle)
+        # scale, tx and ty are currently not used
+        transformations[:, 3] = 1
+        return transformations
+
+
+@functools.lru_cache(maxsize=32)
+def _get_cached_view_set(transformations_bytes, n_views, img_size, hm_size):
+    transformations = np.frombuffer(transformations_bytes, dtype=np.float64).reshape(n_views, 6)
+    return ViewSet(transformations, img_size, hm_size)
+
+
+# The view set of the given transformations with the image and heatmap sizes from the config. View sets are
+# cached, so the tables are only computed the first time a set of transformations is used
+def get_view_set(config, transformations):
+    transformations = np.ascontiguousarray(transformations, dtype=np.float64)
+    img_size = config['data_loader']['args']['image_size']
+    hm_size = config['data_loader']['args']['heatmap_size']
+    return _get_cached_view_set(transformations.tobytes(), transformations.shape[0], img_size, hm_size)
+
+
+def clear_view_set_cache():
+    _get_cached_view_set.cache_clear()
@@ -0,0 +1,75 @@
+"""
+Drop-in replacement for 'import vtk' that only imports the VTK modules that are used.
+
+'import vtk' loads all (more than a hundred) VTK modules, which takes most of a second. Here a class is
+imported from its own VTK module the first time it is used as vtk_lazy.vtkClassName, so reading a
+mesh does not load the rendering modules and importing utils3d does not load VTK at all.
+Classes that are not listed are taken from the full vtk package.
+"""
+import importlib
+
+# VTK module of the classes used in utils3d
+_class_modules = {
+    'VTK_ID_TYPE': 'vtkCommonCore',
+    'VTK_UNSIGNED_CHAR': 'vtkCommonCore',
+    'mutable': 'vtkCommonCore',
+    'reference': 'vtkCommonCore',
+    'vtkDoubleArray': 'vtkCommonCore',
+    'vtkFloatArray': 'vtkCommonCore',
+    'vtkPoints': 'vtkCommonCore',
+    'vtkUnsignedCharArray': 'vtkCommonCore',
+    'vtkCellArray': 'vtkCommonDataModel',
+    'vtkCellLocator': 'vtkCommonDataModel',
+    'vtkImageData': 'vtkCommonDataModel',
+    'vtkPolyData': 'vtkCommonDataModel',
+    'vtkTransform': 'vtkCommonTransforms',
+    'vtkAppendPolyData': 'vtkFiltersCore',
+    'vtkCenterOfMass': 'vtkFiltersCore',
+    'vtkCleanPolyData': 'vtkFiltersCore',
+    'vtkPolyDataNormals': 'vtkFiltersCore',
+    'vtkTriangleFilter': 'vtkFiltersCore',
+    'vtkTransformPolyDataFilter': 'vtkFiltersGeneral',
+    'vtkSphereSource': 'vtkFiltersSources',
+    'vtkImageShiftScale': 'vtkImagingCore',
+    'vtkOBJReader': 'vtkIOGeometry',
+    'vtkSTLReader': 'vtkIOGeometry',
+    'vtkBMPReader': 'vtkIOImage',
+    'vtkJPEGReader': 'vtkIOImage',
+    'vtkPNGReader': 'vtkIOImage',
+    'vtkPNGWriter': 'vtkIOImage',
+    'vtkOBJImporter': 'vtkIOImport',
+    'vtkVRMLImporter': 'vtkIOImport',
+    'vtkPolyDataReader': 'vtkIOLegacy',
+    'vtkPolyDataWriter': 'vtkIOLegacy',
+    'vtkPLYReader': 'vtkIOPLY',
+    'vtkXMLPolyDataReader': 'vtkIOXML',
+    'vtkInteractorStyleTrackballCamera': 'vtkInteractionStyle',
+    'vtkActor': 'vtkRenderingCore',
+    'vtkPolyDataMapper': 'vtkRenderingCore',
+    'vtkProperty': 'vtkRenderingCore',
+    'vtkRenderWindow': 'vtkRenderingCore',
+    'vtkRenderWindowInteractor': 'vtkRenderingCore',
+    'vtkRenderer': 'vtkRenderingCore',
+    'vtkTexture': 'vtkRenderingCore',
+    'vtkWindowToImageFilter': 'vtkRenderingCore',
+    'numpy_to_vtk': 'util.numpy_support',
+    'vtk_to_numpy': 'util.numpy_support',
+}
+
+# The rendering classes are abstract - the OpenGL implementations are registered by importing these modules
+_rendering_modules = {'vtkRenderingCore', 'vtkIOImport', 'vtkInteractionStyle'}
+_rendering_backend = ['vtkRenderingOpenGL2', 'vtkInteractionStyle']
+
+
+def __getattr__(name):
+    module_name = _class_modules.get(name)
+    if module_name is None:
+        module = importlib.import_module('vtk')
+    else:
+        module = importlib.import_module('vtkmodules.' + module_name)
+        if module_name in _rendering_modules:
+            for backend in _rendering_backend:
+                importlib.import_module('vtkmodules.' + backend)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value